@@ -43,6 +43,8 @@ class Coordinator(object):
                             name,
                             {'mappings': index['mappings']},
                         )
+                    else:
+                        self._update_mapping(name, index['mappings'])
             except Exception:
                 logger.warning("Can't connect to Elasticsearch, retrying...")
                 if i == 5:
@@ -85,6 +87,22 @@ class Coordinator(object):
         self.sources_counts = {}
         self.update_sources_counts()
 
+    def _update_mapping(self, name, mappings):
+        """Add new fields to the mapping of an existing index.
+
+        Indices created by older versions don't have everything in the YAML
+        file (for example the 'id' field and the '_source' exclude of
+        'datamart'). If the mapping conflicts, for example because a field
+        was created dynamically with another type, this only logs an error.
+        """
+        try:
+            self.elasticsearch.indices.put_mapping(
+                index=name,
+                body=mappings,
+            )
+        except elasticsearch.RequestError as e:
+            logger.error("Can't update mapping of index %r: %s", name, e)
+
     @staticmethod
     def build_discovery(dataset_id, metadata, discovery=None):
         if discovery is None:
@@ -266,6 +266,38 @@ def cache_get_or_set(cache_dir, key, create_function):
                 continue
 
 
+@contextlib.contextmanager
+def cache_get(cache_dir, key):
+    """Get an entry from the file cache if it exists, without creating it.
+
+    Like `cache_get_or_set()`, the path is locked with a shared lock in the
+    with-block. If the entry doesn't exist, None is returned instead::
+
+        with cache_get('/tmp/cache', 'key123') as entry_path:
+            if entry_path is not None:
+                with open(entry_path) as fp:
+                    print(fp.read())
+    """
+    entry_path = os.path.join(cache_dir, key + '.cache')
+    lock_path = os.path.join(cache_dir, key + '.lock')
+    with contextlib.ExitStack() as lock:
+        try:
+            lock.enter_context(FSLockShared(lock_path))
+        except FileNotFoundError:
+            pass
+        else:
+            if os.path.exists(entry_path):
+                PROM_CACHE_HITS.labels(cache_dir).inc(1)
+
+                # Update time on the file
+                with open(lock_path, 'a'):
+                    pass
+
+                yield entry_path
+                return
+        yield None
+
+
 def clear_cache(cache_dir, should_delete=None, only_if_possible=True):
     """Function used to safely clear a cache.
 
@@ -0,0 +1,66 @@
+import collections
+import threading
+import time
+
+
+class LRUCache(object):
+    """In-memory cache of bytes, bounded by their total size.
+
+    When adding an entry would make the cache bigger than ``max_bytes``, the
+    least recently used entries are dropped. Entries bigger than the whole
+    cache are not stored. If ``ttl`` is set, entries also expire that many
+    seconds after being added. This is safe to use from multiple threads.
+    """
+    def __init__(self, max_bytes, ttl=None):
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.size = 0
+        self._entries = collections.OrderedDict()  # key -> (expires, value)
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, key):
+        return self.get(key, touch=False) is not None
+
+    def get(self, key, touch=True):
+        """Get an entry, marking it as recently used.
+
+        :return: the bytes, or None if the key is not in the cache
+        """
+        with self._lock:
+            try:
+                expires, value = self._entries[key]
+            except KeyError:
+                return None
+            if expires is not None and expires <= time.monotonic():
+                del self._entries[key]
+                self.size -= len(value)
+                return None
+            if touch:
+                self._entries.move_to_end(key)
+            return value
+
+    def put(self, key, value):
+        """Add or replace an entry, dropping old entries to make room.
+        """
+        expires = None
+        if self.ttl is not None:
+            expires = time.monotonic() + self.ttl
+        with self._lock:
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self.size -= len(old[1])
+            if len(value) > self.max_bytes:
+                return
+            while self._entries and self.size + len(value) > self.max_bytes:
+                _, (_, dropped) = self._entries.popitem(last=False)
+                self.size -= len(dropped)
+            self._entries[key] = expires, value
+            self.size += len(value)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.size = 0
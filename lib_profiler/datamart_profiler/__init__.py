@@ -1,14 +1,28 @@
+import collections
+import concurrent.futures
 import contextlib
+import copy
+import csv
+import hashlib
+import io
+import itertools
 import logging
 import math
 import numpy
 import os
 import pandas
-import random
-from sklearn.cluster import KMeans
+import time
+import tracemalloc
 
-from .profile_types import identify_types
-from . import types
+from .profile_types import _identify_types, identify_types, parse_numbers
+from .readers import read_csv
+from .streaming import read_streaming
+from . import lazo, types
+
+try:
+    from multiprocessing import shared_memory
+except ImportError:  # Python < 3.8
+    shared_memory = None
 
 
 __version__ = '0.5.5'
@@ -21,6 +35,10 @@ MAX_SIZE = 50000000  # 50 MB
 
 N_RANGES = 3
 
+KMEANS1D_MAX_ITER = 100
+
+MAX_SPATIAL_CLUSTERING_POINTS = 100000
+
 RANDOM_SEED = 89
 
 SPATIAL_RANGE_DELTA_LONG = 0.0001
@@ -28,8 +46,16 @@ SPATIAL_RANGE_DELTA_LAT = 0.0001
 
 SAMPLE_ROWS = 20
 
+SAMPLE_BLOCK_SIZE = 65536  # 64 kB
+
+SAMPLE_CHUNK_ROWS = 100000
+
+# Optional parts of the profile, that can be left out with `features`
+FEATURES = frozenset(['coverage', 'spatial_coverage', 'lazo', 'sample'])
+
 
 BUCKETS = [0.5, 1.0, 5.0, 10.0, 20.0, 30.0, 60.0, 120.0, 300.0, 600.0]
+MEMORY_BUCKETS = [1e6, 1e7, 5e7, 1e8, 5e8, 1e9, 2e9, 4e9, 8e9]
 
 try:
     import prometheus_client
@@ -52,9 +78,18 @@ except ImportError:
         def __exit__(self, exc_type, exc_val, exc_tb):
             pass
 
+        def labels(self, *args, **kwargs):
+            return self
+
+        def observe(self, amount):
+            pass
+
     PROM_PROFILE = FakeMetric()
     PROM_TYPES = FakeMetric()
     PROM_SPATIAL = FakeMetric()
+    PROM_STAGE_TIME = FakeMetric()
+    PROM_STAGE_CPU = FakeMetric()
+    PROM_STAGE_MEMORY = FakeMetric()
 else:
     logger.info("prometheus_client present, enabling metrics")
 
@@ -67,56 +102,241 @@ else:
     PROM_SPATIAL = prometheus_client.Histogram('profile_spatial_seconds',
                                                "Profile spatial coverage time",
                                                buckets=BUCKETS)
+    PROM_STAGE_TIME = prometheus_client.Histogram(
+        'profile_stage_seconds',
+        "Profile time per stage",
+        ['stage'],
+        buckets=BUCKETS,
+    )
+    PROM_STAGE_CPU = prometheus_client.Histogram(
+        'profile_stage_cpu_seconds',
+        "Profile CPU time per stage",
+        ['stage'],
+        buckets=BUCKETS,
+    )
+    PROM_STAGE_MEMORY = prometheus_client.Histogram(
+        'profile_stage_memory_bytes',
+        "Profile peak memory allocated per stage (only in debug mode)",
+        ['stage'],
+        buckets=MEMORY_BUCKETS,
+    )
+
+
+class _Stages(object):
+    """Records the wall time, CPU time, and memory used by profiling stages.
+
+    Memory is only measured if `trace_memory` is set, using tracemalloc
+    (which makes allocations slower). It is the peak of memory allocated
+    during the stage, or the memory still allocated at the end of the stage
+    on Python < 3.9.
+    """
+    def __init__(self, trace_memory=False, report_metrics=True):
+        self.trace_memory = trace_memory
+        self.report_metrics = report_metrics
+        self.stages = {}
+        self.columns = []
+        self._peaks = []  # Peak memory seen by each running stage
+
+    @contextlib.contextmanager
+    def tracing(self):
+        """Trace memory allocations in this block, if `trace_memory` is set.
+        """
+        if self.trace_memory and not tracemalloc.is_tracing():
+            tracemalloc.start()
+            try:
+                yield
+            finally:
+                tracemalloc.stop()
+        else:
+            yield
+
+    def _update_peaks(self):
+        current, peak = tracemalloc.get_traced_memory()
+        if hasattr(tracemalloc, 'reset_peak'):
+            # Propagate peak to the running stages, then start afresh
+            self._peaks = [max(p, peak) for p in self._peaks]
+            tracemalloc.reset_peak()
+        else:
+            self._peaks = [max(p, current) for p in self._peaks]
+        return current
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        """Record a stage, wrapping the code in a with block.
+        """
+        trace = self.trace_memory and tracemalloc.is_tracing()
+        if trace:
+            memory_start = self._update_peaks()
+            self._peaks.append(memory_start)
+        wall_start = time.perf_counter()
+        cpu_start = time.process_time()
+        try:
+            yield
+        finally:
+            record = {
+                'wall_time': time.perf_counter() - wall_start,
+                'cpu_time': time.process_time() - cpu_start,
+            }
+            if trace:
+                self._update_peaks()
+                record['memory'] = self._peaks.pop() - memory_start
+            self.stages[name] = record
+            if self.report_metrics:
+                _report_stage(name, record)
+
+    def add_column(self, name, stages):
+        """Add the stages of a column, recorded by `_process_column()`.
+        """
+        self.columns.append({'name': name, 'stages': stages})
+        if self.report_metrics:
+            for stage, record in stages.items():
+                _report_stage('column_' + stage, record)
+
+    def report(self):
+        return {'stages': self.stages, 'columns': self.columns}
+
+
+def _report_stage(name, record):
+    PROM_STAGE_TIME.labels(name).observe(record['wall_time'])
+    PROM_STAGE_CPU.labels(name).observe(record['cpu_time'])
+    if 'memory' in record:
+        PROM_STAGE_MEMORY.labels(name).observe(record['memory'])
 
 
 def mean_stddev(array):
-    total = 0
-    for elem in array:
-        if elem is not None:
-            total += elem
-    mean = total / len(array)if len(array) > 0 else 0
-    total = 0
-    for elem in array:
-        if elem is not None:
-            elem = elem - mean
-            total += elem * elem
-    stddev = math.sqrt(total / len(array)) if len(array) > 0 else 0
-
-    return mean, stddev
-
-
-def get_numerical_ranges(values):
+    """Compute the mean and standard deviation of an array.
+
+    Missing values (NaN or None) are left out of the sums, but are still
+    counted in the number of values.
+    """
+    array = numpy.asarray(array, dtype=numpy.float64)
+    if len(array) == 0:
+        return 0, 0
+    mean = numpy.nansum(array) / len(array)
+    stddev = math.sqrt(numpy.nansum((array - mean) ** 2) / len(array))
+
+    return float(mean), stddev
+
+
+def _kmeans_clusters(values):
+    """Cluster values using K-Means.
+
+    :return: list of the clusters' sorted values
+    """
+    # Imported here, scikit-learn is slow to import
+    from sklearn.cluster import KMeans
+
+    clustering = KMeans(n_clusters=min(N_RANGES, len(values)),
+                        random_state=0)
+    clustering.fit(values.reshape(-1, 1))
+    logger.info("K-Means clusters: %r", clustering.cluster_centers_)
+
+    return [numpy.sort(values[clustering.labels_ == rg])
+            for rg in range(N_RANGES)]
+
+
+def _kmeans1d_clusters(values):
+    """Cluster values using K-Means, taking advantage of the single dimension.
+
+    Once the values are sorted, clusters are contiguous slices, delimited by
+    the midpoints between centers. Each iteration of Lloyd's algorithm is
+    then only a binary search and a lookup into the cumulative sums, so the
+    whole thing costs about as much as sorting.
+
+    Two initializations are tried (centers at the quantiles, and clusters
+    split at the largest gaps), keeping the one with the lowest inertia.
+
+    :return: list of the clusters' sorted values
+    """
+    values = numpy.sort(values)
+    nb_values = len(values)
+    # Center the values, to limit loss of precision in the sums of squares
+    centered = values - values[nb_values // 2]
+    cumsum = numpy.concatenate([[0.0], numpy.cumsum(centered)])
+    cumsum_sq = numpy.concatenate([[0.0], numpy.cumsum(centered ** 2)])
+
+    def cluster(centers):
+        centers = numpy.unique(centers)
+        for _ in range(KMEANS1D_MAX_ITER):
+            midpoints = (centers[1:] + centers[:-1]) / 2
+            bounds = numpy.concatenate([
+                [0],
+                numpy.searchsorted(centered, midpoints, side='right'),
+                [nb_values],
+            ])
+            bounds = numpy.unique(bounds)  # Drop empty clusters
+            sizes = numpy.diff(bounds)
+            sums = cumsum[bounds[1:]] - cumsum[bounds[:-1]]
+            new_centers = sums / sizes
+            if numpy.array_equal(new_centers, centers):
+                break
+            centers = new_centers
+        sums_sq = cumsum_sq[bounds[1:]] - cumsum_sq[bounds[:-1]]
+        inertia = numpy.sum(sums_sq - sums * sums / sizes)
+        return inertia, bounds
+
+    # Initialize from quantiles
+    quantiles = (numpy.arange(N_RANGES) + 0.5) / N_RANGES
+    init_quantiles = centered[(quantiles * nb_values).astype(int)]
+
+    # Initialize from largest gaps
+    gaps = numpy.diff(centered)
+    nb_splits = min(N_RANGES - 1, numpy.count_nonzero(gaps))
+    if nb_splits > 0:
+        splits = numpy.argpartition(gaps, -nb_splits)[-nb_splits:]
+        splits = numpy.sort(splits)
+    else:
+        splits = numpy.array([], dtype=int)
+    bounds = numpy.concatenate([[0], splits + 1, [nb_values]])
+    init_gaps = ((cumsum[bounds[1:]] - cumsum[bounds[:-1]]) /
+                 numpy.diff(bounds))
+
+    _, bounds = min(cluster(init_quantiles), cluster(init_gaps),
+                    key=lambda r: r[0])
+    return numpy.split(values, bounds[1:-1])
+
+
+RANGES_METHODS = {
+    'kmeans': _kmeans_clusters,
+    'kmeans1d': _kmeans1d_clusters,
+}
+
+
+def get_numerical_ranges(values, method='kmeans'):
     """
     Retrieve the numeral ranges given the input (timestamp, integer, or float).
 
-    This performs K-Means clustering, returning a maximum of 3 ranges.
+    This clusters the values, returning a maximum of 3 ranges.
+
+    :param values: the values, as a list or 1-D NumPy array
+    :param method: the clustering method, 'kmeans' (K-Means from
+        scikit-learn) or 'kmeans1d' (K-Means on sorted values, much faster
+        on big columns)
     """
 
-    if not values:
+    if len(values) == 0:
         return []
 
+    try:
+        clusters_func = RANGES_METHODS[method]
+    except KeyError:
+        raise ValueError("Unknown ranges method %r" % method)
+
     logger.info("Computing numerical ranges, %d values", len(values))
 
-    clustering = KMeans(n_clusters=min(N_RANGES, len(values)),
-                        random_state=0)
-    clustering.fit(numpy.array(values).reshape(-1, 1))
-    logger.info("K-Means clusters: %r", clustering.cluster_centers_)
+    clusters = clusters_func(numpy.asarray(values, dtype=numpy.float64))
 
     # Compute confidence intervals for each range
     ranges = []
     sizes = []
-    for rg in range(N_RANGES):
-        cluster = [values[i]
-                   for i in range(len(values))
-                   if clustering.labels_[i] == rg]
-        if not cluster:
+    for cluster in clusters:
+        if not len(cluster):
             continue
-        cluster.sort()
         min_idx = int(0.05 * len(cluster))
         max_idx = int(0.95 * len(cluster))
         ranges.append([
-            cluster[min_idx],
-            cluster[max_idx],
+            float(cluster[min_idx]),
+            float(cluster[max_idx]),
         ])
         sizes.append(len(cluster))
     logger.info("Ranges: %r", ranges)
@@ -128,38 +348,53 @@ def get_numerical_ranges(values):
     return ranges
 
 
-def get_spatial_ranges(values):
+def get_spatial_ranges(values, max_clustering_points=None):
     """
     Retrieve the spatial ranges (i.e. bounding boxes) given the input gps points.
 
     This performs K-Means clustering, returning a maximum of 3 ranges.
+
+    :param values: the points as (latitude, longitude) pairs, as a list or an
+        (n, 2) NumPy array
+    :param max_clustering_points: If there are more points than this, fit the
+        clustering on a random subsample of that size. The bounding boxes are
+        still computed over all the points.
     """
 
+    # Imported here, scikit-learn is slow to import
+    from sklearn.cluster import KMeans
+
+    values = numpy.asarray(values, dtype=numpy.float64)
+    if max_clustering_points is None:
+        max_clustering_points = MAX_SPATIAL_CLUSTERING_POINTS
+
     clustering = KMeans(n_clusters=min(N_RANGES, len(values)),
                         random_state=0)
-    clustering.fit(values)
+    if len(values) > max_clustering_points:
+        rand = numpy.random.RandomState(RANDOM_SEED)
+        choose = rand.choice(len(values), max_clustering_points,
+                             replace=False)
+        clustering.fit(values[choose])
+        labels = clustering.predict(values)
+    else:
+        clustering.fit(values)
+        labels = clustering.labels_
     logger.info("K-Means clusters: %r", clustering.cluster_centers_)
 
     # Compute confidence intervals for each range
     ranges = []
     sizes = []
     for rg in range(N_RANGES):
-        cluster = [values[i]
-                   for i in range(len(values))
-                   if clustering.labels_[i] == rg]
-        if not cluster:
+        cluster = values[labels == rg]
+        if not len(cluster):
             continue
-        cluster.sort(key=lambda p: p[0])
         min_idx = int(0.05 * len(cluster))
         max_idx = int(0.95 * len(cluster))
-        min_lat = cluster[min_idx][0]
-        max_lat = cluster[max_idx][0]
-        cluster.sort(key=lambda p: p[1])
-        min_long = cluster[min_idx][1]
-        max_long = cluster[max_idx][1]
+        lat = numpy.partition(cluster[:, 0], [min_idx, max_idx])
+        long = numpy.partition(cluster[:, 1], [min_idx, max_idx])
         ranges.append([
-            [min_long, max_lat],
-            [max_long, min_lat],
+            [float(long[min_idx]), float(lat[max_idx])],
+            [float(long[max_idx]), float(lat[min_idx])],
         ])
         sizes.append(len(cluster))
     logger.info("Ranges: %r", ranges)
@@ -235,10 +470,567 @@ def truncate_string(s, limit=140):
             return s[:space] + "..."
 
 
+def _process_column(array, column_meta, coverage, ranges_method,
+                    trace_memory=False, accumulator=None):
+    """Profile a single column.
+
+    This is the part of `process_dataset()` that is independent for each
+    column. `column_meta` is updated in place.
+
+    If an `accumulator` is given (streaming mode), types and statistics come
+    from it, and `array` is only a sample used to compute ranges.
+
+    :return: (column_meta, latlong, textual, stages) where latlong is either
+        None or a pair (``types.LATITUDE`` or ``types.LONGITUDE``, numerical
+        values), textual is True if the column should be indexed by Lazo, and
+        stages are the measurements from `_Stages`
+    """
+    latlong = None
+    stages = _Stages(trace_memory, report_metrics=False)
+
+    with stages.tracing():
+        # Identify types
+        with stages.stage('identify_types'):
+            if accumulator is None:
+                (structural_type, semantic_types_dict, additional_meta,
+                 latlong_values) = _identify_types(array, column_meta['name'])
+            else:
+                (structural_type, semantic_types_dict, additional_meta,
+                 latlong_values) = accumulator.identify_types(array)
+        # Set structural type
+        column_meta['structural_type'] = structural_type
+        # Add semantic types to the ones already present
+        sem_types = column_meta.setdefault('semantic_types', [])
+        for sem_type in semantic_types_dict:
+            if sem_type not in sem_types:
+                sem_types.append(sem_type)
+        # Insert additional metadata
+        column_meta.update(additional_meta)
+
+        # Compute ranges for numerical/spatial data
+        if structural_type in (types.INTEGER, types.FLOAT):
+            with stages.stage('numerical'):
+                # Get numerical values, parsed by _identify_types() if it
+                # found lat/long, NaN for missing values
+                if latlong_values is not None:
+                    numerical_values = latlong_values
+                else:
+                    numerical_values = parse_numbers(array)
+                # Overflows in ES
+                numerical_values[
+                    ~(numpy.abs(numerical_values) < 3.4e38)
+                ] = numpy.nan
+
+                if accumulator is None:
+                    column_meta['mean'], column_meta['stddev'] = \
+                        mean_stddev(numerical_values)
+                else:
+                    column_meta['mean'], column_meta['stddev'] = \
+                        accumulator.numbers.mean_stddev()
+
+            # Get lat/long columns
+            if types.LATITUDE in semantic_types_dict:
+                latlong = types.LATITUDE, numerical_values
+            elif types.LONGITUDE in semantic_types_dict:
+                latlong = types.LONGITUDE, numerical_values
+            elif coverage:
+                with stages.stage('numerical_ranges'):
+                    ranges = get_numerical_ranges(
+                        numerical_values[~numpy.isnan(numerical_values)],
+                        method=ranges_method,
+                    )
+                if ranges:
+                    column_meta['coverage'] = ranges
+
+        # Compute ranges for temporal data
+        if coverage and types.DATE_TIME in semantic_types_dict:
+            with stages.stage('temporal_ranges'):
+                timestamps = numpy.empty(
+                    len(semantic_types_dict[types.DATE_TIME]),
+                    dtype='float32',
+                )
+                timestamps_for_range = []
+                for j, dt in enumerate(
+                        semantic_types_dict[types.DATE_TIME]):
+                    timestamps[j] = dt.timestamp()
+                    timestamps_for_range.append(
+                        dt.replace(minute=0, second=0).timestamp()
+                    )
+                if accumulator is None:
+                    column_meta['mean'], column_meta['stddev'] = \
+                        mean_stddev(timestamps)
+                else:
+                    column_meta['mean'], column_meta['stddev'] = \
+                        accumulator.dates.mean_stddev()
+
+                # Get temporal ranges
+                ranges = get_numerical_ranges(timestamps_for_range,
+                                              method=ranges_method)
+            if ranges:
+                column_meta['coverage'] = ranges
+
+    textual = (structural_type == types.TEXT and
+               types.DATE_TIME not in semantic_types_dict)
+
+    return column_meta, latlong, textual, stages.stages
+
+
+def column_fingerprint(array, name, coverage=True, ranges_method='kmeans'):
+    """Compute a fingerprint of a column's content.
+
+    It also covers the column name, the profiler version, and the options
+    that change the result, so if two fingerprints are equal, profiling the
+    columns gives the same metadata.
+
+    :param array: the column's values, as strings
+    :return: hexadecimal string
+    """
+    hasher = hashlib.sha1()
+    hasher.update(repr((
+        __version__, name, bool(coverage), ranges_method,
+    )).encode('utf-8'))
+    hashes = pandas.util.hash_pandas_object(
+        pandas.Series(array, dtype=object),
+        index=False,
+    )
+    hasher.update(hashes.values.tobytes())
+    return hasher.hexdigest()
+
+
+def _match_previous_columns(column_fingerprints, previous_metadata):
+    """Find the columns that were already profiled, from their fingerprint.
+
+    :return: dict mapping the index of the column to its metadata from the
+        previous profile
+    """
+    previous_fingerprints = previous_metadata.get('column_fingerprints')
+    previous_columns = previous_metadata.get('columns')
+    if (
+        not previous_fingerprints or
+        len(previous_fingerprints) != len(previous_columns)
+    ):
+        return {}
+    previous = dict(zip(previous_fingerprints, previous_columns))
+    return {
+        i: previous[fingerprint]
+        for i, fingerprint in enumerate(column_fingerprints)
+        if fingerprint in previous
+    }
+
+
+def _reuse_column(array, column_meta, previous_column):
+    """Use the metadata of an unchanged column from a previous profile.
+
+    This returns the same thing as `_process_column()`. Numerical values are
+    still parsed for lat/long columns, since spatial coverage depends on
+    pairs of columns. The column is not reported as textual, as it is
+    already indexed by Lazo.
+    """
+    sem_types = column_meta.setdefault('semantic_types', [])
+    for key, value in previous_column.items():
+        if key == 'semantic_types':
+            for sem_type in value:
+                if sem_type not in sem_types:
+                    sem_types.append(sem_type)
+        else:
+            column_meta[key] = copy.deepcopy(value)
+
+    latlong = None
+    if column_meta['structural_type'] in (types.INTEGER, types.FLOAT):
+        for kind in (types.LATITUDE, types.LONGITUDE):
+            if kind in sem_types:
+                numerical_values = parse_numbers(array)
+                numerical_values[
+                    ~(numpy.abs(numerical_values) < 3.4e38)
+                ] = numpy.nan
+                latlong = kind, numerical_values
+                break
+
+    return column_meta, latlong, False, {}
+
+
+def _share_column(array):
+    """Copy the values of a column into shared memory.
+
+    The memory holds the offsets of the values (int64), followed by the
+    UTF-8-encoded values.
+    """
+    encoded = [value.encode('utf-8') for value in array]
+    offsets = numpy.zeros(len(encoded) + 1, dtype=numpy.int64)
+    numpy.cumsum([len(value) for value in encoded], out=offsets[1:])
+    header_size = offsets.nbytes
+    shm = shared_memory.SharedMemory(
+        create=True,
+        size=max(1, header_size + int(offsets[-1])),
+    )
+    shm.buf[:header_size] = offsets.tobytes()
+    # Copy the values one by one, rather than joining them in another copy
+    pos = header_size
+    for value in encoded:
+        shm.buf[pos:pos + len(value)] = value
+        pos += len(value)
+    return shm
+
+
+def _read_shared_column(name, length):
+    """Read back a column that was put into shared memory.
+
+    The values are decoded straight from the shared memory, without copying
+    it first.
+    """
+    shm = shared_memory.SharedMemory(name=name)
+    try:
+        header_size = 8 * (length + 1)
+        offsets_array = numpy.frombuffer(shm.buf, dtype=numpy.int64,
+                                         count=length + 1)
+        offsets = offsets_array.tolist()
+        # Release our view of the memory, so it can be closed
+        del offsets_array
+        with shm.buf[header_size:] as payload:
+            values = [
+                str(payload[offsets[i]:offsets[i + 1]], 'utf-8')
+                for i in range(length)
+            ]
+    finally:
+        shm.close()
+    return pandas.Series(values, dtype=object)
+
+
+def _process_column_worker(column, column_meta, coverage, ranges_method,
+                           trace_memory, accumulator):
+    """Entrypoint for `_process_column()` in a worker process.
+
+    :param column: either the values of the column, or a tuple (name of the
+        shared memory, number of values)
+    """
+    if isinstance(column, tuple):
+        array = _read_shared_column(*column)
+    else:
+        array = pandas.Series(column, dtype=object)
+    return _process_column(array, column_meta, coverage, ranges_method,
+                           trace_memory, accumulator)
+
+
+def _process_columns_parallel(data, columns, indices, coverage,
+                              ranges_method, max_workers, trace_memory,
+                              accumulators):
+    """Run `_process_column()` for some columns, using a process pool.
+
+    The columns are handed to the workers through shared memory if available
+    (Python 3.8+). Only `max_workers` columns are submitted at a time, so
+    that only those are copied into shared memory.
+
+    :param indices: indices of the columns to process
+    :param accumulators: accumulators from streaming mode, or None
+    :return: list of the results of `_process_column()`, in order
+    """
+    logger.info("Processing columns with %d workers", max_workers)
+
+    def submit(i):
+        array = data.iloc[:, i]
+        shm = None
+        if shared_memory is not None:
+            shm = _share_column(array)
+            column = shm.name, len(array)
+        else:
+            column = array.values.tolist()
+        try:
+            future = executor.submit(
+                _process_column_worker,
+                column, columns[i], coverage, ranges_method, trace_memory,
+                accumulators[i] if accumulators else None,
+            )
+        except BaseException:
+            if shm is not None:
+                free(shm)
+            raise
+        return future, shm
+
+    def free(shm):
+        shm.close()
+        shm.unlink()
+
+    with concurrent.futures.ProcessPoolExecutor(
+        max_workers=max_workers,
+    ) as executor:
+        to_submit = iter(indices)
+        pending = collections.deque()
+        try:
+            for i in itertools.islice(to_submit, max_workers):
+                pending.append(submit(i))
+            results = []
+            while pending:
+                future, shm = pending[0]
+                try:
+                    results.append(future.result())
+                finally:
+                    pending.popleft()
+                    if shm is not None:
+                        free(shm)
+                i = next(to_submit, None)
+                if i is not None:
+                    pending.append(submit(i))
+            return results
+        finally:
+            for future, shm in pending:
+                future.cancel()
+            # Wait for the workers before freeing their memory
+            executor.shutdown(wait=True)
+            for future, shm in pending:
+                if shm is not None:
+                    free(shm)
+
+
+def _record_ends(block, in_quotes, newline, quote):
+    """Find where the CSV records end in a block, from a given quoting state.
+
+    :return: list of offsets just after each newline that ends a record
+    """
+    ends = []
+    pos = 0
+    next_quote = block.find(quote)
+    while True:
+        if in_quotes:
+            # Skip to the closing quote (an escaped quote closes and re-opens)
+            pos = block.find(quote, pos)
+            if pos == -1:
+                break
+            pos += 1
+            in_quotes = False
+        else:
+            next_newline = block.find(newline, pos)
+            if next_newline == -1:
+                break
+            if next_quote != -1 and next_quote < pos:
+                next_quote = block.find(quote, pos)
+            if next_quote != -1 and next_quote < next_newline:
+                pos = next_quote + 1
+                in_quotes = True
+            else:
+                pos = next_newline + 1
+                ends.append(pos)
+    return ends
+
+
+def _count_records(text, nb_columns):
+    """Parse CSV records, to check that they are consistent with the header.
+
+    :return: the number of records with exactly `nb_columns` fields, or None
+        if the text is not valid or has a record with too many fields
+    """
+    exact = 0
+    try:
+        for row in csv.reader(io.StringIO(text, newline=''), strict=True):
+            if len(row) > nb_columns:
+                return None
+            elif len(row) == nb_columns:
+                exact += 1
+    except csv.Error:
+        return None
+    return exact
+
+
+def _align_block(block, nb_columns, newline, quote, at_eof=False):
+    """Re-align a block read at a random offset on complete CSV records.
+
+    The block starts at the beginning of a line, which might be inside a
+    multi-line quoted value. Both cases are tried, and the one that parses
+    into records matching the header is kept.
+
+    :return: (start, end) offsets of the complete records in the block, or
+        None if the alignment can't be decided
+    """
+    candidates = []
+    for in_quotes in (False, True):
+        ends = _record_ends(block, in_quotes, newline, quote)
+        if in_quotes:
+            if not ends:
+                continue
+            # The first record started before this block
+            start = ends.pop(0)
+        else:
+            start = 0
+        last = ends[-1] if ends else start
+        if at_eof and last < len(block) and block.count(quote, last) % 2 == 0:
+            # Last record is complete even without a trailing newline
+            ends.append(len(block))
+        if not ends:
+            continue
+        records = block[start:ends[-1]]
+        if isinstance(records, bytes):
+            records = records.decode('utf-8', 'replace')
+        exact = _count_records(records, nb_columns)
+        if exact is not None:
+            candidates.append((exact, start, ends[-1]))
+    if len(candidates) == 1:
+        return candidates[0][1:]
+    elif len(candidates) == 2 and candidates[0][0] != candidates[1][0]:
+        return max(candidates)[1:]
+    else:
+        return None
+
+
+def _finish_record(fp, quote, max_size):
+    """Read the end of a record, when stopped in a multi-line quoted value.
+
+    :return: the lines up to the end of the record, or None if it doesn't end
+        in `max_size`
+    """
+    lines = []
+    size = 0
+    while size < max_size:
+        line = fp.readline()
+        if not line:
+            return None
+        lines.append(line)
+        size += len(line)
+        if line.count(quote) % 2 == 1:
+            return line[:0].join(lines)
+    return None
+
+
+def _read_sample_rows(fp, size, sample_size):
+    """Sample random rows from a CSV file, reading all of it in chunks.
+
+    This is slower than reading blocks, but doesn't depend on being able to
+    find where records start.
+
+    :return: (data, nb_rows) where data is a DataFrame of the sample and
+        nb_rows is the exact number of rows in the whole file
+    """
+    fp.seek(0, 0)
+    ratio = sample_size / size
+    rand = numpy.random.RandomState(RANDOM_SEED)
+    nb_rows = 0
+    chunks = []
+    for chunk in pandas.read_csv(fp, dtype=str, na_filter=False,
+                                 chunksize=SAMPLE_CHUNK_ROWS):
+        nb_rows += chunk.shape[0]
+        chunks.append(chunk[rand.random_sample(chunk.shape[0]) < ratio])
+    data = pandas.concat(chunks, ignore_index=True)
+    logger.info("Sampled %d rows from %d rows", data.shape[0], nb_rows)
+    return data, nb_rows
+
+
+def read_sample(fp, size, sample_size, reader='pandas'):
+    """Read a random sample of a CSV file, by reading random blocks from it.
+
+    The blocks are picked using `RANDOM_SEED` and re-aligned on records: each
+    block gets the records that start in it. Since a block might
+    start in the middle of a multi-line quoted value, the quoting state at
+    its start is found by checking which one parses into records matching the
+    header, see `_align_block()`. Blocks where this can't be decided are
+    dropped; if all of them are, the rows are sampled from a full pass over
+    the file instead.
+
+    :param fp: file object, which has to be seekable. Text-mode files are
+        read from their underlying binary buffer if they have one, otherwise
+        (e.g. `io.StringIO`) sizes and offsets are in characters
+    :param size: size of the file in bytes
+    :param sample_size: target number of bytes to read
+    :param reader: how to parse the sampled lines, see `readers.read_csv()`
+    :return: (data, nb_rows) where data is a DataFrame of the sample and
+        nb_rows is the estimated number of rows in the whole file
+    """
+    if isinstance(fp, io.TextIOWrapper):
+        # Text files can't be seeked to arbitrary offsets, use the bytes
+        fp = fp.buffer
+    fp.seek(0, 0)
+    header = fp.readline()
+    if isinstance(header, str):
+        empty, newline, quote = '', '\n', '"'
+    else:
+        empty, newline, quote = b'', b'\n', b'"'
+    # The header might have multi-line quoted values too
+    while header.count(quote) % 2 == 1:
+        line = fp.readline()
+        if not line:
+            break
+        header += line
+    body_start = fp.tell()
+    body_size = size - body_start
+    if isinstance(header, bytes):
+        header_text = header.decode('utf-8', 'replace')
+    else:
+        header_text = header
+    nb_columns = len(next(csv.reader(io.StringIO(header_text, newline='')),
+                          []))
+
+    nb_blocks = max(1, -(-body_size // SAMPLE_BLOCK_SIZE))
+    nb_chosen = min(nb_blocks, max(1, sample_size // SAMPLE_BLOCK_SIZE))
+    rand = numpy.random.RandomState(RANDOM_SEED)
+    chosen = numpy.sort(rand.choice(nb_blocks, nb_chosen, replace=False))
+
+    def read_block(offset):
+        # Skip to the first line starting at or after the offset
+        fp.seek(offset - 1, 0)
+        fp.readline()
+        pos = fp.tell()
+        end = offset + SAMPLE_BLOCK_SIZE
+        if pos >= end:
+            return empty, False
+        block = fp.read(end - pos)
+        # Finish the last line
+        if block and not block.endswith(newline):
+            block += fp.readline()
+        return block, not block.endswith(newline)
+
+    blocks = []
+    sampled_size = 0
+    nb_dropped = 0
+    for block_idx in chosen:
+        block, at_eof = read_block(
+            body_start + int(block_idx) * SAMPLE_BLOCK_SIZE,
+        )
+        if not block:
+            continue
+        # Dropped blocks still count for the estimate: they are mostly in the
+        # middle of values too long to have a record start in them
+        sampled_size += len(block)
+        aligned = _align_block(block, nb_columns, newline, quote, at_eof)
+        if aligned is None:
+            nb_dropped += 1
+            continue
+        start, end = aligned
+        if end < len(block):
+            # Finish the last record, which starts in this block
+            rest = _finish_record(fp, quote, sample_size)
+            if rest is not None:
+                block += rest
+                end = len(block)
+        blocks.append(block[start:end])
+    if nb_dropped:
+        logger.info("Dropped %d sampled blocks that couldn't be aligned",
+                    nb_dropped)
+    if nb_dropped and not blocks:
+        logger.warning("All sampled blocks were dropped, sampling from the "
+                       "whole file")
+        return _read_sample_rows(fp, size, sample_size)
+
+    if blocks and not blocks[-1].endswith(newline):
+        blocks[-1] += newline
+    sample = header + empty.join(blocks)
+    if isinstance(sample, str):
+        sample = sample.encode('utf-8')
+    data = read_csv(io.BytesIO(sample), reader)
+
+    if sampled_size == 0:
+        nb_rows = 0
+    else:
+        nb_rows = int(round(data.shape[0] * body_size / sampled_size))
+    logger.info("Sampled %d rows from %d bytes, estimated %d rows",
+                data.shape[0], sampled_size, nb_rows)
+    return data, nb_rows
+
+
 @PROM_PROFILE.time()
 def process_dataset(data, dataset_id=None, metadata=None,
                     lazo_client=None, search=False,
-                    coverage=True, sample_size=None):
+                    coverage=True, sample_size=None,
+                    ranges_method='kmeans', max_workers=None,
+                    debug=False, fingerprints=False,
+                    previous_metadata=None, streaming=False,
+                    reader='pandas', profile_columns=None, features=None):
     """Compute all metafeatures from a dataset.
 
     :param data: path to dataset, or file object, or DataFrame
@@ -249,9 +1041,66 @@ def process_dataset(data, dataset_id=None, metadata=None,
     :param search: True if this method is being called during the search
         operation (and not for indexing).
     :param coverage: Whether to compute data ranges (using k-means)
+    :param ranges_method: How to compute numerical and temporal ranges, see
+        `get_numerical_ranges()`. Spatial ranges always use k-means.
     :param sample_size: Target sample size. The data will be randomly sampled
         if it is bigger. Defaults to `MAX_SIZE`, currently 50 MB.
+    :param max_workers: If more than 1, profile the columns in parallel with
+        that many processes. The results are the same.
+    :param debug: If True, add the wall time, CPU time, and memory used by
+        each stage and each column under a 'debug' key. Memory is traced
+        using tracemalloc, which slows down profiling.
+    :param fingerprints: If True, store a fingerprint of each column under
+        'column_fingerprints', see `column_fingerprint()`.
+    :param previous_metadata: The result of a previous profile of the same
+        dataset, made with ``fingerprints=True``. Columns that have the same
+        fingerprint are not profiled again, their metadata is copied, and they
+        are not sent to Lazo again.
+    :param streaming: If True, read the whole file in chunks, accumulating
+        statistics about all the rows in bounded memory, instead of loading a
+        sample (`sample_size` is ignored). Ranges, spatial coverage, and the
+        sample come from a random sample of rows. Not available for
+        DataFrames; fingerprints are not computed in this mode.
+    :param reader: How to parse the CSV file, 'pandas' or 'arrow' (which
+        reads with multiple threads, and needs pyarrow), see
+        `readers.read_csv()`. The results are the same. Streaming always uses
+        pandas.
+    :param profile_columns: Indices of the columns to profile. Other columns
+        only get their 'name' in the metadata, so column indices stay the
+        same. Defaults to all the columns.
+    :param features: Which optional parts of the profile to compute, a subset
+        of `FEATURES`: 'coverage' (ranges of the columns), 'spatial_coverage',
+        'lazo' (indexing or sketches), 'sample'. Defaults to all of them.
+        ``coverage=False`` leaves out both coverage features.
     """
+    if features is None:
+        features = FEATURES
+    else:
+        features = frozenset(features)
+        if not features <= FEATURES:
+            raise ValueError("Unknown features: %s" % ', '.join(
+                sorted(features - FEATURES)
+            ))
+    stages = _Stages(trace_memory=debug)
+    with stages.tracing():
+        metadata = _process_dataset(
+            data, dataset_id, metadata, lazo_client, search, coverage,
+            sample_size, ranges_method, max_workers, stages,
+            fingerprints, previous_metadata, streaming, reader,
+            profile_columns, features,
+        )
+    if debug:
+        metadata['debug'] = stages.report()
+    return metadata
+
+
+def _process_dataset(data, dataset_id, metadata, lazo_client, search,
+                     coverage, sample_size, ranges_method, max_workers,
+                     stages, fingerprints, previous_metadata, streaming,
+                     reader, profile_columns, features):
+    compute_spatial = coverage and 'spatial_coverage' in features
+    coverage = coverage and 'coverage' in features
+
     if not sample_size:
         sample_size = MAX_SIZE
 
@@ -259,11 +1108,13 @@ def process_dataset(data, dataset_id=None, metadata=None,
         metadata = {}
 
     data_path = None
+    accumulators = None
     if isinstance(data, pandas.DataFrame):
         metadata['nb_rows'] = len(data)
         # FIXME: no sampling here!
     else:
         with contextlib.ExitStack() as stack:
+            stack.enter_context(stages.stage('load'))
             if isinstance(data, (str, bytes)):
                 if not os.path.exists(data):
                     raise ValueError("data file does not exist")
@@ -285,30 +1136,32 @@ def process_dataset(data, dataset_id=None, metadata=None,
                 raise TypeError("data should be a filename, a file object, or "
                                 "a pandas.DataFrame")
 
+            if streaming:
+                logger.info("Reading dataframe in chunks...")
+                accumulators, data, nb_rows = read_streaming(data,
+                                                             RANDOM_SEED)
+                metadata['nb_rows'] = nb_rows
             # Sub-sample
-            if metadata['size'] > sample_size:
-                logger.info("Counting rows...")
-                metadata['nb_rows'] = sum(1 for _ in data)
-                data.seek(0, 0)
-
-                ratio = sample_size / metadata['size']
-                logger.info("Loading dataframe, sample ratio=%r...", ratio)
-                rand = random.Random(RANDOM_SEED)
-                data = pandas.read_csv(
-                    data,
-                    dtype=str, na_filter=False,
-                    skiprows=lambda i: i != 0 and rand.random() > ratio)
+            elif metadata['size'] > sample_size:
+                logger.info("Loading dataframe, sampling %d bytes...",
+                            sample_size)
+                data, nb_rows = read_sample(data, metadata['size'],
+                                            sample_size, reader)
+                metadata['nb_rows'] = nb_rows
+                metadata['nb_rows_estimated'] = True
             else:
                 logger.info("Loading dataframe...")
-                data = pandas.read_csv(data,
-                                       dtype=str, na_filter=False)
+                data = read_csv(data, reader)
 
                 metadata['nb_rows'] = data.shape[0]
 
             logger.info("Dataframe loaded, %d rows, %d columns",
                         data.shape[0], data.shape[1])
 
-    metadata['nb_profiled_rows'] = data.shape[0]
+    if accumulators is not None:
+        metadata['nb_profiled_rows'] = metadata['nb_rows']
+    else:
+        metadata['nb_profiled_rows'] = data.shape[0]
 
     # Get column dictionary
     columns = metadata.setdefault('columns', [])
@@ -334,158 +1187,131 @@ def process_dataset(data, dataset_id=None, metadata=None,
     # Textual columns
     column_textual = []
 
-    # Identify types
-    logger.info("Identifying types, %d columns...", len(columns))
-    with PROM_TYPES.time():
-        for i, column_meta in enumerate(columns):
-            logger.info("Processing column %d...", i)
-            array = data.iloc[:, i]
-            # Identify types
-            structural_type, semantic_types_dict, additional_meta = \
-                identify_types(array, column_meta['name'])
-            # Set structural type
-            column_meta['structural_type'] = structural_type
-            # Add semantic types to the ones already present
-            sem_types = column_meta.setdefault('semantic_types', [])
-            for sem_type in semantic_types_dict:
-                if sem_type not in sem_types:
-                    sem_types.append(sem_type)
-            # Insert additional metadata
-            column_meta.update(additional_meta)
-
-            # Compute ranges for numerical/spatial data
-            if structural_type in (types.INTEGER, types.FLOAT):
-                # Get numerical ranges
-                numerical_values = []
-                for e in array:
-                    try:
-                        e = float(e)
-                    except ValueError:
-                        e = None
-                    else:
-                        if not (-3.4e38 < e < 3.4e38):  # Overflows in ES
-                            e = None
-                    numerical_values.append(e)
-
-                column_meta['mean'], column_meta['stddev'] = \
-                    mean_stddev(numerical_values)
-
-                # Get lat/long columns
-                if types.LATITUDE in semantic_types_dict:
-                    columns_lat.append(
-                        (column_meta['name'], numerical_values)
-                    )
-                elif types.LONGITUDE in semantic_types_dict:
-                    columns_long.append(
-                        (column_meta['name'], numerical_values)
-                    )
-                elif coverage:
-                    ranges = get_numerical_ranges(
-                        [x for x in numerical_values if x is not None]
-                    )
-                    if ranges:
-                        column_meta['coverage'] = ranges
+    # Columns to profile
+    if profile_columns is None:
+        profiled = range(len(columns))
+    else:
+        profiled = sorted(set(i for i in profile_columns
+                              if 0 <= i < len(columns)))
 
-            # Compute ranges for temporal data
-            if coverage and types.DATE_TIME in semantic_types_dict:
-                timestamps = numpy.empty(
-                    len(semantic_types_dict[types.DATE_TIME]),
-                    dtype='float32',
+    # Identify types
+    logger.info("Identifying types, %d/%d columns...",
+                len(profiled), len(columns))
+    with PROM_TYPES.time(), stages.stage('types'):
+        # Find the columns that haven't changed since the previous profile
+        reused = {}
+        if fingerprints and accumulators is None:
+            column_fingerprints = [
+                column_fingerprint(data.iloc[:, i], column_meta['name'],
+                                   coverage, ranges_method)
+                for i, column_meta in enumerate(columns)
+            ]
+            metadata['column_fingerprints'] = column_fingerprints
+            if previous_metadata:
+                reused = _match_previous_columns(column_fingerprints,
+                                                 previous_metadata)
+                logger.info("Re-using %d/%d columns from previous profile",
+                            len(reused), len(columns))
+
+        to_process = [i for i in profiled if i not in reused]
+        parallel = (max_workers is not None and max_workers > 1 and
+                    len(to_process) > 1)
+        if parallel:
+            parallel_results = iter(_process_columns_parallel(
+                data, columns, to_process,
+                coverage, ranges_method, max_workers, stages.trace_memory,
+                accumulators,
+            ))
+
+        for i in profiled:
+            column_meta = columns[i]
+            if i in reused:
+                result = _reuse_column(data.iloc[:, i], column_meta,
+                                       reused[i])
+            elif parallel:
+                result = next(parallel_results)
+            else:
+                result = _process_column(
+                    data.iloc[:, i], column_meta,
+                    coverage, ranges_method, stages.trace_memory,
+                    accumulators[i] if accumulators else None,
                 )
-                timestamps_for_range = []
-                for j, dt in enumerate(
-                        semantic_types_dict[types.DATE_TIME]):
-                    timestamps[j] = dt.timestamp()
-                    timestamps_for_range.append(
-                        dt.replace(minute=0, second=0).timestamp()
-                    )
-                column_meta['mean'], column_meta['stddev'] = \
-                    mean_stddev(timestamps)
-
-                # Get temporal ranges
-                ranges = get_numerical_ranges(timestamps_for_range)
-                if ranges:
-                    column_meta['coverage'] = ranges
-
-            if structural_type == types.TEXT and \
-                    types.DATE_TIME not in semantic_types_dict:
+            result_meta, latlong, textual, column_stages = result
+            if result_meta is not column_meta:
+                column_meta.update(result_meta)
+            stages.add_column(column_meta['name'], column_stages)
+            if latlong is not None:
+                kind, values = latlong
+                if kind == types.LATITUDE:
+                    columns_lat.append((column_meta['name'], values))
+                else:
+                    columns_long.append((column_meta['name'], values))
+            if textual:
                 column_textual.append(column_meta['name'])
 
     # Textual columns
-    if lazo_client and column_textual:
-        # Indexing with lazo
-        if not search:
-            # TODO: Remove previous data from lazo
-            logger.info("Indexing textual data with Lazo...")
-            try:
-                if data_path:
-                    # if we have the path, send the path
-                    lazo_client.index_data_path(
-                        data_path,
+    if lazo_client and column_textual and 'lazo' in features:
+        with stages.stage('lazo'):
+            # Indexing with lazo
+            if not search:
+                # TODO: Remove previous data from lazo
+                logger.info("Indexing textual data with Lazo...")
+                try:
+                    # if we have the path, send the path, otherwise send the
+                    # data of all the columns concurrently
+                    lazo.index_columns(
+                        lazo_client,
+                        data,
                         dataset_id,
-                        column_textual
+                        column_textual,
+                        data_path=data_path,
                     )
-                else:
-                    # if path is not available, send the data instead
-                    for column_name in column_textual:
-                        lazo_client.index_data(
-                            data[column_name].values.tolist(),
-                            dataset_id,
-                            column_name
-                        )
-            except Exception:
-                logger.error('Error indexing textual attributes from %s', dataset_id)
-                raise
-        # Generating Lazo sketches for the search
-        else:
-            logger.info("Generating Lazo sketches...")
-            try:
-                if data_path:
-                    # if we have the path, send the path
-                    lazo_sketches = lazo_client.get_lazo_sketch_from_data_path(
-                        data_path,
-                        "",
-                        column_textual
+                except Exception:
+                    logger.error('Error indexing textual attributes from %s', dataset_id)
+                    raise
+            # Generating Lazo sketches for the search
+            else:
+                logger.info("Generating Lazo sketches...")
+                try:
+                    # if we have the path, send the path, otherwise send
+                    # the data of all the columns concurrently
+                    lazo_sketches = lazo.get_sketches(
+                        lazo_client,
+                        data,
+                        column_textual,
+                        data_path=data_path,
                     )
-                else:
-                    # if path is not available, send the data instead
-                    lazo_sketches = []
-                    for column_name in column_textual:
-                        lazo_sketches.append(
-                            lazo_client.get_lazo_sketch_from_data(
-                                data[column_name].values.tolist(),
-                                "",
-                                column_name
-                            )
-                        )
-                # saving sketches into metadata
-                metadata_lazo = []
-                for i in range(len(column_textual)):
-                    n_permutations, hash_values, cardinality =\
-                        lazo_sketches[i]
-                    metadata_lazo.append(dict(
-                        name=column_textual[i],
-                        n_permutations=n_permutations,
-                        hash_values=list(hash_values),
-                        cardinality=cardinality
-                    ))
-                metadata['lazo'] = metadata_lazo
-            except Exception:
-                logger.warning('Error getting Lazo sketches textual attributes from %s', dataset_id)
-                raise
+                    # saving sketches into metadata
+                    metadata_lazo = []
+                    for i in range(len(column_textual)):
+                        n_permutations, hash_values, cardinality =\
+                            lazo_sketches[i]
+                        metadata_lazo.append(dict(
+                            name=column_textual[i],
+                            n_permutations=n_permutations,
+                            hash_values=list(hash_values),
+                            cardinality=cardinality
+                        ))
+                    metadata['lazo'] = metadata_lazo
+                except Exception:
+                    logger.warning('Error getting Lazo sketches textual attributes from %s', dataset_id)
+                    raise
 
     # Lat / Lon
-    if coverage:
+    if compute_spatial:
         logger.info("Computing spatial coverage...")
-        with PROM_SPATIAL.time():
+        with PROM_SPATIAL.time(), stages.stage('spatial'):
             spatial_coverage = []
             pairs = pair_latlong_columns(columns_lat, columns_long)
             for (name_lat, values_lat), (name_long, values_long) in pairs:
-                values = []
-                for lat, long in zip(values_lat, values_long):
-                    if (lat and long and  # Ignore None and 0
-                            -90 < lat < 90 and -180 < long < 180):
-                        values.append((lat, long))
+                # Ignore missing values and 0
+                mask = ((values_lat != 0) & (values_long != 0) &
+                        (numpy.abs(values_lat) < 90) &
+                        (numpy.abs(values_long) < 180))
+                values = numpy.stack(
+                    [values_lat[mask], values_long[mask]],
+                    axis=1,
+                )
 
                 if len(values) > 1:
                     logger.info("Computing spatial ranges %r,%r (%d rows)",
@@ -500,16 +1326,18 @@ def process_dataset(data, dataset_id=None, metadata=None,
             metadata['spatial_coverage'] = spatial_coverage
 
     # Sample data
-    rand = numpy.random.RandomState(RANDOM_SEED)
-    choose_rows = rand.choice(
-        len(data),
-        min(SAMPLE_ROWS, len(data)),
-        replace=False,
-    )
-    choose_rows.sort()  # Keep it in order
-    sample = data.iloc[choose_rows]
-    sample = sample.applymap(truncate_string)  # Truncate long values
-    metadata['sample'] = sample.to_csv(index=False)
+    if 'sample' in features:
+        with stages.stage('sample'):
+            rand = numpy.random.RandomState(RANDOM_SEED)
+            choose_rows = rand.choice(
+                len(data),
+                min(SAMPLE_ROWS, len(data)),
+                replace=False,
+            )
+            choose_rows.sort()  # Keep it in order
+            sample = data.iloc[choose_rows]
+            sample = sample.applymap(truncate_string)  # Truncate long values
+            metadata['sample'] = sample.to_csv(index=False)
 
     # Return it -- it will be inserted into Elasticsearch, and published to the
     # feed and the waiting on-demand searches
@@ -0,0 +1,105 @@
+"""Operations on all the textual columns of a dataset with the Lazo server.
+
+The Lazo protocol only handles several columns in a single request when the
+server can read the file itself (``index_data_path()``,
+``get_lazo_sketch_from_data_path()``). Otherwise, there is one request per
+column; these functions send them concurrently (gRPC multiplexes them over
+the client's channel), so a dataset costs about one round-trip instead of one
+per column.
+"""
+
+import concurrent.futures
+import logging
+
+
+logger = logging.getLogger(__name__)
+
+
+# Maximum number of concurrent requests to the Lazo server
+LAZO_MAX_WORKERS = 8
+
+
+def _map_concurrently(func, items, max_workers):
+    """Call a function on each item using threads, return results in order.
+    """
+    if max_workers is None:
+        max_workers = LAZO_MAX_WORKERS
+    if len(items) <= 1 or max_workers <= 1:
+        return [func(item) for item in items]
+
+    with concurrent.futures.ThreadPoolExecutor(
+        max_workers=min(max_workers, len(items)),
+    ) as executor:
+        return list(executor.map(func, items))
+
+
+def index_columns(lazo_client, data, dataset_id, column_names,
+                  data_path=None, max_workers=None):
+    """Index columns of a dataset in Lazo.
+
+    :param data: the dataset as a DataFrame
+    :param data_path: path to the dataset, if it can be read by the server;
+        all the columns are then sent in a single request
+    :param max_workers: maximum number of concurrent requests, defaults to
+        `LAZO_MAX_WORKERS`
+    :return: list of ``(n_permutations, hash_values, cardinality)``, in the
+        order of ``column_names``
+    """
+    if data_path:
+        return lazo_client.index_data_path(data_path, dataset_id,
+                                           column_names)
+
+    def index(column_name):
+        return lazo_client.index_data(
+            data[column_name].values.tolist(),
+            dataset_id,
+            column_name,
+        )
+
+    return _map_concurrently(index, column_names, max_workers)
+
+
+def get_sketches(lazo_client, data, column_names,
+                 data_path=None, max_workers=None):
+    """Get Lazo sketches of columns, without indexing them.
+
+    :param data: the dataset as a DataFrame
+    :param data_path: path to the dataset, if it can be read by the server;
+        all the columns are then sent in a single request
+    :param max_workers: maximum number of concurrent requests, defaults to
+        `LAZO_MAX_WORKERS`
+    :return: list of ``(n_permutations, hash_values, cardinality)``, in the
+        order of ``column_names``
+    """
+    if data_path:
+        return lazo_client.get_lazo_sketch_from_data_path(data_path, "",
+                                                          column_names)
+
+    def get_sketch(column_name):
+        return lazo_client.get_lazo_sketch_from_data(
+            data[column_name].values.tolist(),
+            "",
+            column_name,
+        )
+
+    return _map_concurrently(get_sketch, column_names, max_workers)
+
+
+def query_sketches(lazo_client, sketches, max_workers=None):
+    """Query the Lazo index with several sketches.
+
+    :param sketches: list of ``(n_permutations, hash_values, cardinality)``
+    :param max_workers: maximum number of concurrent requests, defaults to
+        `LAZO_MAX_WORKERS`
+    :return: list of query results, in the order of ``sketches``, each a
+        list of ``(dataset_id, column_name, max_threshold)``
+    """
+    def query(sketch):
+        n_permutations, hash_values, cardinality = sketch
+        return lazo_client.query_lazo_sketch_data(
+            n_permutations,
+            hash_values,
+            cardinality,
+        )
+
+    return _map_concurrently(query, sketches, max_workers)
@@ -1,8 +1,12 @@
 from datetime import datetime
 import dateutil.parser
 import dateutil.tz
+import itertools
+import numpy
+import pandas
 import re
 
+from .sketches import HyperLogLog
 from . import types
 
 
@@ -24,6 +28,32 @@ _re_phone = re.compile(r'^'
                        r'$')
 _re_whitespace = re.compile(r'\s')
 
+_bool_values = ('0', '1', 'true', 'false', 'y', 'n', 'yes', 'no')
+
+# Every capitalization of the boolean values, so checking doesn't need lower()
+_bool_cells = frozenset(
+    ''.join(chars)
+    for value in _bool_values
+    for chars in itertools.product(*[(c.lower(), c.upper()) for c in value])
+)
+
+# Kind of a value in a single match: integer, float, or text (4 or more
+# whitespace characters), in groups 1, 2, 3 in that order of priority
+_re_kind = re.compile(r'(?:'
+                      r'(' + _re_int.pattern + r')|'
+                      r'(' + _re_float.pattern + r')|'
+                      r'((?:\S*\s){4})'
+                      r')?')
+
+
+# Codes returned by `classify_cells()`
+CELL_INT = 1
+CELL_FLOAT = 2
+CELL_TEXT = 3
+CELL_KIND = 3  # Mask for the kind of value
+CELL_BOOL = 4
+CELL_PHONE = 8
+
 
 # Tolerable ratio of unclean data
 MAX_UNCLEAN = 0.02  # 2%
@@ -33,6 +63,59 @@ MAX_UNCLEAN = 0.02  # 2%
 MAX_CATEGORICAL_RATIO = 0.10  # 10%
 
 
+# Number of values looked at to decide whether to de-duplicate a column
+DEDUP_PREFIX = 1000
+
+# Ratio of distinct values over which we don't de-duplicate before
+# classifying, since it would cost more than it saves
+MAX_DEDUP_RATIO = 0.5  # 50%
+
+
+# Number of standard errors by which the estimated number of distinct values
+# has to exceed the categorical threshold for the exact count to be skipped
+CATEGORICAL_ESTIMATE_MARGIN = 3
+
+
+# Progressive checks: the phone number and date checks first look at a random
+# sample of this many values, growing it by PROGRESSIVE_GROWTH each time, and
+# stop as soon as it is clear that the column doesn't match
+PROGRESSIVE_SAMPLE = 1000
+PROGRESSIVE_GROWTH = 4
+
+# Width of the confidence interval used to stop, in standard deviations
+PROGRESSIVE_CONFIDENCE = 5.0
+
+# Seed used to pick the values checked first
+PROGRESSIVE_SEED = 89
+
+
+# Number of distinct values used to infer the date formats of a column
+DATE_FORMAT_PREFIX = 20
+
+
+# Formats that can be recognized from the first values of a column, and then
+# used to parse the rest of it at once. They all contain a full date
+_date_formats = [
+    '%Y-%m-%d',
+    '%Y-%m-%d %H:%M',
+    '%Y-%m-%d %H:%M:%S',
+    '%Y-%m-%d %H:%M:%S.%f',
+    '%Y-%m-%dT%H:%M',
+    '%Y-%m-%dT%H:%M:%S',
+    '%Y-%m-%dT%H:%M:%S.%f',
+    '%Y-%m-%dT%H:%M:%SZ',
+    '%Y-%m-%dT%H:%M:%S.%fZ',
+    '%Y/%m/%d',
+    '%Y/%m/%d %H:%M:%S',
+    '%m/%d/%Y',
+    '%m/%d/%Y %H:%M',
+    '%m/%d/%Y %H:%M:%S',
+    '%m/%d/%Y %I:%M:%S %p',
+    '%m/%d/%Y %I:%M %p',
+    '%Y%m%dT%H%M%SZ',
+]
+
+
 _defaults = datetime(1985, 1, 1), datetime(2005, 6, 15)
 
 
@@ -56,37 +139,365 @@ def parse_date(string):
         return dt1
 
 
+def _to_float(value):
+    try:
+        return float(value)
+    except ValueError:
+        return numpy.nan
+
+
+def parse_numbers(array):
+    """Convert a column to floats in a single pass.
+
+    Values that can't be parsed are NaN.
+
+    :return: a NumPy array of float64
+    """
+    array = numpy.asarray(array, dtype=object)
+    try:
+        return array.astype(numpy.float64)
+    except ValueError:
+        # Some values are not numbers, convert each distinct value once
+        codes, uniques = pandas.factorize(array)
+        floats = numpy.array([_to_float(v) for v in uniques],
+                             dtype=numpy.float64)
+        return floats[codes]
+
+
+def _infer_date_formats(values):
+    """Find the formats of the dates at the start of a column.
+
+    Only formats that give the same result as `parse_date()` are kept.
+
+    :return: list of formats, most common first
+    """
+    found = {}
+    for value in values[:DATE_FORMAT_PREFIX]:
+        expected = parse_date(value)
+        if expected is None:
+            continue
+        for fmt in _date_formats:
+            try:
+                dt = datetime.strptime(value, fmt)
+            except ValueError:
+                continue
+            if dt.replace(tzinfo=dateutil.tz.UTC) == expected:
+                found[fmt] = found.get(fmt, 0) + 1
+                break
+    return sorted(found, key=lambda fmt: -found[fmt])
+
+
+def parse_dates(array):
+    """Parse the dates in a column.
+
+    The formats are inferred from the first distinct values, and used to
+    parse the rest of the column at once. `parse_date()` is only called for
+    the values that don't match them.
+
+    :return: list of datetimes, for the values that are dates
+    """
+    if not isinstance(array, pandas.Series):
+        array = pandas.Series(array, dtype=object)
+    remaining = pandas.Series(array.unique(), dtype=object)
+    remaining = remaining[remaining != '']
+
+    parsed = {}
+    for fmt in _infer_date_formats(remaining):
+        dates = pandas.to_datetime(remaining, format=fmt, errors='coerce',
+                                   utc=True)
+        matches = dates.notna().values
+        # Only keep values that match the format exactly; the others will
+        # be tried with the next format, or with dateutil
+        if matches.any():
+            matches[matches] = (
+                dates[matches].dt.strftime(fmt) == remaining[matches]
+            ).values
+        for value, dt in zip(remaining[matches], dates[matches]):
+            parsed[value] = dt.to_pydatetime().replace(
+                tzinfo=dateutil.tz.UTC,
+            )
+        remaining = remaining[~matches]
+
+    # Fall back on dateutil for the rest
+    for value in remaining:
+        dt = parse_date(value)
+        if dt is not None:
+            parsed[value] = dt
+
+    return [parsed[elem] for elem in array if elem in parsed]
+
+
+def _distinct_values(array):
+    """De-duplicate the values of a column, if it is worth it.
+
+    :return: ``(values, counts)``, where ``counts`` holds the number of
+        occurrences of each entry in ``values``; if the column has too many
+        distinct values, ``counts`` is None and ``values`` is the whole column
+    """
+    if len(array) > DEDUP_PREFIX:
+        prefix = array.iloc[:DEDUP_PREFIX]
+        if prefix.nunique() > MAX_DEDUP_RATIO * DEDUP_PREFIX:
+            return array, None
+
+    value_counts = array.value_counts(sort=False)
+    return value_counts.index.to_series(), value_counts.values
+
+
+def _proportion_upper_bound(matches, total):
+    """Upper bound of the proportion of matching values in a column.
+
+    This is the upper end of the Wilson score interval (with a width of
+    `PROGRESSIVE_CONFIDENCE` standard deviations), from ``matches`` out of
+    ``total`` random values.
+    """
+    z2 = PROGRESSIVE_CONFIDENCE * PROGRESSIVE_CONFIDENCE
+    ratio = matches / total
+    center = ratio + z2 / (2 * total)
+    spread = PROGRESSIVE_CONFIDENCE * numpy.sqrt(
+        ratio * (1.0 - ratio) / total + z2 / (4 * total * total)
+    )
+    return (center + spread) / (1.0 + z2 / total)
+
+
+def _estimate_below(values, count_func, ratio):
+    """Check on growing random samples whether few enough values match.
+
+    :param values: NumPy array of the non-empty values of the column
+    :param count_func: function counting the matching values in an array
+    :param ratio: the proportion of values that need to match
+    :return: the estimated number of matching values if it is settled that
+        the proportion is below ``ratio``, or None if the whole column needs
+        to be checked
+    """
+    total = len(values)
+    order = None
+    checked = matches = 0
+    size = PROGRESSIVE_SAMPLE
+    # Only worth it if the sample is much smaller than the column
+    while size * PROGRESSIVE_GROWTH <= total:
+        if order is None:
+            rand = numpy.random.RandomState(PROGRESSIVE_SEED)
+            order = rand.permutation(total)
+        matches += count_func(values[order[checked:size]])
+        checked = size
+        if _proportion_upper_bound(matches, checked) < ratio:
+            return int(round(matches * total / checked))
+        elif matches >= ratio * checked:
+            # Looks like a match, which needs the whole column anyway
+            return None
+        size *= PROGRESSIVE_GROWTH
+    return None
+
+
+def _count_phones(values):
+    return int(pandas.Series(values, dtype=object).str.match(
+        _re_phone, na=False,
+    ).sum())
+
+
+def _count_dates(values):
+    return len(parse_dates(values))
+
+
+def classify_cells(values, phone=True):
+    """Classify non-empty values in a single pass.
+
+    Each value is matched once against a combined pattern for integers, floats
+    and text, and checked against the boolean values and the phone number
+    pattern, giving the same results as the separate checks.
+
+    :param values: NumPy array or list of non-empty strings
+    :param phone: whether to check for phone numbers
+    :return: NumPy array of codes, one per value. ``code & CELL_KIND`` is
+        `CELL_INT`, `CELL_FLOAT`, `CELL_TEXT`, or 0 if none of those; the
+        `CELL_BOOL` and `CELL_PHONE` bits are set for booleans and phone
+        numbers
+    """
+    match_kind = _re_kind.match
+    bools = _bool_cells
+    if phone:
+        match_phone = _re_phone.match
+        codes = (
+            (match_kind(v).lastindex or 0) |
+            (CELL_BOOL if v in bools else 0) |
+            (CELL_PHONE if match_phone(v) is not None else 0)
+            for v in values
+        )
+    else:
+        codes = (
+            (match_kind(v).lastindex or 0) |
+            (CELL_BOOL if v in bools else 0)
+            for v in values
+        )
+    return numpy.fromiter(codes, dtype=numpy.int8, count=len(values))
+
+
+def _count_types(array, phone=True):
+    """Count the values matching each of the structural checks.
+
+    This works on the whole column at once, classifying each distinct value
+    only once, with `classify_cells()`.
+
+    :param phone: whether to count phone numbers, if False the count is not
+        in the result
+    :return: ``(counts, distinct)``, where ``counts`` is a dict with the
+        number of empty, integer, float, text, boolean and phone number values,
+        and ``distinct`` is a Series of the distinct non-empty values (or None
+        if it wasn't computed)
+    """
+    if not isinstance(array, pandas.Series):
+        array = pandas.Series(array, dtype=object)
+    values, counts = _distinct_values(array)
+
+    def count(mask):
+        if counts is None:
+            return int(mask.sum())
+        else:
+            return int(counts[mask].sum())
+
+    empty = (values == '').values
+    non_empty = ~empty
+    codes = numpy.zeros(len(values), dtype=numpy.int8)
+    codes[non_empty] = classify_cells(values.values[non_empty], phone)
+    kinds = codes & CELL_KIND
+
+    if counts is None:
+        distinct = None
+    else:
+        distinct = values[non_empty]
+
+    result = {
+        'empty': count(empty),
+        'int': count(kinds == CELL_INT),
+        'float': count(kinds == CELL_FLOAT),
+        'text': count(kinds == CELL_TEXT),
+        'bool': count((codes & CELL_BOOL) != 0),
+    }
+    if phone:
+        result['phone'] = count((codes & CELL_PHONE) != 0)
+    return result, distinct
+
+
 def identify_types(array, name):
-    num_total = len(array)
-    ratio = 1.0 - MAX_UNCLEAN
-
-    # Identify structural type
-    num_float = num_int = num_bool = num_empty = num_text = 0
-    for elem in array:
-        if not elem:
-            num_empty += 1
-        elif _re_int.match(elem):
-            num_int += 1
-        elif _re_float.match(elem):
-            num_float += 1
-        elif len(_re_whitespace.findall(elem)) >= 4:
-            num_text += 1
-        if elem.lower() in ('0', '1', 'true', 'false', 'y', 'n', 'yes', 'no'):
-            num_bool += 1
-
-    threshold = ratio * (num_total - num_empty)
-
-    if num_empty == num_total:
+    """Identify the structural type and semantic types of a column.
+
+    The phone number and date checks are done progressively, on a growing
+    random sample of the values; they stop early when it is clear that the
+    column doesn't match, and only look at every value otherwise.
+
+    :return: ``(structural_type, semantic_types_dict, column_meta)``
+    """
+    return _identify_types(array, name)[:3]
+
+
+def _identify_types(array, name):
+    """Identify the types of a column, see `identify_types()`.
+
+    :return: ``(structural_type, semantic_types_dict, column_meta,
+        numerical_values)``, where ``numerical_values`` is the column parsed
+        as floats if it was found to be a latitude or longitude, else None
+    """
+    if not isinstance(array, pandas.Series):
+        array = pandas.Series(array, dtype=object)
+    non_empty = array.values[(array != '').values]
+    min_ratio = 1.0 - MAX_UNCLEAN
+
+    num_phone = _estimate_below(non_empty, _count_phones, min_ratio)
+    counts, distinct = _count_types(array, phone=num_phone is None)
+    if num_phone is not None:
+        counts['phone'] = num_phone
+
+    def get_distinct(max_categorical):
+        if distinct is not None:
+            num_distinct = len(distinct)
+            if num_distinct <= max_categorical:
+                return num_distinct, set(distinct)
+            return num_distinct, None
+
+        # The column was not de-duplicated, it probably has many distinct
+        # values. Estimate how many first, and only build the set if it
+        # might be small enough
+        if len(non_empty) > DEDUP_PREFIX:
+            sketch = HyperLogLog()
+            sketch.update(non_empty)
+            estimate = sketch.estimate()
+            margin = 1.0 + (
+                CATEGORICAL_ESTIMATE_MARGIN * sketch.relative_error
+            )
+            if estimate > max_categorical * margin:
+                return int(round(estimate)), None
+        values = set(non_empty)
+        if len(values) <= max_categorical:
+            return len(values), values
+        return len(values), None
+
+    def get_latlong():
+        numerical_values = parse_numbers(array)
+        abs_values = numpy.abs(numerical_values)
+        num_lat = numpy.count_nonzero(abs_values <= 90.0)
+        num_long = numpy.count_nonzero(abs_values <= 180.0)
+        return num_lat, num_long, numerical_values
+
+    def get_dates():
+        num_dates = _estimate_below(non_empty, _count_dates, min_ratio)
+        if num_dates is not None:
+            return num_dates, []
+        parsed_dates = parse_dates(array)
+        return len(parsed_dates), parsed_dates
+
+    return decide_types(name, len(array), counts,
+                        get_distinct, get_latlong, get_dates)
+
+
+def structural_type_from_counts(counts, num_total):
+    """Decide the structural type of a column from the counts of its values.
+
+    :param counts: dict with the number of values of each kind, as returned
+        by `_count_types()`
+    :return: ``(structural_type, threshold)`` where ``threshold`` is the
+        number of values that need to match for a type to be picked
+    """
+    threshold = (1.0 - MAX_UNCLEAN) * (num_total - counts['empty'])
+
+    if counts['empty'] == num_total:
         structural_type = types.MISSING_DATA
-    elif num_int >= threshold:
+    elif counts['int'] >= threshold:
         structural_type = types.INTEGER
-    elif num_int + num_float >= threshold:
+    elif counts['int'] + counts['float'] >= threshold:
         structural_type = types.FLOAT
     else:
         structural_type = types.TEXT
 
+    return structural_type, threshold
+
+
+def decide_types(name, num_total, counts,
+                 get_distinct, get_latlong, get_dates):
+    """Identify the types of a column from statistics about its values.
+
+    This is the part of `identify_types()` that doesn't need the values
+    themselves, so it can also be used from accumulated statistics. The
+    more expensive checks are functions, called only if needed:
+
+    :param get_distinct: takes the maximum number of distinct values for a
+        categorical column, returns ``(num_distinct, values)``, where values
+        is the set of distinct values if the column is categorical (or None)
+    :param get_latlong: returns ``(num_lat, num_long, numerical_values)``,
+        the number of values that are valid latitudes/longitudes and the
+        parsed values
+    :param get_dates: returns ``(num_dates, parsed_dates)``
+    :return: ``(structural_type, semantic_types_dict, column_meta,
+        numerical_values)``, see `_identify_types()`
+    """
+    num_empty = counts['empty']
+    num_bool = counts['bool']
+
+    structural_type, threshold = structural_type_from_counts(counts,
+                                                             num_total)
+
     semantic_types_dict = {}
     column_meta = {}
+    latlong_values = None
 
     if structural_type != types.MISSING_DATA and num_empty > 0:
         column_meta['missing_values_ratio'] = num_empty / num_total
@@ -98,15 +509,15 @@ def identify_types(array, name):
             (num_total - num_empty - num_bool) / num_total
 
     if structural_type == types.TEXT:
-        if num_text >= threshold:
+        if counts['text'] >= threshold:
             # Free text
             semantic_types_dict[types.TEXT] = None
         else:
             # Count distinct values
-            values = set(e for e in array if e)
-            column_meta['num_distinct_values'] = len(values)
-            max_categorical = MAX_CATEGORICAL_RATIO * (len(array) - num_empty)
-            if len(values) <= max_categorical:
+            max_categorical = MAX_CATEGORICAL_RATIO * (num_total - num_empty)
+            num_distinct, values = get_distinct(max_categorical)
+            column_meta['num_distinct_values'] = num_distinct
+            if values is not None:
                 semantic_types_dict[types.CATEGORICAL] = values
     elif structural_type == types.INTEGER:
         # Identify ids
@@ -122,41 +533,30 @@ def identify_types(array, name):
 
     # Identify lat/long
     if structural_type == types.FLOAT:
-        num_lat = num_long = 0
-        for elem in array:
-            try:
-                elem = float(elem)
-            except ValueError:
-                pass
-            else:
-                if -180.0 <= float(elem) <= 180.0:
-                    num_long += 1
-                    if -90.0 <= float(elem) <= 90.0:
-                        num_lat += 1
-
-        if num_lat >= threshold and 'lat' in name.lower():
-            semantic_types_dict[types.LATITUDE] = None
-        if num_long >= threshold and 'lon' in name.lower():
-            semantic_types_dict[types.LONGITUDE] = None
+        maybe_lat = 'lat' in name.lower()
+        maybe_long = 'lon' in name.lower()
+        if maybe_lat or maybe_long:
+            num_lat, num_long, numerical_values = get_latlong()
+
+            if num_lat >= threshold and maybe_lat:
+                semantic_types_dict[types.LATITUDE] = None
+            if num_long >= threshold and maybe_long:
+                semantic_types_dict[types.LONGITUDE] = None
+            if (types.LATITUDE in semantic_types_dict or
+                    types.LONGITUDE in semantic_types_dict):
+                # The parsed values are returned for use by the caller
+                latlong_values = numerical_values
 
     # Identify dates
     if structural_type == types.TEXT:
-        parsed_dates = []
-        for elem in array:
-            elem = parse_date(elem)
-            if elem is not None:
-                parsed_dates.append(elem)
+        num_dates, parsed_dates = get_dates()
 
-        if len(parsed_dates) >= threshold:
+        if num_dates >= threshold:
             semantic_types_dict[types.DATE_TIME] = parsed_dates
 
     # Identify phone numbers
-    num_phones = 0
-    for elem in array:
-        if _re_phone.match(elem) is not None:
-            num_phones += 1
-
-    if structural_type != types.MISSING_DATA and num_phones >= threshold:
+    if (structural_type != types.MISSING_DATA and
+            counts['phone'] >= threshold):
         semantic_types_dict[types.PHONE_NUMBER] = None
 
-    return structural_type, semantic_types_dict, column_meta
+    return structural_type, semantic_types_dict, column_meta, latlong_values
@@ -0,0 +1,121 @@
+"""Backends used to load CSV files into DataFrames of strings.
+
+'pandas' uses `pandas.read_csv()`. 'arrow' uses Apache Arrow's CSV reader,
+which parses the file with multiple threads into columnar string buffers;
+those are then converted to pandas column by column, with identical strings
+sharing the same Python object. It needs the ``pyarrow`` package.
+"""
+
+import csv
+import io
+import logging
+import pandas
+
+try:
+    import pyarrow
+    import pyarrow.csv
+except ImportError:
+    pyarrow = None
+
+
+logger = logging.getLogger(__name__)
+
+
+def _read_pandas(fp):
+    return pandas.read_csv(fp, dtype=str, na_filter=False)
+
+
+def _header_names(names):
+    """Turn the values of the header row into column names, like pandas.
+    """
+    result = []
+    seen = {}
+    for i, name in enumerate(names):
+        if not name:
+            name = 'Unnamed: %d' % i
+        if name in seen:
+            # Duplicate names get a suffix: 'a', 'a.1', 'a.2'...
+            seen[name] += 1
+            name = '%s.%d' % (name, seen[name])
+        else:
+            seen[name] = 0
+        result.append(name)
+    return result
+
+
+def _read_header(fp):
+    """Read the header row of a CSV file, leaving the file after it.
+    """
+    header = fp.readline()
+    # A quoted name might contain a line break
+    while header.count(b'"') % 2 == 1:
+        line = fp.readline()
+        if not line:
+            break
+        header += line
+    header = header.decode('utf-8-sig')
+    return next(csv.reader(io.StringIO(header)), [])
+
+
+def _read_arrow(fp):
+    if pyarrow is None:
+        raise ImportError("The 'arrow' reader needs the pyarrow package")
+
+    if not hasattr(fp, 'read'):
+        with open(fp, 'rb') as fp:
+            return _read_arrow(fp)
+
+    start = fp.tell()
+    names = _read_header(fp)
+    if not names:
+        raise pandas.errors.EmptyDataError("No columns to parse from file")
+    arrow_names = ['f%d' % i for i in range(len(names))]
+    try:
+        table = pyarrow.csv.read_csv(
+            fp,
+            read_options=pyarrow.csv.ReadOptions(
+                column_names=arrow_names,
+                use_threads=True,
+            ),
+            convert_options=pyarrow.csv.ConvertOptions(
+                column_types={name: pyarrow.string() for name in arrow_names},
+                strings_can_be_null=False,
+                quoted_strings_can_be_null=False,
+            ),
+        )
+    except pyarrow.lib.ArrowInvalid as e:
+        # Arrow rejects rows with missing fields, which pandas fills with
+        # empty strings
+        logger.warning("Arrow couldn't read the CSV file, falling back on "
+                       "pandas: %s", e)
+        fp.seek(start, 0)
+        return _read_pandas(fp)
+    data = table.to_pandas(
+        split_blocks=True,
+        self_destruct=True,
+        deduplicate_objects=True,
+    )
+    del table
+    data.columns = _header_names(names)
+    return data
+
+
+READERS = {
+    'pandas': _read_pandas,
+    'arrow': _read_arrow,
+}
+
+
+def read_csv(fp, reader='pandas'):
+    """Load a CSV file as a DataFrame of strings.
+
+    Empty values are kept as empty strings, they are not turned into NaN.
+
+    :param fp: file object or path
+    :param reader: which backend to use, one of `READERS`
+    """
+    try:
+        read_func = READERS[reader]
+    except KeyError:
+        raise ValueError("Unknown CSV reader %r" % reader)
+    return read_func(fp)
@@ -0,0 +1,89 @@
+import numpy
+import pandas
+
+
+HLL_PRECISION = 12
+
+# Number of values hashed at once, to bound the memory used by updates
+HLL_CHUNK_SIZE = 65536
+
+
+def hash_values(values):
+    """Hash values to 64-bit integers, deterministically.
+
+    :param values: list or array of strings
+    :return: NumPy array of uint64
+    """
+    return pandas.util.hash_array(numpy.asarray(values, dtype=object))
+
+
+def _bit_length(array):
+    """Number of bits needed to represent each integer of a uint64 array.
+    """
+    array = array.copy()
+    length = numpy.zeros(len(array), dtype=numpy.uint8)
+    for shift in (32, 16, 8, 4, 2, 1):
+        mask = array >= (numpy.uint64(1) << numpy.uint64(shift))
+        length[mask] += shift
+        array[mask] >>= numpy.uint64(shift)
+    length += (array > 0).astype(numpy.uint8)
+    return length
+
+
+class HyperLogLog(object):
+    """Estimate the number of distinct values, in bounded memory.
+
+    This uses ``2 ** precision`` one-byte registers; the standard error of the
+    estimate is about ``1.04 / sqrt(2 ** precision)`` (1.6% with the default
+    precision). Sketches with the same precision can be merged.
+    """
+    def __init__(self, precision=HLL_PRECISION):
+        self.precision = precision
+        self.registers = numpy.zeros(1 << precision, dtype=numpy.uint8)
+
+    @property
+    def relative_error(self):
+        """Standard error of the estimate, relative to the true count.
+        """
+        return 1.04 / numpy.sqrt(len(self.registers))
+
+    def update(self, values):
+        """Add values (strings) to the sketch.
+        """
+        for start in range(0, len(values), HLL_CHUNK_SIZE):
+            self.update_hashes(hash_values(
+                values[start:start + HLL_CHUNK_SIZE],
+            ))
+
+    def update_hashes(self, hashes):
+        """Add values to the sketch, from their hashes (see `hash_values()`).
+        """
+        if len(hashes) == 0:
+            return
+        precision = numpy.uint64(self.precision)
+        index = (hashes >> (numpy.uint64(64) - precision)).astype(numpy.intp)
+        # Position of the first 1 bit in the rest of the hash
+        rank = (64 + 1) - _bit_length(hashes << precision)
+        rank = numpy.minimum(rank, 64 - self.precision + 1)
+        numpy.maximum.at(self.registers, index, rank.astype(numpy.uint8))
+
+    def merge(self, other):
+        """Merge another sketch into this one.
+        """
+        if other.precision != self.precision:
+            raise ValueError("Can't merge sketches with different precisions")
+        numpy.maximum(self.registers, other.registers, out=self.registers)
+
+    def estimate(self):
+        """Estimate the number of distinct values that were added.
+        """
+        nb_registers = len(self.registers)
+        alpha = 0.7213 / (1.0 + 1.079 / nb_registers)
+        estimate = alpha * nb_registers * nb_registers / numpy.sum(
+            numpy.power(2.0, -self.registers.astype(numpy.float64))
+        )
+        zeros = numpy.count_nonzero(self.registers == 0)
+        if estimate <= 2.5 * nb_registers and zeros > 0:
+            # Small range correction (linear counting)
+            estimate = nb_registers * numpy.log(nb_registers / zeros)
+        return float(estimate)
@@ -0,0 +1,297 @@
+"""Profile CSV files in chunks, accumulating statistics over all the rows.
+
+Each column gets a `ColumnAccumulator`, and a `RowReservoir` keeps a uniform
+random sample of the rows, used for the things that need actual values
+(ranges, spatial coverage, the sample in the metadata). Both can be merged,
+so chunks can be summarized independently.
+"""
+
+import logging
+import math
+import numpy
+import pandas
+
+from .profile_types import _count_types, decide_types, parse_dates, \
+    parse_numbers, structural_type_from_counts
+from .sketches import HyperLogLog
+from . import types
+
+
+logger = logging.getLogger(__name__)
+
+
+CHUNK_ROWS = 100000
+
+RESERVOIR_ROWS = 20000
+
+MAX_DISTINCT_VALUES = 100000
+
+
+class Moments(object):
+    """Mergeable mean and variance.
+
+    Like `mean_stddev()`, missing values (NaN) are not in the sums but are
+    counted in the number of values.
+    """
+    def __init__(self):
+        self.nb_total = 0
+        self.nb_valid = 0
+        self.mean = 0.0
+        self.m2 = 0.0  # Sum of squared differences from the mean
+
+    def update(self, values):
+        """Add values to the moments.
+        """
+        values = numpy.asarray(values, dtype=numpy.float64)
+        valid = values[~numpy.isnan(values)]
+        other = Moments()
+        other.nb_total = len(values)
+        other.nb_valid = len(valid)
+        if len(valid):
+            other.mean = float(numpy.mean(valid))
+            other.m2 = float(numpy.sum((valid - other.mean) ** 2))
+        self.merge(other)
+
+    def add_missing(self, count):
+        """Count missing values.
+        """
+        self.nb_total += count
+
+    def merge(self, other):
+        """Merge other moments into these (Chan et al.'s parallel algorithm).
+        """
+        nb_valid = self.nb_valid + other.nb_valid
+        if nb_valid:
+            delta = other.mean - self.mean
+            self.mean += delta * other.nb_valid / nb_valid
+            self.m2 += other.m2 + (
+                delta * delta * self.nb_valid * other.nb_valid / nb_valid
+            )
+        self.nb_valid = nb_valid
+        self.nb_total += other.nb_total
+
+    def mean_stddev(self):
+        """Get the mean and standard deviation, same as `mean_stddev()`.
+        """
+        if self.nb_total == 0:
+            return 0, 0
+        mean = self.mean * self.nb_valid / self.nb_total
+        sq_diff = self.m2 + self.nb_valid * (self.mean - mean) ** 2
+        return float(mean), math.sqrt(sq_diff / self.nb_total)
+
+
+class ColumnAccumulator(object):
+    """Accumulates statistics about a column, to identify its types.
+
+    This counts the kinds of values, the distinct values (exactly up to
+    `MAX_DISTINCT_VALUES`, then using a `HyperLogLog`), and the moments of
+    numbers and dates.
+    """
+    def __init__(self, name):
+        self.name = name
+        self.nb_values = 0
+        self.counts = dict(empty=0, int=0, float=0, text=0, bool=0, phone=0)
+        self.distinct = set()  # None if there are too many
+        self.distinct_sketch = HyperLogLog()
+        self.nb_lat = 0
+        self.nb_long = 0
+        self.numbers = Moments()
+        self.nb_dates = 0
+        self.dates = Moments()
+
+    @classmethod
+    def from_array(cls, name, array):
+        """Summarize a chunk of a column.
+        """
+        acc = cls(name)
+        if not isinstance(array, pandas.Series):
+            array = pandas.Series(array, dtype=object)
+        acc.nb_values = len(array)
+        acc.counts, distinct = _count_types(array)
+        non_empty = array[array != '']
+
+        # Distinct values
+        if distinct is not None:
+            distinct = set(distinct)
+        elif len(non_empty) <= MAX_DISTINCT_VALUES:
+            distinct = set(non_empty)
+        if distinct is not None and len(distinct) <= MAX_DISTINCT_VALUES:
+            acc.distinct = distinct
+        else:
+            acc.distinct = None
+        acc.distinct_sketch.update(non_empty.values)
+
+        # Numbers
+        if acc.counts['int'] + acc.counts['float'] > 0:
+            numerical_values = parse_numbers(array)
+            # Overflows in ES
+            numerical_values[
+                ~(numpy.abs(numerical_values) < 3.4e38)
+            ] = numpy.nan
+            acc.numbers.update(numerical_values)
+            name = name.lower()
+            if 'lat' in name or 'lon' in name:
+                abs_values = numpy.abs(numerical_values)
+                acc.nb_lat = numpy.count_nonzero(abs_values <= 90.0)
+                acc.nb_long = numpy.count_nonzero(abs_values <= 180.0)
+        else:
+            acc.numbers.add_missing(len(array))
+
+        # Dates, only if this chunk looks like text
+        structural_type, _ = structural_type_from_counts(acc.counts,
+                                                         len(array))
+        if structural_type == types.TEXT:
+            parsed_dates = parse_dates(array)
+            acc.nb_dates = len(parsed_dates)
+            acc.dates.update(numpy.array(
+                [dt.timestamp() for dt in parsed_dates],
+                dtype='float32',
+            ))
+
+        return acc
+
+    def update(self, array):
+        """Add a chunk of the column.
+        """
+        self.merge(self.from_array(self.name, array))
+
+    def merge(self, other):
+        """Merge the statistics of another part of the same column.
+        """
+        self.nb_values += other.nb_values
+        for key, value in other.counts.items():
+            self.counts[key] += value
+        if self.distinct is not None and other.distinct is not None:
+            self.distinct.update(other.distinct)
+            if len(self.distinct) > MAX_DISTINCT_VALUES:
+                self.distinct = None
+        else:
+            self.distinct = None
+        self.distinct_sketch.merge(other.distinct_sketch)
+        self.nb_lat += other.nb_lat
+        self.nb_long += other.nb_long
+        self.numbers.merge(other.numbers)
+        self.nb_dates += other.nb_dates
+        self.dates.merge(other.dates)
+
+    def identify_types(self, sample):
+        """Identify the types of the column, like `_identify_types()`.
+
+        The decisions are made from the accumulated statistics, but the
+        payloads (parsed numbers and dates) come from `sample`, the values of
+        the column in the reservoir.
+        """
+        def get_distinct(max_categorical):
+            if self.distinct is not None:
+                num_distinct = len(self.distinct)
+                if num_distinct <= max_categorical:
+                    return num_distinct, self.distinct
+                return num_distinct, None
+            else:
+                return int(round(self.distinct_sketch.estimate())), None
+
+        def get_latlong():
+            return self.nb_lat, self.nb_long, parse_numbers(sample)
+
+        def get_dates():
+            return self.nb_dates, parse_dates(sample)
+
+        return decide_types(self.name, self.nb_values, self.counts,
+                            get_distinct, get_latlong, get_dates)
+
+
+class RowReservoir(object):
+    """Uniform random sample of rows, which can be merged.
+
+    Each row gets a random priority, and the rows with the lowest priorities
+    are kept.
+    """
+    def __init__(self, size):
+        self.size = size
+        self.rows = None
+        self.priorities = numpy.empty(0)
+        self.positions = numpy.empty(0, dtype=numpy.int64)
+
+    @classmethod
+    def from_chunk(cls, size, chunk, first_row, rand):
+        """Sample a chunk of the data.
+
+        :param first_row: the position of the chunk's first row in the data
+        :param rand: `numpy.random.RandomState` used for the priorities
+        """
+        reservoir = cls(size)
+        priorities = rand.random_sample(len(chunk))
+        keep = numpy.argsort(priorities, kind='stable')[:size]
+        reservoir.rows = chunk.iloc[keep]
+        reservoir.priorities = priorities[keep]
+        reservoir.positions = first_row + keep
+        return reservoir
+
+    def update(self, chunk, first_row, rand):
+        """Sample from a new chunk of the data.
+        """
+        self.merge(self.from_chunk(self.size, chunk, first_row, rand))
+
+    def merge(self, other):
+        """Merge with a reservoir from another part of the data.
+        """
+        if other.rows is None:
+            return
+        elif self.rows is None:
+            rows = other.rows
+        else:
+            rows = pandas.concat([self.rows, other.rows])
+        priorities = numpy.concatenate([self.priorities, other.priorities])
+        positions = numpy.concatenate([self.positions, other.positions])
+        keep = numpy.argsort(priorities, kind='stable')[:self.size]
+        self.rows = rows.iloc[keep]
+        self.priorities = priorities[keep]
+        self.positions = positions[keep]
+
+    def get_data(self):
+        """Get the sampled rows, in the order they appear in the data.
+        """
+        order = numpy.argsort(self.positions, kind='stable')
+        return self.rows.iloc[order].reset_index(drop=True)
+
+
+def read_streaming(fp, seed, chunk_rows=None, reservoir_rows=None):
+    """Read a CSV file in chunks, accumulating statistics about the columns.
+
+    :param fp: file object or path
+    :param seed: seed for the random sample of rows
+    :param chunk_rows: number of rows to read at once, defaults to
+        `CHUNK_ROWS`
+    :param reservoir_rows: number of rows to sample, defaults to
+        `RESERVOIR_ROWS`
+    :return: ``(accumulators, data, nb_rows)`` where ``accumulators`` are
+        the `ColumnAccumulator` of each column and ``data`` is a random sample
+        of the rows, as a DataFrame
+    """
+    if chunk_rows is None:
+        chunk_rows = CHUNK_ROWS
+    if reservoir_rows is None:
+        reservoir_rows = RESERVOIR_ROWS
+
+    rand = numpy.random.RandomState(seed)
+    accumulators = None
+    reservoir = RowReservoir(reservoir_rows)
+    nb_rows = 0
+    empty = None
+    for chunk in pandas.read_csv(fp, dtype=str, na_filter=False,
+                                 chunksize=chunk_rows):
+        if accumulators is None:
+            accumulators = [ColumnAccumulator(name) for name in chunk.columns]
+            empty = chunk.iloc[:0]
+        logger.info("Reading chunk, rows %d-%d",
+                    nb_rows, nb_rows + len(chunk) - 1)
+        for i, acc in enumerate(accumulators):
+            acc.update(chunk.iloc[:, i])
+        reservoir.update(chunk, nb_rows, rand)
+        nb_rows += len(chunk)
+
+    if reservoir.rows is None:
+        data = empty
+    else:
+        data = reservoir.get_data()
+    return accumulators, data, nb_rows
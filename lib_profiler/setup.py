@@ -21,6 +21,7 @@ setup(name='datamart_profiler',
       install_requires=req,
       extras_require={
           'prometheus': ['prometheus_client'],
+          'arrow': ['pyarrow'],
       },
       description="Data profiling library for Datamart",
       author="Remi Rampin",
@@ -24,7 +24,24 @@ logger = logging.getLogger(__name__)
 MAX_CONCURRENT = 2
 
 
-def materialize_and_process_dataset(dataset_id, metadata, lazo_client):
+def get_previous_metadata(es, dataset_id):
+    """Get the metadata of a dataset from the index, if it can be re-used.
+
+    Profiles made by a different version are ignored, so that
+    `freshen_old_index.py` actually re-profiles everything.
+    """
+    try:
+        previous = es.get('datamart', dataset_id)['_source']
+    except elasticsearch.NotFoundError:
+        return None
+    if previous.get('version') != os.environ['DATAMART_VERSION']:
+        return None
+    return previous
+
+
+def materialize_and_process_dataset(dataset_id, metadata, lazo_client, es):
+    previous_metadata = get_previous_metadata(es, dataset_id)
+
     with get_dataset(metadata, dataset_id) as dataset_path:
         materialize = metadata.pop('materialize')
 
@@ -46,7 +63,10 @@ def materialize_and_process_dataset(dataset_id, metadata, lazo_client):
             data=dataset_path,
             metadata=metadata,
             lazo_client=lazo_client,
-            dataset_id=dataset_id
+            dataset_id=dataset_id,
+            max_workers=int(os.environ.get('PROFILE_WORKERS', '1')),
+            fingerprints=True,
+            previous_metadata=previous_metadata,
         )
         logger.info("Profiling took %.2fs", time.perf_counter() - start)
 
@@ -133,7 +153,8 @@ class Profiler(object):
                 materialize_and_process_dataset,
                 dataset_id,
                 metadata,
-                self.lazo_client
+                self.lazo_client,
+                self.es,
             )
 
             future.add_done_callback(
@@ -0,0 +1,72 @@
+import asyncio
+import concurrent.futures
+import prometheus_client
+import time
+
+
+BUCKETS = [0.01, 0.1, 0.5, 1.0, 5.0, 10.0, 30.0, 60.0, 120.0, 300.0]
+
+PROM_EXECUTOR_QUEUED = prometheus_client.Gauge(
+    'executor_queued_tasks',
+    "Number of tasks waiting for a worker, per executor",
+    ['executor'],
+)
+PROM_EXECUTOR_RUNNING = prometheus_client.Gauge(
+    'executor_running_tasks',
+    "Number of tasks being run, per executor",
+    ['executor'],
+)
+PROM_EXECUTOR_WAIT = prometheus_client.Histogram(
+    'executor_wait_seconds',
+    "Time tasks waited for a worker, per executor",
+    ['executor'],
+    buckets=BUCKETS,
+)
+
+
+class BoundedExecutor(object):
+    """Runs blocking functions on a fixed number of threads.
+
+    This is used by the request handlers so that Elasticsearch requests,
+    profiling, and augmentation don't block the IOLoop. Tasks wait in a queue
+    when all the workers are busy; the size of that queue is exported as the
+    ``executor_queued_tasks`` Prometheus metric.
+    """
+    def __init__(self, name, max_workers):
+        self.name = name
+        self.max_workers = max_workers
+        self._executor = concurrent.futures.ThreadPoolExecutor(
+            max_workers=max_workers,
+            thread_name_prefix=name,
+        )
+        self._queued = PROM_EXECUTOR_QUEUED.labels(name)
+        self._running = PROM_EXECUTOR_RUNNING.labels(name)
+        self._wait = PROM_EXECUTOR_WAIT.labels(name)
+        self._queued.set(0)
+        self._running.set(0)
+
+    def run(self, func, *args, **kwargs):
+        """Call a function on a worker thread.
+
+        :return: an asyncio future for the result
+        """
+        submitted = time.perf_counter()
+
+        def task():
+            self._queued.dec()
+            self._wait.observe(time.perf_counter() - submitted)
+            with self._running.track_inprogress():
+                return func(*args, **kwargs)
+
+        def done(future):
+            # Tasks cancelled before they started are still counted as queued
+            if future.cancelled():
+                self._queued.dec()
+
+        self._queued.inc()
+        future = self._executor.submit(task)
+        future.add_done_callback(done)
+        return asyncio.wrap_future(future)
+
+    def shutdown(self, wait=True):
+        self._executor.shutdown(wait=wait)
@@ -1,16 +1,22 @@
 from datetime import datetime
 from dateutil.parser import parse
+import concurrent.futures
 import distance
+import functools
 import hashlib
 import io
+import json
 import logging
-import pickle
+import prometheus_client
 import time
 import tornado.web
 
 from datamart_core import types
-from datamart_core.fscache import cache_get_or_set
+from datamart_core.common import hash_json
+from datamart_core.fscache import cache_get, cache_get_or_set
+from datamart_core.lrucache import LRUCache
 from datamart_profiler import process_dataset
+from datamart_profiler.lazo import query_sketches
 
 
 logger = logging.getLogger(__name__)
@@ -20,6 +26,15 @@ BUF_SIZE = 128000
 PAGINATION_SIZE = 200
 TOP_K_SIZE = 50
 
+# Maximum number of datasets matched by each attribute, for union search
+UNION_MAX_CANDIDATES = 1000
+
+# Maximum number of searches running at the same time for a request
+SEARCH_PLANNER_WORKERS = 8
+
+# Time after which a request stops waiting for searches, in seconds
+SEARCH_DEADLINE = 30.0
+
 
 def compute_levenshtein_sim(str1, str2):
     """
@@ -48,6 +63,117 @@ class ClientError(ValueError):
     """
 
 
+class SearchPlanner(object):
+    """Runs the independent searches of a request concurrently.
+
+    Searches are submitted to a pool of threads, and `wait()` returns them as
+    they complete. Once the deadline is reached, searches that are not done
+    are abandoned and the request goes on with the results it has.
+    """
+    def __init__(self, deadline=None, max_workers=None):
+        if deadline is None:
+            deadline = SEARCH_DEADLINE
+        if max_workers is None:
+            max_workers = SEARCH_PLANNER_WORKERS
+        self.deadline = time.monotonic() + deadline
+        self.timed_out = False
+        self._executor = concurrent.futures.ThreadPoolExecutor(
+            max_workers=max_workers,
+        )
+
+    def submit(self, func, *args, **kwargs):
+        return self._executor.submit(func, *args, **kwargs)
+
+    def wait(self, futures):
+        """Wait for some of the futures to complete.
+
+        :return: the set of futures that are done, empty if the deadline
+            was reached (the others are then cancelled)
+        """
+        timeout = max(0.0, self.deadline - time.monotonic())
+        done, not_done = concurrent.futures.wait(
+            futures,
+            timeout=timeout,
+            return_when=concurrent.futures.FIRST_COMPLETED,
+        )
+        if not done:
+            self.timed_out = True
+            logger.warning("Search deadline reached, abandoning %d searches",
+                           len(not_done))
+            for future in not_done:
+                future.cancel()
+        return done
+
+    def shutdown(self):
+        # Don't wait for abandoned searches
+        self._executor.shutdown(wait=False)
+
+
+def multi_search_all(es, index, bodies, max_hits=None, page_size=None,
+                     **kwargs):
+    """
+    Run several searches at once, getting all their hits.
+
+    The searches are sent together using the multi-search API, and paginated
+    with ``search_after``: each round requests the next page of the searches
+    that are not done yet.
+
+    :param bodies: list of search bodies (without size or sort).
+    :param max_hits: maximum number of hits to get for each search, the best
+        scoring ones.
+    :param page_size: number of hits requested at a time, defaults to
+        `PAGINATION_SIZE`.
+    :return: list of lists of hits, in the order of ``bodies``.
+    """
+
+    if page_size is None:
+        page_size = PAGINATION_SIZE
+
+    results = [list() for _ in bodies]
+    cursors = [None for _ in bodies]
+    pending = list(range(len(bodies)))
+    while pending:
+        requests = list()
+        sizes = list()
+        for i in pending:
+            size = page_size
+            if max_hits is not None:
+                size = min(size, max_hits - len(results[i]))
+            body = dict(
+                bodies[i],
+                size=size,
+                # 'id' breaks ties, so that 'search_after' is exact. Indices
+                # created before it was mapped sort as if it were missing
+                sort=[
+                    '_score',
+                    {'id': {'order': 'asc', 'unmapped_type': 'keyword'}},
+                ],
+                track_total_hits=False,
+            )
+            if cursors[i] is not None:
+                body['search_after'] = cursors[i]
+            requests.append({'index': index})
+            requests.append(body)
+            sizes.append(size)
+
+        responses = es.msearch(body=requests, **kwargs)['responses']
+
+        next_pending = list()
+        for i, size, response in zip(pending, sizes, responses):
+            if 'error' in response:
+                raise RuntimeError("Error from Elasticsearch in search %d: "
+                                   "%r" % (i, response['error']))
+            hits = response['hits']['hits']
+            results[i].extend(hits)
+            if len(hits) == size and (max_hits is None or
+                                      len(results[i]) < max_hits):
+                cursors[i] = hits[-1]['sort']
+                next_pending.append(i)
+        pending = next_pending
+
+    return results
+
+
 def get_column_index_mapping(data_profile):
     """
     Get the mapping between column name and column index.
@@ -356,11 +482,17 @@ def get_spatial_join_search_results(es, ranges, dataset_id=None,
 
 
 def get_textual_join_search_results(es, dataset_ids, column_names,
-                                    lazo_scores, query_args=None):
+                                    lazo_scores, query_args=None,
+                                    dataset_columns=None):
     """Combine Lazo textual search results with Elasticsearch
     (keyword search).
+
+    :param dataset_columns: `DatasetColumns` cache for the request
     """
 
+    if dataset_columns is None:
+        dataset_columns = DatasetColumns(es)
+
     scores_per_dataset = dict()
     column_per_dataset = dict()
     for d_id, name, lazo_score in zip(dataset_ids, column_names, lazo_scores):
@@ -373,11 +505,11 @@ def get_textual_join_search_results(es, dataset_ids, column_names,
     # if there is no keyword query
     if not query_args:
         results = list()
+        dataset_columns.prefetch(column_per_dataset)
         for dataset_id in column_per_dataset:
-            column_indices = get_column_identifiers(
-                es=es,
-                column_names=column_per_dataset[dataset_id],
-                dataset_id=dataset_id
+            column_indices = dataset_columns.get_indices(
+                dataset_id,
+                column_per_dataset[dataset_id],
             )
             for j in range(len(column_indices)):
                 column_name = column_per_dataset[dataset_id][j]
@@ -456,32 +588,101 @@ def get_textual_join_search_results(es, dataset_ids, column_names,
     )['hits']['hits']
 
 
-def get_column_identifiers(es, column_names, dataset_id=None, data_profile=None):
-    column_indices = [-1 for _ in column_names]
-    if not data_profile:
-        columns = es.get('datamart', dataset_id)['_source']['columns']
-    else:
-        columns = data_profile['columns']
-    for i in range(len(columns)):
-        for j in range(len(column_names)):
-            if columns[i]['name'] == column_names[j]:
-                column_indices[j] = i
-    return column_indices
+class DatasetColumns(object):
+    """
+    Cache of the column indices of datasets, for the duration of a request.
 
+    Datasets that are not known yet are fetched from Elasticsearch, several
+    at a time with `prefetch()`; columns found in search hits can be added
+    with `add()`. It can be shared by the threads of a `SearchPlanner` (at
+    worst, a dataset gets fetched twice).
+    """
+
+    def __init__(self, es):
+        self.es = es
+        self._column_maps = dict()
+
+    def add(self, dataset_id, columns):
+        """
+        Record the columns of a dataset, from its metadata.
+        """
+
+        # If names are repeated, the last column wins
+        self._column_maps[dataset_id] = {
+            column['name']: index for index, column in enumerate(columns)
+        }
 
-def get_dataset_metadata(es, dataset_id):
+    def prefetch(self, dataset_ids):
+        """
+        Fetch the columns of all these datasets with a single request.
+        """
+
+        dataset_ids = [
+            dataset_id for dataset_id in dict.fromkeys(dataset_ids)
+            if dataset_id not in self._column_maps
+        ]
+        if not dataset_ids:
+            return
+
+        docs = self.es.mget(
+            index='datamart',
+            body={'ids': dataset_ids},
+            _source_includes=['columns.name'],
+        )['docs']
+        for doc in docs:
+            if doc.get('found'):
+                self.add(doc['_id'], doc['_source']['columns'])
+            else:
+                self._column_maps[doc['_id']] = {}
+
+    def get_indices(self, dataset_id, column_names):
+        """
+        Get the indices of columns of a dataset, -1 for unknown names.
+        """
+
+        self.prefetch([dataset_id])
+        column_map = self._column_maps[dataset_id]
+        return [column_map.get(name, -1) for name in column_names]
+
+
+def get_datasets_metadata(es, dataset_ids):
     """
-    Retrieve metadata about input dataset.
+    Retrieve metadata about datasets, for search results.
+
+    All the datasets are fetched with a single request, each only once even
+    if it appears multiple times in ``dataset_ids``. Long descriptions are
+    truncated.
 
+    :return: dict, where the key is the dataset ID, and value is the metadata.
+        Datasets that don't exist (anymore) are left out.
     """
 
-    hit = es.get('datamart', dataset_id)
+    dataset_ids = list(dict.fromkeys(dataset_ids))  # unique, in order
+    if not dataset_ids:
+        return {}
+
+    docs = es.mget(
+        index='datamart',
+        body={'ids': dataset_ids},
+    )['docs']
+
+    metadata = dict()
+    for doc in docs:
+        if not doc.get('found'):
+            logger.warning("Dataset in search results not found: %r",
+                           doc['_id'])
+            continue
+        meta = doc['_source']
+        if meta.get('description') and len(meta['description']) > 100:
+            meta['description'] = meta['description'][:97] + "..."
+        metadata[doc['_id']] = meta
 
-    return hit
+    return metadata
 
 
 def get_joinable_datasets(es, lazo_client, data_profile, dataset_id=None,
-                          query_args=None, tabular_variables=()):
+                          query_args=None, tabular_variables=(),
+                          dataset_columns=None, planner=None):
     """
     Retrieve datasets that can be joined with an input dataset.
 
@@ -491,12 +692,17 @@ def get_joinable_datasets(es, lazo_client, data_profile, dataset_id=None,
     :param dataset_id: The identifier of the desired Datamart dataset for augmentation.
     :param query_args: list of query arguments (optional).
     :param tabular_variables: specifies which columns to focus on for the search.
+    :param dataset_columns: `DatasetColumns` cache for the request (optional).
+    :param planner: `SearchPlanner` running the searches (optional).
     """
 
     if not dataset_id and not data_profile:
         raise TypeError("Either a dataset id or a data profile "
                         "must be provided for the join")
 
+    if dataset_columns is None:
+        dataset_columns = DatasetColumns(es)
+
     column_index_mapping = get_column_index_mapping(data_profile)
 
     # get the coverage for each column of the input dataset
@@ -507,26 +713,35 @@ def get_joinable_datasets(es, lazo_client, data_profile, dataset_id=None,
         tabular_variables
     )
 
-    # search results
-    search_results = list()
+    own_planner = planner is None
+    if own_planner:
+        planner = SearchPlanner()
+
+    # results of each search, in the order the searches are listed
+    results_per_search = dict()
+    pending = dict()
+
+    def add_results(key, column, results):
+        for result in results:
+            result['companion_column'] = column
+        results_per_search[key] = results
 
     # numerical, temporal, and spatial attributes
     for column in column_coverage:
         type_ = column_coverage[column]['type']
         type_value = column_coverage[column]['type_value']
         if type_ == 'spatial':
-            spatial_results = get_spatial_join_search_results(
+            future = planner.submit(
+                get_spatial_join_search_results,
                 es,
                 column_coverage[column]['ranges'],
                 dataset_id,
                 query_args
             )
-            for result in spatial_results:
-                result['companion_column'] = column
-                search_results.append(result)
         else:
             column_name = data_profile['columns'][int(column)]['name']
-            numerical_results = get_numerical_join_search_results(
+            future = planner.submit(
+                get_numerical_join_search_results,
                 es,
                 type_,
                 type_value,
@@ -535,9 +750,8 @@ def get_joinable_datasets(es, lazo_client, data_profile, dataset_id=None,
                 dataset_id,
                 query_args
             )
-            for result in numerical_results:
-                result['companion_column'] = column
-                search_results.append(result)
+        key = ('coverage', column)
+        pending[future] = functools.partial(add_results, key, column)
 
     # textual/categorical attributes
     lazo_sketches = get_lazo_sketches(
@@ -545,32 +759,64 @@ def get_joinable_datasets(es, lazo_client, data_profile, dataset_id=None,
         column_index_mapping,
         tabular_variables
     )
-    for column in lazo_sketches:
-        n_permutations, hash_values, cardinality = lazo_sketches[column]
-        query_results = lazo_client.query_lazo_sketch_data(
-            n_permutations,
-            hash_values,
-            cardinality
-        )
-        if not query_results:
-            continue
-        dataset_ids = list()
-        column_names = list()
-        scores = list()
-        for dataset_id, column_name, threshold in query_results:
-            dataset_ids.append(dataset_id)
-            column_names.append(column_name)
-            scores.append(threshold)
-        textual_results = get_textual_join_search_results(
-            es,
-            dataset_ids,
-            column_names,
-            scores,
-            query_args
+    lazo_columns = list(lazo_sketches)
+
+    def lazo_results(lazo_query_results):
+        if not query_args:
+            # get the columns of all the matched datasets in one request
+            dataset_columns.prefetch(
+                result[0]
+                for query_results in lazo_query_results
+                for result in query_results
+            )
+        # then combine them with Elasticsearch
+        for column, query_results in zip(lazo_columns, lazo_query_results):
+            if not query_results:
+                continue
+            dataset_ids = list()
+            column_names = list()
+            scores = list()
+            for d_id, column_name, threshold in query_results:
+                dataset_ids.append(d_id)
+                column_names.append(column_name)
+                scores.append(threshold)
+            future = planner.submit(
+                get_textual_join_search_results,
+                es,
+                dataset_ids,
+                column_names,
+                scores,
+                query_args,
+                dataset_columns=dataset_columns,
+            )
+            key = ('textual', column)
+            pending[future] = functools.partial(add_results, key, column)
+
+    if lazo_columns:
+        # query all the sketches concurrently
+        future = planner.submit(
+            query_sketches,
+            lazo_client,
+            [lazo_sketches[column] for column in lazo_columns],
         )
-        for result in textual_results:
-            result['companion_column'] = column
-            search_results.append(result)
+        pending[future] = lazo_results
+
+    # handle the results as they arrive, until the deadline
+    try:
+        while pending:
+            done = planner.wait(pending)
+            if not done:
+                break  # deadline
+            for future in done:
+                pending.pop(future)(future.result())
+    finally:
+        if own_planner:
+            planner.shutdown()
+
+    search_results = list()
+    for key in [('coverage', column) for column in column_coverage] + \
+            [('textual', column) for column in lazo_columns]:
+        search_results.extend(results_per_search.get(key, ()))
 
     search_results = sorted(
         search_results,
@@ -578,14 +824,18 @@ def get_joinable_datasets(es, lazo_client, data_profile, dataset_id=None,
         reverse=True
     )
 
+    datasets_metadata = get_datasets_metadata(
+        es,
+        [result['_source']['dataset_id'] for result in search_results],
+    )
+
     results = []
     for result in search_results:
         dt = result['_source']['dataset_id']
-        info = get_dataset_metadata(es, dt)
-        meta = info.pop('_source')
+        if dt not in datasets_metadata:
+            continue
+        meta = datasets_metadata[dt]
         # materialize = meta.get('materialize', {})
-        if meta.get('description') and len(meta['description']) > 100:
-            meta['description'] = meta['description'][:97] + "..."
         left_columns = []
         right_columns = []
         left_columns_names = []
@@ -660,7 +910,8 @@ def get_column_information(data_profile, filter_=()):
 
 
 def get_unionable_datasets(es, data_profile, dataset_id=None,
-                           query_args=None, tabular_variables=()):
+                           query_args=None, tabular_variables=(),
+                           dataset_columns=None):
     """
     Retrieve datasets that can be unioned to an input dataset using fuzzy search
     (max edit distance = 2).
@@ -670,12 +921,16 @@ def get_unionable_datasets(es, data_profile, dataset_id=None,
     :param dataset_id: The identifier of the desired Datamart dataset for augmentation.
     :param query_args: list of query arguments (optional).
     :param tabular_variables: specifies which columns to focus on for the search.
+    :param dataset_columns: `DatasetColumns` cache for the request (optional).
     """
 
     if not dataset_id and not data_profile:
         raise TypeError("Either a dataset id or a data profile "
                         "must be provided for the union")
 
+    if dataset_columns is None:
+        dataset_columns = DatasetColumns(es)
+
     main_dataset_columns = get_column_information(
         data_profile=data_profile,
         filter_=tabular_variables
@@ -685,7 +940,9 @@ def get_unionable_datasets(es, data_profile, dataset_id=None,
     for type_ in main_dataset_columns:
         n_columns += len(main_dataset_columns[type_])
 
-    column_pairs = dict()
+    # build one query per attribute
+    attributes = list()
+    queries = list()
     for type_ in main_dataset_columns:
         for att in main_dataset_columns[type_]:
             partial_query = {
@@ -748,36 +1005,36 @@ def get_unionable_datasets(es, data_profile, dataset_id=None,
 
             # logger.info("Query (union-fuzzy): %r", query_obj)
 
-            # FIXME: Use search-after API here?
-            from_ = 0
-            while True:
-                hits = es.search(
-                    index='datamart',
-                    body=query_obj,
-                    from_=from_,
-                    size=PAGINATION_SIZE,
-                    request_timeout=30
-                )['hits']['hits']
-                from_ += len(hits)
-
-                for hit in hits:
-
-                    dataset_name = hit['_id']
-                    es_score = hit['_score'] if query_args else 1
-                    columns = hit['_source']['columns']
-                    inner_hits = hit['inner_hits']
-
-                    if dataset_name not in column_pairs:
-                        column_pairs[dataset_name] = []
-
-                    for column_hit in inner_hits['columns']['hits']['hits']:
-                        column_offset = int(column_hit['_nested']['offset'])
-                        column_name = columns[column_offset]['name']
-                        sim = compute_levenshtein_sim(att.lower(), column_name.lower())
-                        column_pairs[dataset_name].append((att, column_name, sim, es_score))
-
-                if len(hits) != PAGINATION_SIZE:
-                    break
+            attributes.append(att)
+            queries.append(query_obj)
+
+    # run all the queries together
+    hits_per_attribute = multi_search_all(
+        es,
+        'datamart',
+        queries,
+        max_hits=UNION_MAX_CANDIDATES,
+        request_timeout=30,
+    )
+
+    column_pairs = dict()
+    for att, hits in zip(attributes, hits_per_attribute):
+        for hit in hits:
+
+            dataset_name = hit['_id']
+            es_score = hit['_score'] if query_args else 1
+            columns = hit['_source']['columns']
+            inner_hits = hit['inner_hits']
+            dataset_columns.add(dataset_name, columns)
+
+            if dataset_name not in column_pairs:
+                column_pairs[dataset_name] = []
+
+            for column_hit in inner_hits['columns']['hits']['hits']:
+                column_offset = int(column_hit['_nested']['offset'])
+                column_name = columns[column_offset]['name']
+                sim = compute_levenshtein_sim(att.lower(), column_name.lower())
+                column_pairs[dataset_name].append((att, column_name, sim, es_score))
 
     scores = dict()
     for dataset in list(column_pairs.keys()):
@@ -816,13 +1073,19 @@ def get_unionable_datasets(es, data_profile, dataset_id=None,
         reverse=True
     )
 
+    datasets_metadata = get_datasets_metadata(
+        es,
+        [dt for dt, _ in sorted_datasets],
+    )
+    if not dataset_id:
+        profile_column_map = get_column_index_mapping(data_profile)
+
     results = []
     for dt, score in sorted_datasets:
-        info = get_dataset_metadata(es, dt)
-        meta = info.pop('_source')
+        if dt not in datasets_metadata:
+            continue
+        meta = datasets_metadata[dt]
         # materialize = meta.get('materialize', {})
-        if meta.get('description') and len(meta['description']) > 100:
-            meta['description'] = meta['description'][:97] + "..."
         # TODO: augmentation information is incorrect
         left_columns = []
         right_columns = []
@@ -831,15 +1094,15 @@ def get_unionable_datasets(es, data_profile, dataset_id=None,
         for att_1, att_2, sim, es_score in column_pairs[dt]:
             if dataset_id:
                 left_columns.append(
-                    get_column_identifiers(es, [att_1], dataset_id=dataset_id)
+                    dataset_columns.get_indices(dataset_id, [att_1])
                 )
             else:
                 left_columns.append(
-                    get_column_identifiers(es, [att_1], data_profile=data_profile)
+                    [profile_column_map.get(att_1, -1)]
                 )
             left_columns_names.append([att_1])
             right_columns.append(
-                get_column_identifiers(es, [att_2], dataset_id=dt)
+                dataset_columns.get_indices(dt, [att_2])
             )
             right_columns_names.append([att_2])
         results.append(dict(
@@ -1154,35 +1417,61 @@ def parse_query_variables(data, tabular_variables=None):
 def get_augmentation_search_results(es, lazo_client, data_profile,
                                     query_args_main, query_args_sup,
                                     tabular_variables, score_threshold,
-                                    dataset_id=None, join=True, union=True):
+                                    dataset_id=None, join=True, union=True,
+                                    planner=None):
     join_results = []
     union_results = []
 
-    if join:
-        logger.info("Looking for joins...")
-        start = time.perf_counter()
-        join_results = get_joinable_datasets(
-            es=es,
-            lazo_client=lazo_client,
-            data_profile=data_profile,
-            dataset_id=dataset_id,
-            query_args=query_args_sup,
-            tabular_variables=tabular_variables
-        )
-        logger.info("Found %d join results in %.2fs",
-                    len(join_results), time.perf_counter() - start)
-    if union:
-        logger.info("Looking for unions...")
-        start = time.perf_counter()
-        union_results = get_unionable_datasets(
-            es=es,
-            data_profile=data_profile,
-            dataset_id=dataset_id,
-            query_args=query_args_main,
-            tabular_variables=tabular_variables
-        )
-        logger.info("Found %d union results in %.2fs",
-                    len(union_results), time.perf_counter() - start)
+    # column indices of datasets, shared by the join and union searches
+    dataset_columns = DatasetColumns(es)
+
+    own_planner = planner is None
+    if own_planner:
+        planner = SearchPlanner()
+    try:
+        # the union search runs in the background, while this thread runs
+        # the join search (which itself uses the planner)
+        union_future = None
+        if union:
+            logger.info("Looking for unions...")
+            start = time.perf_counter()
+
+            def union_search():
+                results = get_unionable_datasets(
+                    es=es,
+                    data_profile=data_profile,
+                    dataset_id=dataset_id,
+                    query_args=query_args_main,
+                    tabular_variables=tabular_variables,
+                    dataset_columns=dataset_columns,
+                )
+                logger.info("Found %d union results in %.2fs",
+                            len(results), time.perf_counter() - start)
+                return results
+
+            union_future = planner.submit(union_search)
+
+        if join:
+            logger.info("Looking for joins...")
+            start = time.perf_counter()
+            join_results = get_joinable_datasets(
+                es=es,
+                lazo_client=lazo_client,
+                data_profile=data_profile,
+                dataset_id=dataset_id,
+                query_args=query_args_sup,
+                tabular_variables=tabular_variables,
+                dataset_columns=dataset_columns,
+                planner=planner,
+            )
+            logger.info("Found %d join results in %.2fs",
+                        len(join_results), time.perf_counter() - start)
+
+        if union_future is not None and planner.wait([union_future]):
+            union_results = union_future.result()
+    finally:
+        if own_planner:
+            planner.shutdown()
 
     min_size = min(len(join_results), len(union_results))
     results = list(zip(join_results[:min_size], union_results[:min_size]))
@@ -1200,13 +1489,122 @@ def get_augmentation_search_results(es, lazo_client, data_profile,
     return results[:TOP_K_SIZE]  # top-50
 
 
+# Size of the in-memory tier of the profile cache, in front of /cache/queries
+PROFILE_CACHE_MEMORY_BYTES = 64 * 1024 * 1024
+
+PROM_PROFILE_CACHE_HITS = prometheus_client.Counter(
+    'profile_cache_hits',
+    "Number of lookups of input profiles that hit, per cache tier",
+    ['tier'],
+)
+PROM_PROFILE_CACHE_MISSES = prometheus_client.Counter(
+    'profile_cache_misses',
+    "Number of lookups of input profiles that miss, per cache tier",
+    ['tier'],
+)
+PROM_PROFILE_CACHE_MEMORY = prometheus_client.Gauge(
+    'profile_cache_memory_bytes',
+    "Size of the profiles in the in-memory tier of the profile cache",
+)
+
+for tier in ('memory', 'disk'):
+    PROM_PROFILE_CACHE_HITS.labels(tier).inc(0)
+    PROM_PROFILE_CACHE_MISSES.labels(tier).inc(0)
+
+# Parts of the profile used by the search, see `get_joinable_datasets()` and
+# `get_unionable_datasets()`
+SEARCH_PROFILE_FEATURES = ('coverage', 'spatial_coverage', 'lazo')
+
+# Serialized (JSON) profiles, keyed by the SHA1 of the data
+profile_memory_cache = LRUCache(PROFILE_CACHE_MEMORY_BYTES)
+PROM_PROFILE_CACHE_MEMORY.set_function(lambda: profile_memory_cache.size)
+
+
+# Size of the cache of search results, and how long they are kept (seconds)
+SEARCH_CACHE_MEMORY_BYTES = 32 * 1024 * 1024
+SEARCH_CACHE_TTL = 10 * 60
+
+PROM_SEARCH_CACHE_HITS = prometheus_client.Counter(
+    'search_cache_hits',
+    "Number of searches whose results were cached",
+)
+PROM_SEARCH_CACHE_MISSES = prometheus_client.Counter(
+    'search_cache_misses',
+    "Number of searches whose results were not cached",
+)
+
+
+class SearchResultsCache(object):
+    """Cache of the results of searches with data, in memory.
+
+    Entries expire after `SEARCH_CACHE_TTL` seconds, and the whole cache is
+    invalidated when the datasets in the index change.
+    """
+    def __init__(self, max_bytes, ttl):
+        self._cache = LRUCache(max_bytes, ttl=ttl)
+        # Incremented on invalidation, so results of searches that were
+        # running at the time don't get stored
+        self.generation = 0
+
+    @staticmethod
+    def make_key(data_hash, data_profile, query_args_main, query_args_sup,
+                 tabular_variables):
+        """Build the key of a search, from its data and parsed query.
+
+        :param data_hash: SHA1 of the data, if it was sent, else the
+            `data_profile` is hashed
+        """
+        if data_hash is not None:
+            data_key = dict(data=data_hash)
+        else:
+            data_key = dict(data_profile=data_profile)
+        return hash_json(
+            data_key,
+            query_args_main=query_args_main,
+            query_args_sup=query_args_sup,
+            # Comes from a set, so the order doesn't matter. Sorted on repr(),
+            # since the query might have any type of values
+            tabular_variables=sorted(tabular_variables, key=repr),
+        )
+
+    def get(self, key):
+        serialized = self._cache.get(key)
+        if serialized is None:
+            PROM_SEARCH_CACHE_MISSES.inc()
+            return None
+        PROM_SEARCH_CACHE_HITS.inc()
+        return json.loads(serialized.decode('utf-8'))
+
+    def put(self, key, results, generation):
+        """Store results, unless the cache was invalidated since `generation`.
+        """
+        if generation == self.generation:
+            self._cache.put(key, json.dumps(results).encode('utf-8'))
+
+    def invalidate(self):
+        self.generation += 1
+        self._cache.clear()
+
+
+search_results_cache = SearchResultsCache(SEARCH_CACHE_MEMORY_BYTES,
+                                          SEARCH_CACHE_TTL)
+
+
 class ProfilePostedData(tornado.web.RequestHandler):
-    def handle_data_parameter(self, data):
+    async def handle_data_parameter(self, data, profile_columns=None,
+                                    features=None):
         """
         Handles the 'data' parameter.
 
+        Profiles are cached as JSON, in memory (most recently used ones) and
+        in /cache/queries. Reading from disk and profiling happen in the
+        application's `compute_executor`.
+
         :param data: the input parameter
-        :param lazo_client: client for the Lazo Index Server
+        :param profile_columns: indices of the columns to profile (e.g. the
+          tabular variables of a search), defaults to all of them
+        :param features: optional parts of the profile to compute, see
+          `datamart_profiler.FEATURES`, defaults to all of them
         :return: (data, data_profile)
           data: data as bytes (either the input or loaded from the input)
           data_profile: the profiling (metadata) of the data
@@ -1219,6 +1617,53 @@ class ProfilePostedData(tornado.web.RequestHandler):
         sha1 = hashlib.sha1(data)
         data_hash = sha1.hexdigest()
 
+        # Partial profiles are cached separately, but a full profile can be
+        # used in their place
+        cache_keys = [data_hash]
+        if profile_columns is not None or features is not None:
+            if profile_columns is not None:
+                profile_columns = sorted(set(
+                    i for i in profile_columns if isinstance(i, int)
+                ))
+            if features is not None:
+                features = sorted(set(features))
+            cache_keys.append('%s_%s' % (
+                data_hash,
+                hash_json(columns=profile_columns, features=features),
+            ))
+        for key in cache_keys:
+            serialized = profile_memory_cache.get(key)
+            if serialized is not None:
+                PROM_PROFILE_CACHE_HITS.labels('memory').inc()
+                logger.info("Found cached profile_data in memory")
+                return json.loads(serialized.decode('utf-8')), data_hash
+        PROM_PROFILE_CACHE_MISSES.labels('memory').inc()
+
+        data_profile = await self.application.compute_executor.run(
+            self._get_profile,
+            data, cache_keys, profile_columns, features,
+        )
+        return data_profile, data_hash
+
+    def _get_profile(self, data, cache_keys, profile_columns, features):
+        """Get the profile from /cache/queries, or profile the data.
+
+        A full profile found on disk is used in place of a partial one.
+        Otherwise, the profile is computed and stored under the last key.
+        """
+        # The '.json' suffix keeps entries pickled by older versions from
+        # being read
+        for key in cache_keys[:-1]:
+            with cache_get('/cache/queries', key + '.json') as cache_path:
+                if cache_path is not None:
+                    PROM_PROFILE_CACHE_HITS.labels('disk').inc()
+                    logger.info("Found cached full profile_data")
+                    with open(cache_path, 'rb') as fp:
+                        serialized = fp.read()
+                    profile_memory_cache.put(key, serialized)
+                    return json.loads(serialized.decode('utf-8'))
+
+        cache_key = cache_keys[-1]
         data_profile = [None]
 
         def create(cache_temp):
@@ -1228,16 +1673,26 @@ class ProfilePostedData(tornado.web.RequestHandler):
                 data=io.BytesIO(data),
                 lazo_client=self.application.lazo_client,
                 search=True,
+                profile_columns=profile_columns,
+                features=features,
             )
             logger.info("Profiled in %.2fs", time.perf_counter() - start)
+            serialized = json.dumps(data_profile[0]).encode('utf-8')
             with open(cache_temp, 'wb') as fp:
-                pickle.dump(data_profile[0], fp)
+                fp.write(serialized)
+            profile_memory_cache.put(cache_key, serialized)
 
-        with cache_get_or_set('/cache/queries', data_hash, create) as cache_path:
+        with cache_get_or_set(
+            '/cache/queries', cache_key + '.json', create,
+        ) as cache_path:
             if data_profile[0]:
                 # We just profiled it, no need to re-read from disk
-                return data_profile[0], data_hash
+                PROM_PROFILE_CACHE_MISSES.labels('disk').inc()
+                return data_profile[0]
             else:
+                PROM_PROFILE_CACHE_HITS.labels('disk').inc()
                 logger.info("Found cached profile_data")
                 with open(cache_path, 'rb') as fp:
-                    return pickle.load(fp), data_hash
+                    serialized = fp.read()
+                profile_memory_cache.put(cache_key, serialized)
+                return json.loads(serialized.decode('utf-8'))
@@ -1,12 +1,12 @@
 import aio_pika
 import asyncio
-import contextlib
 import elasticsearch
 import lazo_index_service
 import logging
 import json
 import os
 import prometheus_client
+from prometheus_async.aio import time as prom_async_time
 import shutil
 import tornado.ioloop
 from tornado.routing import URLSpec
@@ -22,9 +22,11 @@ from datamart_core.materialize import get_dataset
 import datamart_profiler
 
 from .enhance_metadata import enhance_metadata
+from .executor import BoundedExecutor
 from .graceful_shutdown import GracefulApplication, GracefulHandler
 from .search import ClientError, parse_query, \
-    get_augmentation_search_results, ProfilePostedData
+    get_augmentation_search_results, ProfilePostedData, SearchPlanner, \
+    search_results_cache, SEARCH_PLANNER_WORKERS, SEARCH_PROFILE_FEATURES
 
 
 logger = logging.getLogger(__name__)
@@ -32,6 +34,12 @@ logger = logging.getLogger(__name__)
 
 SCORE_THRESHOLD = 0.0
 
+# Number of threads running searches (Elasticsearch and Lazo requests)
+SEARCH_WORKERS = 16
+
+# Number of threads profiling and augmenting data
+COMPUTE_WORKERS = 2
+
 
 BUCKETS = [0.5, 1.0, 5.0, 10.0, 20.0, 30.0, 60.0, 120.0, 300.0, 600.0]
 
@@ -103,8 +111,8 @@ class BaseHandler(RequestHandler):
 
 
 class Profile(BaseHandler, GracefulHandler, ProfilePostedData):
-    @PROM_PROFILE_TIME.time()
-    def post(self):
+    @prom_async_time(PROM_PROFILE_TIME)
+    async def post(self):
         PROM_PROFILE.inc()
 
         data = self.get_body_argument('data', None)
@@ -122,7 +130,7 @@ class Profile(BaseHandler, GracefulHandler, ProfilePostedData):
         logger.info("Got profile")
 
         try:
-            data_profile, _ = self.handle_data_parameter(data)
+            data_profile, _ = await self.handle_data_parameter(data)
         except ClientError as e:
             return self.send_error_json(400, str(e))
 
@@ -133,12 +141,13 @@ class Profile(BaseHandler, GracefulHandler, ProfilePostedData):
 
 
 class Search(BaseHandler, GracefulHandler, ProfilePostedData):
-    @PROM_SEARCH_TIME.time()
-    def post(self):
+    @prom_async_time(PROM_SEARCH_TIME)
+    async def post(self):
         PROM_SEARCH.inc()
 
         type_ = self.request.headers.get('Content-type', '')
         data = None
+        data_hash = None
         data_profile = None
         if type_.startswith('application/json'):
             query = self.get_json()
@@ -188,13 +197,6 @@ class Search(BaseHandler, GracefulHandler, ProfilePostedData):
                     ', data' if data else '',
                     ', data_profile' if data_profile else '')
 
-        # parameter: data
-        if data:
-            try:
-                data_profile, _ = self.handle_data_parameter(data)
-            except ClientError as e:
-                return self.send_error_json(400, str(e))
-
         # parameter: query
         query_args_main = list()
         query_args_sup = list()
@@ -206,6 +208,18 @@ class Search(BaseHandler, GracefulHandler, ProfilePostedData):
             except ClientError as e:
                 return self.send_error_json(400, str(e))
 
+        # parameter: data
+        # Only profile what the search will use
+        if data:
+            try:
+                data_profile, data_hash = await self.handle_data_parameter(
+                    data,
+                    profile_columns=tabular_variables or None,
+                    features=SEARCH_PROFILE_FEATURES,
+                )
+            except ClientError as e:
+                return self.send_error_json(400, str(e))
+
         # At least one of them must be provided
         if not query_args_main and not data_profile:
             return self.send_error_json(
@@ -214,7 +228,8 @@ class Search(BaseHandler, GracefulHandler, ProfilePostedData):
             )
 
         if not data_profile:
-            hits = self.application.elasticsearch.search(
+            hits = (await self.application.search_executor.run(
+                self.application.elasticsearch.search,
                 index='datamart',
                 body={
                     'query': {
@@ -224,7 +239,7 @@ class Search(BaseHandler, GracefulHandler, ProfilePostedData):
                     },
                 },
                 size=1000
-            )['hits']['hits']
+            ))['hits']['hits']
 
             results = []
             for h in hits:
@@ -246,15 +261,37 @@ class Search(BaseHandler, GracefulHandler, ProfilePostedData):
                     supplied_resource_id=None
                 ))
         else:
-            results = get_augmentation_search_results(
-                self.application.elasticsearch,
-                self.application.lazo_client,
-                data_profile,
-                query_args_main,
-                query_args_sup,
-                tabular_variables,
-                SCORE_THRESHOLD
+            cache_key = search_results_cache.make_key(
+                data_hash, data_profile,
+                query_args_main, query_args_sup, tabular_variables,
             )
+            results = search_results_cache.get(cache_key)
+            if results is not None:
+                logger.info("Found cached search results")
+                return self.send_json(results)
+
+            generation = search_results_cache.generation
+            planner = SearchPlanner()
+            try:
+                results = await self.application.search_executor.run(
+                    get_augmentation_search_results,
+                    self.application.elasticsearch,
+                    self.application.lazo_client,
+                    data_profile,
+                    query_args_main,
+                    query_args_sup,
+                    tabular_variables,
+                    SCORE_THRESHOLD,
+                    planner=planner,
+                )
+            finally:
+                planner.shutdown()
+            results = [enhance_metadata(result) for result in results]
+            # Don't keep partial results
+            if not planner.timed_out:
+                search_results_cache.put(cache_key, results, generation)
+            return self.send_json(results)
+
         results = [enhance_metadata(result) for result in results]
         return self.send_json(results)
 
@@ -311,21 +348,20 @@ class BaseDownload(BaseHandler):
             logger.info("Sending redirect to direct_url")
             return self.redirect(materialize['direct_url'])
         else:
-            # We want to catch exceptions from get_dataset(), without catching
-            # exceptions from inside the with block
-            # https://docs.python.org/3/library/contextlib.html#catching-exceptions-from-enter-methods
-            stack = contextlib.ExitStack()
+            # Materializing the dataset and locking it in the cache happen in
+            # the executor, sending it on the IOLoop
+            cache_entry = get_dataset(
+                metadata, dataset_id,
+                format=format, format_options=format_options,
+            )
             try:
-                dataset_path = stack.enter_context(
-                    get_dataset(
-                        metadata, dataset_id,
-                        format=format, format_options=format_options,
-                    )
+                dataset_path = await self.application.compute_executor.run(
+                    cache_entry.__enter__,
                 )
             except Exception:
                 self.send_error_json(500, "Materializer reports failure")
                 raise
-            with stack:
+            try:
                 if zipfile.is_zipfile(dataset_path):
                     self.set_header('Content-Type', 'application/zip')
                     self.set_header(
@@ -347,30 +383,36 @@ class BaseDownload(BaseHandler):
                             break
                         buf = fp.read(BUFSIZE)
                     await self.flush()
-                return self.finish()
+            finally:
+                await self.application.compute_executor.run(
+                    cache_entry.__exit__, None, None, None,
+                )
+            return self.finish()
 
 
 class DownloadId(BaseDownload, GracefulHandler):
-    @PROM_DOWNLOAD_TIME.time()
-    def get(self, dataset_id):
+    @prom_async_time(PROM_DOWNLOAD_TIME)
+    async def get(self, dataset_id):
         PROM_DOWNLOAD_ID.inc()
 
         format, format_options = self.read_format()
 
         # Get materialization data from Elasticsearch
         try:
-            metadata = self.application.elasticsearch.get(
-                'datamart', dataset_id
-            )['_source']
+            metadata = (await self.application.search_executor.run(
+                self.application.elasticsearch.get,
+                'datamart', dataset_id,
+            ))['_source']
         except elasticsearch.NotFoundError:
             raise HTTPError(404)
 
-        return self.send_dataset(dataset_id, metadata, format, format_options)
+        return await self.send_dataset(dataset_id, metadata,
+                                       format, format_options)
 
 
 class Download(BaseDownload, GracefulHandler, ProfilePostedData):
-    @PROM_DOWNLOAD_TIME.time()
-    def post(self):
+    @prom_async_time(PROM_DOWNLOAD_TIME)
+    async def post(self):
         PROM_DOWNLOAD.inc()
 
         type_ = self.request.headers.get('Content-type', '')
@@ -412,18 +454,19 @@ class Download(BaseDownload, GracefulHandler, ProfilePostedData):
         metadata = task['metadata']
 
         if not data:
-            return self.send_dataset(
+            return await self.send_dataset(
                 task['id'], metadata, format, format_options,
             )
         else:
             # data
             try:
-                data_profile, _ = self.handle_data_parameter(data)
+                data_profile, _ = await self.handle_data_parameter(data)
             except ClientError as e:
                 return self.send_error_json(400, str(e))
 
             # first, look for possible augmentation
-            search_results = get_augmentation_search_results(
+            search_results = await self.application.search_executor.run(
+                get_augmentation_search_results,
                 es=self.application.elasticsearch,
                 lazo_client=self.application.lazo_client,
                 data_profile=data_profile,
@@ -444,17 +487,24 @@ class Download(BaseDownload, GracefulHandler, ProfilePostedData):
 
             task = search_results[0]
 
-            with get_dataset(metadata, task['id'], format='csv') as newdata:
-                # perform augmentation
-                logger.info("Performing half-augmentation with supplied data")
-                new_path = augment(
-                    data,
-                    newdata,
-                    data_profile,
-                    task,
-                    return_only_datamart_data=True
-                )
-                # FIXME: This always sends in D3M format
+            def do_augment():
+                with get_dataset(metadata, task['id'],
+                                 format='csv') as newdata:
+                    # perform augmentation
+                    logger.info("Performing half-augmentation with supplied "
+                                "data")
+                    return augment(
+                        data,
+                        newdata,
+                        data_profile,
+                        task,
+                        return_only_datamart_data=True
+                    )
+                    # FIXME: This always sends in D3M format
+
+            new_path = await self.application.compute_executor.run(
+                do_augment,
+            )
 
             # send a zip file
             self.set_header('Content-Type', 'application/zip')
@@ -469,13 +519,15 @@ class Download(BaseDownload, GracefulHandler, ProfilePostedData):
 
 
 class Metadata(BaseHandler, GracefulHandler):
-    @PROM_METADATA_TIME.time()
-    def get(self, dataset_id):
+    @prom_async_time(PROM_METADATA_TIME)
+    async def get(self, dataset_id):
         PROM_METADATA.inc()
 
         es = self.application.elasticsearch
         try:
-            metadata = es.get('datamart', dataset_id)['_source']
+            metadata = (await self.application.search_executor.run(
+                es.get, 'datamart', dataset_id,
+            ))['_source']
         except elasticsearch.NotFoundError:
             raise HTTPError(404)
 
@@ -485,8 +537,8 @@ class Metadata(BaseHandler, GracefulHandler):
 
 
 class Augment(BaseHandler, GracefulHandler, ProfilePostedData):
-    @PROM_AUGMENT_TIME.time()
-    def post(self):
+    @prom_async_time(PROM_AUGMENT_TIME)
+    async def post(self):
         PROM_AUGMENT.inc()
 
         type_ = self.request.headers.get('Content-type', '')
@@ -519,7 +571,7 @@ class Augment(BaseHandler, GracefulHandler, ProfilePostedData):
 
         # data
         try:
-            data_profile, data_hash = self.handle_data_parameter(data)
+            data_profile, data_hash = await self.handle_data_parameter(data)
         except ClientError as e:
             return self.send_error_json(400, str(e))
 
@@ -529,7 +581,8 @@ class Augment(BaseHandler, GracefulHandler, ProfilePostedData):
         # no augmentation task provided -- will first look for possible augmentation
         if task['augmentation']['type'] == 'none':
             logger.info("No task, searching for augmentations")
-            search_results = get_augmentation_search_results(
+            search_results = await self.application.search_executor.run(
+                get_augmentation_search_results,
                 es=self.application.elasticsearch,
                 lazo_client=self.application.lazo_client,
                 data_profile=data_profile,
@@ -559,22 +612,28 @@ class Augment(BaseHandler, GracefulHandler, ProfilePostedData):
         )
 
         def create_aug(cache_temp):
-            try:
-                with get_dataset(metadata, task['id'], format='csv') as newdata:
-                    # perform augmentation
-                    logger.info("Performing augmentation with supplied data")
-                    augment(
-                        data,
-                        newdata,
-                        data_profile,
-                        task,
-                        columns=columns,
-                        destination=cache_temp,
-                    )
-            except AugmentationError as e:
-                return self.send_error_json(400, str(e))
+            with get_dataset(metadata, task['id'], format='csv') as newdata:
+                # perform augmentation
+                logger.info("Performing augmentation with supplied data")
+                augment(
+                    data,
+                    newdata,
+                    data_profile,
+                    task,
+                    columns=columns,
+                    destination=cache_temp,
+                )
 
-        with cache_get_or_set('/cache/aug', key, create_aug) as path:
+        # Locking and creating the entry happen in the executor, sending it
+        # on the IOLoop
+        cache_entry = cache_get_or_set('/cache/aug', key, create_aug)
+        try:
+            path = await self.application.compute_executor.run(
+                cache_entry.__enter__,
+            )
+        except AugmentationError as e:
+            return self.send_error_json(400, str(e))
+        try:
             # send a zip file
             self.set_header('Content-Type', 'application/zip')
             self.set_header(
@@ -586,6 +645,10 @@ class Augment(BaseHandler, GracefulHandler, ProfilePostedData):
             # Maybe compressing to disk and streaming that file is better?
             writer.write_recursive(path)
             writer.close()
+        finally:
+            await self.application.compute_executor.run(
+                cache_entry.__exit__, None, None, None,
+            )
 
         return self.finish()
 
@@ -608,7 +671,8 @@ class Health(BaseHandler):
 
 
 class Application(GracefulApplication):
-    def __init__(self, *args, es, lazo, **kwargs):
+    def __init__(self, *args, es, lazo, search_workers=SEARCH_WORKERS,
+                 compute_workers=COMPUTE_WORKERS, **kwargs):
         super(Application, self).__init__(*args, **kwargs)
 
         self.is_closing = False
@@ -617,6 +681,10 @@ class Application(GracefulApplication):
         self.lazo_client = lazo
         self.channel = None
 
+        # The handlers run blocking work there, to keep the IOLoop responsive
+        self.search_executor = BoundedExecutor('search', search_workers)
+        self.compute_executor = BoundedExecutor('compute', compute_workers)
+
         log_future(asyncio.get_event_loop().create_task(self._amqp()), logger)
 
     async def _amqp(self):
@@ -628,6 +696,20 @@ class Application(GracefulApplication):
         self.channel = await connection.channel()
         await self.channel.set_qos(prefetch_count=1)
 
+        # Register to datasets exchange, to know when search results change
+        datasets_exchange = await self.channel.declare_exchange(
+            'datasets',
+            aio_pika.ExchangeType.TOPIC,
+        )
+        datasets_queue = await self.channel.declare_queue(exclusive=True)
+        await datasets_queue.bind(datasets_exchange, '#')
+
+        # Consume dataset messages
+        async for message in datasets_queue.iterator(no_ack=True):
+            logger.info("Got dataset message: %r, invalidating search cache",
+                        message.routing_key)
+            search_results_cache.invalidate()
+
     def log_request(self, handler):
         if handler.request.path == '/health':
             return
@@ -635,8 +717,15 @@ class Application(GracefulApplication):
 
 
 def make_app(debug=False):
+    search_workers = int(os.environ.get('QUERY_SEARCH_WORKERS',
+                                        SEARCH_WORKERS))
+    compute_workers = int(os.environ.get('QUERY_COMPUTE_WORKERS',
+                                         COMPUTE_WORKERS))
+
     es = elasticsearch.Elasticsearch(
-        os.environ['ELASTICSEARCH_HOSTS'].split(',')
+        os.environ['ELASTICSEARCH_HOSTS'].split(','),
+        # One connection for each search that can run at the same time
+        maxsize=search_workers * SEARCH_PLANNER_WORKERS,
     )
     lazo_client = lazo_index_service.LazoIndexClient(
         host=os.environ['LAZO_SERVER_HOST'],
@@ -657,7 +746,9 @@ def make_app(debug=False):
         debug=debug,
         serve_traceback=True,
         es=es,
-        lazo=lazo_client
+        lazo=lazo_client,
+        search_workers=search_workers,
+        compute_workers=compute_workers,
     )
 
 
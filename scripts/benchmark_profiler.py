@@ -0,0 +1,252 @@
+#!/usr/bin/env python3
+
+"""This script measures the performance of the profiler.
+
+It profiles synthetic datasets (wide, tall, text, dates, numeric, geo) and
+the CSV files in tests/data, and reports the throughput in rows per second,
+the peak memory usage (RSS), and the time spent in each stage as recorded by
+`process_dataset(debug=True)` (column stages are added up over the columns).
+Each dataset is profiled twice, each time in a fresh process: once for the
+totals, and once with debug on for the stages.
+
+Example::
+
+    python scripts/benchmark_profiler.py --rows 100000 --json results.json
+"""
+
+import argparse
+import concurrent.futures
+from datetime import datetime, timedelta
+import json
+import logging
+import multiprocessing
+import numpy
+import os
+import pandas
+import resource
+import shutil
+import sys
+import tempfile
+import time
+
+from datamart_profiler import RANDOM_SEED, process_dataset
+from datamart_profiler.readers import READERS
+
+
+TESTS_DATA = os.path.join(os.path.dirname(__file__), '..', 'tests', 'data')
+
+
+def _words(rand, rows, nb_words):
+    vocabulary = numpy.array([
+        'alpha', 'bravo', 'charlie', 'delta', 'echo', 'foxtrot', 'golf',
+        'hotel', 'india', 'juliett', 'kilo', 'lima', 'mike', 'november',
+        'oscar', 'papa', 'quebec', 'romeo', 'sierra', 'tango',
+    ])
+    words = vocabulary[rand.randint(0, len(vocabulary), (rows, nb_words))]
+    return [' '.join(row) for row in words]
+
+
+def _dates(rand, rows):
+    start = datetime(2010, 1, 1)
+    seconds = rand.randint(0, 10 * 365 * 86400, rows)
+    return [(start + timedelta(seconds=int(s))).isoformat() for s in seconds]
+
+
+def _numbers(rand, rows, integer):
+    if integer:
+        return rand.randint(-1000000, 1000000, rows).astype(str)
+    else:
+        return numpy.char.mod('%.4f', rand.normal(0.0, 1000.0, rows))
+
+
+def generate(kind, rows, columns):
+    """Generate a synthetic dataset.
+
+    :param kind: one of `GENERATORS`
+    :param rows: number of rows
+    :param columns: number of columns, for the 'wide' dataset
+    :return: pandas.DataFrame of strings
+    """
+    rand = numpy.random.RandomState(RANDOM_SEED)
+    data = {}
+    if kind == 'wide':
+        for i in range(columns):
+            if i % 4 == 0:
+                data['int_%d' % i] = _numbers(rand, rows, True)
+            elif i % 4 == 1:
+                data['float_%d' % i] = _numbers(rand, rows, False)
+            elif i % 4 == 2:
+                data['cat_%d' % i] = rand.choice(['a', 'b', 'c', 'd'], rows)
+            else:
+                data['text_%d' % i] = _words(rand, rows, 2)
+    elif kind == 'tall':
+        data['id'] = numpy.arange(rows).astype(str)
+        data['value'] = _numbers(rand, rows, False)
+        data['category'] = rand.choice(['yes', 'no'], rows)
+    elif kind == 'text':
+        for i in range(4):
+            data['text_%d' % i] = _words(rand, rows, 8)
+    elif kind == 'dates':
+        for i in range(4):
+            data['date_%d' % i] = _dates(rand, rows)
+    elif kind == 'numeric':
+        for i in range(8):
+            data['number_%d' % i] = _numbers(rand, rows, i % 2 == 0)
+    elif kind == 'geo':
+        centers = numpy.array([(40.7, -74.0), (34.0, -118.2), (41.9, -87.6)])
+        points = centers[rand.randint(0, 3, rows)]
+        points += rand.normal(0.0, 0.05, (rows, 2))
+        data['latitude'] = numpy.char.mod('%.6f', points[:, 0])
+        data['longitude'] = numpy.char.mod('%.6f', points[:, 1])
+        data['height'] = _numbers(rand, rows, False)
+    else:
+        raise ValueError("Unknown dataset kind %r" % kind)
+    return pandas.DataFrame(data)
+
+
+GENERATORS = ['wide', 'tall', 'text', 'dates', 'numeric', 'geo']
+
+
+def benchmark(path, options, debug):
+    """Benchmark profiling a CSV file, in the current process.
+
+    :param debug: whether to have `process_dataset()` record the time and
+        memory of each stage. This traces memory allocations, which makes it
+        slower, so total time and peak memory are measured in another run.
+    :return: dict of measurements
+    """
+    # Import scikit-learn now, it is slow and would skew the first stage
+    # using it
+    start = time.perf_counter()
+    import sklearn.cluster  # noqa: F401
+    import_time = time.perf_counter() - start
+
+    start = time.perf_counter()
+    metadata = process_dataset(
+        path,
+        ranges_method=options['ranges_method'],
+        max_workers=options['max_workers'],
+        reader=options['reader'],
+        debug=debug,
+    )
+    total = time.perf_counter() - start
+
+    # ru_maxrss is in kilobytes on Linux, bytes on macOS. Worker processes
+    # count as children once they are done
+    peak_rss = max(
+        resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+        resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss,
+    )
+    result = {
+        'rows': metadata['nb_rows'],
+        'columns': len(metadata['columns']),
+        'profiled_rows': metadata['nb_profiled_rows'],
+        'total': total,
+        'rows_per_second': metadata['nb_profiled_rows'] / total,
+        'import_time': import_time,
+        'peak_rss_mb': (
+            peak_rss / (1024 * 1024 if sys.platform == 'darwin' else 1024)
+        ),
+    }
+    if debug:
+        stages = dict(metadata['debug']['stages'])
+        # Add up the stages of each column
+        for column in metadata['debug']['columns']:
+            for name, record in column['stages'].items():
+                total_record = stages.setdefault('column_' + name, {})
+                for key, value in record.items():
+                    total_record[key] = total_record.get(key, 0) + value
+        result['stages'] = stages
+    return result
+
+
+def run_isolated(path, options, debug=False):
+    """Run `benchmark()` in a new process, so peak memory is per-run.
+
+    The process is spawned rather than forked, so it doesn't start with the
+    memory of this one.
+    """
+    with concurrent.futures.ProcessPoolExecutor(
+        max_workers=1,
+        mp_context=multiprocessing.get_context('spawn'),
+    ) as executor:
+        return executor.submit(benchmark, path, options, debug).result()
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Measure the performance of the profiler",
+    )
+    parser.add_argument('--rows', type=int, default=100000,
+                        help="Number of rows in synthetic datasets (the "
+                             "'wide' dataset has a tenth of that)")
+    parser.add_argument('--columns', type=int, default=200,
+                        help="Number of columns in the 'wide' dataset")
+    parser.add_argument('--datasets', nargs='+',
+                        default=GENERATORS + ['tests'],
+                        choices=GENERATORS + ['tests'],
+                        help="Which datasets to run ('tests' is the CSV "
+                             "files in tests/data)")
+    parser.add_argument('--ranges-method', default='kmeans')
+    parser.add_argument('--max-workers', type=int, default=None)
+    parser.add_argument('--reader', default='pandas', choices=sorted(READERS),
+                        help="How to parse the CSV files")
+    parser.add_argument('--json', help="Also write the results to this file")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.WARNING)
+
+    options = {
+        'ranges_method': args.ranges_method,
+        'max_workers': args.max_workers,
+        'reader': args.reader,
+    }
+
+    tmp = tempfile.mkdtemp(prefix='benchmark_profiler_')
+    try:
+        paths = []
+        for kind in args.datasets:
+            if kind == 'tests':
+                for name in sorted(os.listdir(TESTS_DATA)):
+                    if name.endswith('.csv'):
+                        paths.append((
+                            'tests/' + name,
+                            os.path.join(TESTS_DATA, name),
+                        ))
+            else:
+                rows = args.rows // 10 if kind == 'wide' else args.rows
+                path = os.path.join(tmp, kind + '.csv')
+                generate(kind, rows, args.columns).to_csv(path, index=False)
+                paths.append((kind, path))
+
+        stage_names = ['load', 'types', 'column_identify_types',
+                       'column_numerical_ranges', 'column_temporal_ranges',
+                       'spatial']
+        print("%-22s %8s %5s %9s %11s %9s  %s" % (
+            "dataset", "rows", "cols", "total (s)", "rows/s", "RSS (MB)",
+            " ".join("%16s" % s for s in stage_names),
+        ))
+        results = {}
+        for name, path in paths:
+            result = results[name] = run_isolated(path, options)
+            result['stages'] = run_isolated(path, options, True)['stages']
+            print("%-22s %8d %5d %9.3f %11.0f %9.1f  %s" % (
+                name, result['rows'], result['columns'], result['total'],
+                result['rows_per_second'], result['peak_rss_mb'],
+                " ".join(
+                    "%16.3f" % result['stages'][s]['wall_time']
+                    if s in result['stages'] else "%16s" % "-"
+                    for s in stage_names
+                ),
+            ))
+    finally:
+        shutil.rmtree(tmp)
+
+    if args.json:
+        with open(args.json, 'w') as fp:
+            json.dump({'options': options, 'results': results}, fp,
+                      indent=2, sort_keys=True)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,76 @@
+#!/usr/bin/env python3
+
+"""This script compares the methods used to compute numerical ranges.
+
+For each synthetic distribution and size, it reports the time taken by each
+method of `get_numerical_ranges()`, the fraction of the values covered by the
+ranges, and the total width of the ranges (relative to the width of the
+data). A good method covers most of the values with narrow ranges.
+"""
+
+import argparse
+import numpy
+import time
+
+from datamart_profiler import RANDOM_SEED, RANGES_METHODS, \
+    get_numerical_ranges
+
+
+def make_distributions(size):
+    rng = numpy.random.RandomState(RANDOM_SEED)
+    third = size // 3
+    return {
+        'uniform': rng.uniform(0.0, 100.0, size),
+        'normal': rng.normal(50.0, 10.0, size),
+        'lognormal': rng.lognormal(3.0, 1.0, size),
+        'mixture': numpy.concatenate([
+            rng.normal(10.0, 1.0, third),
+            rng.normal(50.0, 5.0, third),
+            rng.normal(200.0, 20.0, size - 2 * third),
+        ]),
+        'integers': rng.randint(0, 20, size).astype(numpy.float64),
+        'timestamps': numpy.sort(
+            1.5e9 + rng.exponential(3600.0, size).cumsum()
+        ),
+    }
+
+
+def evaluate(values, ranges):
+    covered = numpy.zeros(len(values), dtype=bool)
+    width = 0.0
+    for rg in ranges:
+        gte, lte = rg['range']['gte'], rg['range']['lte']
+        covered |= (gte <= values) & (values <= lte)
+        width += lte - gte
+    spread = values.max() - values.min()
+    return covered.mean(), width / spread if spread else 0.0
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Compare the methods used to compute numerical ranges",
+    )
+    parser.add_argument('--sizes', nargs='+', type=int,
+                        default=[1000, 10000, 100000, 1000000])
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args()
+
+    print("%-12s %9s %-9s %10s %9s %7s" % (
+        "data", "size", "method", "time (s)", "coverage", "width",
+    ))
+    for size in args.sizes:
+        for name, values in make_distributions(size).items():
+            for method in sorted(RANGES_METHODS):
+                times = []
+                for _ in range(args.repeat):
+                    start = time.perf_counter()
+                    ranges = get_numerical_ranges(values, method=method)
+                    times.append(time.perf_counter() - start)
+                coverage, width = evaluate(values, ranges)
+                print("%-12s %9d %-9s %10.4f %8.1f%% %7.3f" % (
+                    name, size, method, min(times), coverage * 100.0, width,
+                ))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,109 @@
+#!/usr/bin/env python3
+
+"""This script compares the single-pass cell classifier with separate checks.
+
+The separate checks are how `_count_types()` used to classify values: one
+pass for each of integers, floats, text, booleans, and phone numbers. Both
+are run on every value of each column of the CSV files in tests/data
+(repeated ``--scale`` times, so there is enough work to measure), and must
+give the same counts.
+"""
+
+import argparse
+import os
+import pandas
+import time
+
+from datamart_profiler.profile_types import CELL_BOOL, CELL_FLOAT, CELL_INT, \
+    CELL_KIND, CELL_PHONE, CELL_TEXT, _bool_values, _re_float, _re_int, \
+    _re_phone, _re_whitespace, classify_cells
+
+
+TESTS_DATA = os.path.join(os.path.dirname(__file__), '..', 'tests', 'data')
+
+
+def separate_checks(values):
+    """Count the kinds of values with one pass for each check.
+    """
+    values = pandas.Series(values, dtype=object)
+    is_int = values.str.match(_re_int, na=False)
+    is_float = ~is_int & values.str.match(_re_float, na=False)
+    is_text = ~is_int & ~is_float & (values.str.count(_re_whitespace) >= 4)
+    short = values.str.len() <= 5
+    is_bool = short & values.str.lower().isin(_bool_values)
+    is_phone = values.str.match(_re_phone, na=False)
+    return {
+        'int': int(is_int.sum()),
+        'float': int(is_float.sum()),
+        'text': int(is_text.sum()),
+        'bool': int(is_bool.sum()),
+        'phone': int(is_phone.sum()),
+    }
+
+
+def single_pass(values):
+    """Count the kinds of values with `classify_cells()`.
+    """
+    codes = classify_cells(values)
+    kinds = codes & CELL_KIND
+    return {
+        'int': int((kinds == CELL_INT).sum()),
+        'float': int((kinds == CELL_FLOAT).sum()),
+        'text': int((kinds == CELL_TEXT).sum()),
+        'bool': int(((codes & CELL_BOOL) != 0).sum()),
+        'phone': int(((codes & CELL_PHONE) != 0).sum()),
+    }
+
+
+def measure(func, values, repeat):
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = func(values)
+        times.append(time.perf_counter() - start)
+    return min(times), result
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Compare the single-pass cell classifier with separate "
+                    "checks",
+    )
+    parser.add_argument('--scale', type=int, default=200,
+                        help="Number of times the values are repeated")
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+
+    print("%-12s %-24s %9s %12s %12s %8s" % (
+        "file", "column", "values", "separate (s)", "single (s)", "speedup",
+    ))
+    total_separate = total_single = 0.0
+    for name in sorted(os.listdir(TESTS_DATA)):
+        if not name.endswith('.csv'):
+            continue
+        data = pandas.read_csv(os.path.join(TESTS_DATA, name),
+                               dtype=str, na_filter=False)
+        for column in data.columns:
+            values = data[column].values
+            values = list(values[values != '']) * args.scale
+            time_separate, expected = measure(separate_checks, values,
+                                              args.repeat)
+            time_single, result = measure(single_pass, values, args.repeat)
+            if result != expected:
+                raise AssertionError("Different counts for %s %s: %r != %r" % (
+                    name, column, result, expected,
+                ))
+            total_separate += time_separate
+            total_single += time_single
+            print("%-12s %-24s %9d %12.4f %12.4f %7.2fx" % (
+                name, column[:24], len(values), time_separate, time_single,
+                time_separate / time_single,
+            ))
+    print("%-12s %-24s %9s %12.4f %12.4f %7.2fx" % (
+        "total", "", "", total_separate, total_single,
+        total_separate / total_single,
+    ))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,209 @@
+"""A stand-in for the Lazo index server, for tests.
+
+It implements the gRPC protocol of the real server, keeping the index in
+memory and computing its own MinHash sketches with `lazo_sketch()`.
+It can also add a delay to each request and records how many requests were
+running at the same time, to check that clients send them concurrently.
+"""
+
+import concurrent.futures
+import contextlib
+import grpc
+from lazo_index_service import LazoIndexClient
+from lazo_index_service import lazo_index_pb2 as pb2
+from lazo_index_service.lazo_index_pb2_grpc import LazoIndexServicer, \
+    add_LazoIndexServicer_to_server
+import numpy
+import pandas
+import threading
+import time
+
+from datamart_profiler.sketches import hash_values
+
+
+# Number of permutations in MinHash sketches made by `lazo_sketch()`
+LAZO_PERMUTATIONS = 128
+
+# Seed used to draw the permutations
+LAZO_SEED = 1
+
+# Number of distinct values permuted at once, to bound memory usage
+LAZO_CHUNK_SIZE = 8192
+
+_MERSENNE_PRIME = numpy.uint64((1 << 61) - 1)
+_MAX_HASH = numpy.uint64((1 << 32) - 1)
+
+
+def _lazo_permutations(n_permutations, seed):
+    """Coefficients of the permutations ``(a * x + b) mod (2 ** 61 - 1)``.
+
+    They are drawn below ``2 ** 32`` so that, with 32-bit hashes, the
+    computation doesn't overflow 64-bit integers.
+    """
+    rand = numpy.random.RandomState(seed)
+    a = rand.randint(1, 1 << 32, n_permutations, dtype=numpy.uint64)
+    b = rand.randint(0, 1 << 32, n_permutations, dtype=numpy.uint64)
+    return a, b
+
+
+def lazo_sketch(values, n_permutations=LAZO_PERMUTATIONS, seed=LAZO_SEED):
+    """Compute the MinHash sketch of a column, in the format used by Lazo.
+
+    Values are hashed to 32 bits, each distinct hash is permuted with
+    ``n_permutations`` random linear functions, and the minimum of each
+    permutation is kept. This is not the hashing of the real Lazo server, so
+    these sketches can only be compared with each other.
+
+    :param values: list or array of strings; empty strings are ignored
+    :return: ``(n_permutations, hash_values, cardinality)``, where
+        ``cardinality`` is the number of distinct values
+    """
+    values = numpy.asarray(values, dtype=object)
+    values = values[values != '']
+    hashes = numpy.unique(hash_values(values))
+    cardinality = len(hashes)
+    hashes &= _MAX_HASH
+
+    a, b = _lazo_permutations(n_permutations, seed)
+    minimums = numpy.full(n_permutations, _MAX_HASH, dtype=numpy.uint64)
+    for start in range(0, len(hashes), LAZO_CHUNK_SIZE):
+        chunk = hashes[start:start + LAZO_CHUNK_SIZE, None]
+        permuted = ((chunk * a + b) % _MERSENNE_PRIME) & _MAX_HASH
+        numpy.minimum(minimums, permuted.min(axis=0), out=minimums)
+
+    return n_permutations, [int(h) for h in minimums], cardinality
+
+
+def _sketch_message(sketch):
+    n_permutations, hash_values, cardinality = sketch
+    return pb2.LazoSketchData(
+        number_permutations=n_permutations,
+        hash_values=hash_values,
+        cardinality=cardinality,
+    )
+
+
+class StubLazoServicer(LazoIndexServicer):
+    def __init__(self, delay=0.0):
+        self.delay = delay
+        self.index = {}  # (dataset_id, column_name) -> sketch
+        self.calls = []
+        self.running = 0
+        self.max_running = 0
+        self._lock = threading.Lock()
+
+    @contextlib.contextmanager
+    def _call(self, name):
+        with self._lock:
+            self.calls.append(name)
+            self.running += 1
+            self.max_running = max(self.max_running, self.running)
+        try:
+            time.sleep(self.delay)
+            yield
+        finally:
+            with self._lock:
+                self.running -= 1
+
+    @staticmethod
+    def _read_stream(request_iterator):
+        values = []
+        identifier = None
+        for column_value in request_iterator:
+            values.append(column_value.value)
+            identifier = column_value.column_identifier
+        return values, identifier
+
+    @staticmethod
+    def _read_path(request):
+        data = pandas.read_csv(request.path, dtype=str, na_filter=False)
+        return [
+            (identifier, lazo_sketch(data[identifier.column_name].values))
+            for identifier in request.column_identifiers
+        ]
+
+    def IndexData(self, request_iterator, context):
+        with self._call('IndexData'):
+            values, identifier = self._read_stream(request_iterator)
+            sketch = lazo_sketch(values)
+            self.index[(identifier.dataset_id, identifier.column_name)] = \
+                sketch
+            return _sketch_message(sketch)
+
+    def IndexDataPath(self, request, context):
+        with self._call('IndexDataPath'):
+            sketches = []
+            for identifier, sketch in self._read_path(request):
+                key = identifier.dataset_id, identifier.column_name
+                self.index[key] = sketch
+                sketches.append(_sketch_message(sketch))
+            return pb2.LazoSketchDataList(lazo_sketch_data=sketches)
+
+    def GetLazoSketchFromData(self, request_iterator, context):
+        with self._call('GetLazoSketchFromData'):
+            values, _ = self._read_stream(request_iterator)
+            return _sketch_message(lazo_sketch(values))
+
+    def GetLazoSketchFromDataPath(self, request, context):
+        with self._call('GetLazoSketchFromDataPath'):
+            return pb2.LazoSketchDataList(lazo_sketch_data=[
+                _sketch_message(sketch)
+                for _, sketch in self._read_path(request)
+            ])
+
+    def RemoveSketches(self, request, context):
+        with self._call('RemoveSketches'):
+            for column_name in request.column_names:
+                self.index.pop((request.dataset_id, column_name), None)
+            return pb2.Ack(ack=True)
+
+    def QueryLazoSketchData(self, request, context):
+        with self._call('QueryLazoSketchData'):
+            results = []
+            for (dataset_id, column_name), sketch in self.index.items():
+                containment = self._containment(
+                    (request.number_permutations, request.hash_values,
+                     request.cardinality),
+                    sketch,
+                )
+                if containment > 0.0:
+                    results.append(pb2.LazoQueryResult(
+                        column=pb2.ColumnIdentifier(
+                            dataset_id=dataset_id,
+                            column_name=column_name,
+                        ),
+                        max_threshold=containment,
+                    ))
+            return pb2.LazoQueryResults(query_results=results)
+
+    @staticmethod
+    def _containment(query, indexed):
+        """Estimate the containment of the query column in an indexed one.
+        """
+        _, query_hashes, query_cardinality = query
+        _, indexed_hashes, indexed_cardinality = indexed
+        if not query_cardinality or len(query_hashes) != len(indexed_hashes):
+            return 0.0
+        equal = sum(1 for q, i in zip(query_hashes, indexed_hashes) if q == i)
+        jaccard = equal / len(query_hashes)
+        intersection = (jaccard * (query_cardinality + indexed_cardinality) /
+                        (1.0 + jaccard))
+        return min(1.0, intersection / query_cardinality)
+
+
+@contextlib.contextmanager
+def run_stub_lazo_server(delay=0.0):
+    """Run a `StubLazoServicer` on a free local port.
+
+    :return: ``(servicer, client)``, a context manager; the client is a
+        regular `LazoIndexClient` connected to the stub
+    """
+    servicer = StubLazoServicer(delay)
+    server = grpc.server(concurrent.futures.ThreadPoolExecutor(max_workers=16))
+    add_LazoIndexServicer_to_server(servicer, server)
+    port = server.add_insecure_port('127.0.0.1:0')
+    server.start()
+    try:
+        yield servicer, LazoIndexClient(host='127.0.0.1', port=port)
+    finally:
+        server.stop(None)
@@ -1,6 +1,8 @@
+import time
 import unittest
+from unittest import mock
 
-from datamart_core import common
+from datamart_core import common, lrucache
 
 
 class TestDatasetIdEncoding(unittest.TestCase):
@@ -17,3 +19,43 @@ class TestDatasetIdEncoding(unittest.TestCase):
             common.decode_dataset_id('datamart__contrived_2Fdataset_23id_3B'),
             'datamart_contrived/dataset#id;',
         )
+
+
+class TestLRUCache(unittest.TestCase):
+    def test_eviction(self):
+        """Test dropping the least recently used entries."""
+        cache = lrucache.LRUCache(10)
+        cache.put('a', b'aaaa')
+        cache.put('b', b'bbbb')
+        self.assertEqual(cache.get('a'), b'aaaa')
+        cache.put('c', b'cccc')
+        self.assertEqual(cache.get('b'), None)
+        self.assertEqual(cache.get('a'), b'aaaa')
+        self.assertEqual(cache.get('c'), b'cccc')
+        self.assertEqual(cache.size, 8)
+
+        # Replacing an entry updates the size
+        cache.put('a', b'aa')
+        self.assertEqual(cache.size, 6)
+        self.assertEqual(len(cache), 2)
+
+        # Entries bigger than the cache are not stored
+        cache.put('d', b'd' * 11)
+        self.assertNotIn('d', cache)
+        self.assertEqual(len(cache), 2)
+
+        cache.clear()
+        self.assertEqual((len(cache), cache.size), (0, 0))
+
+    def test_ttl(self):
+        """Test that entries expire."""
+        cache = lrucache.LRUCache(10, ttl=60)
+        with mock.patch.object(time, 'monotonic', return_value=1000.0):
+            cache.put('a', b'aaaa')
+        with mock.patch.object(time, 'monotonic', return_value=1059.0):
+            cache.put('b', b'bbbb')
+            self.assertEqual(cache.get('a'), b'aaaa')
+        with mock.patch.object(time, 'monotonic', return_value=1061.0):
+            self.assertEqual(cache.get('a'), None)
+            self.assertEqual(cache.get('b'), b'bbbb')
+            self.assertEqual((len(cache), cache.size), (1, 4))
@@ -124,7 +124,8 @@ class TestProfileQuery(DatamartTest):
             )
         metadata = {k: v for k, v in basic_metadata.items()
                     if k not in {'name', 'description', 'source',
-                                 'date', 'materialize'}}
+                                 'date', 'materialize',
+                                 'column_fingerprints'}}
         metadata = dict(
             metadata,
             lazo=lambda lazo: (
@@ -336,6 +337,53 @@ class TestDataSearch(DatamartTest):
             ]
         )
 
+    def test_basic_join_tabular_variables(self):
+        """Test that profiling only some columns gives the same matches."""
+        def search(query=None):
+            files = {'data': basic_aug_data.encode('utf-8')}
+            if query is not None:
+                files['query'] = json.dumps(query).encode('utf-8')
+            response = self.datamart_post(
+                '/search',
+                files=files,
+                schema=result_list_schema,
+            )
+            return [
+                (result['id'], result['augmentation'])
+                for result in response.json()['results']
+            ]
+
+        query = {
+            'variables': [
+                {
+                    'type': 'tabular_variable',
+                    'columns': [0],
+                    'relationship': 'contains',
+                },
+            ],
+        }
+        # Partial profile first, then the full profile, which the next
+        # searches can use in its place
+        partial = search(query)
+        full = search()
+        self.assertEqual(partial, full)
+        self.assertEqual(search(query), full)
+        self.assertEqual(
+            full,
+            [
+                (
+                    'datamart.test.basic',
+                    {
+                        'left_columns': [[0]],
+                        'left_columns_names': [['number']],
+                        'right_columns': [[2]],
+                        'right_columns_names': [['number']],
+                        'type': 'join'
+                    },
+                ),
+            ],
+        )
+
     def test_basic_join_only_profile(self):
         response = self.datamart_post(
             '/profile',
@@ -1606,6 +1654,16 @@ def check_ranges(min_, max_):
     return check
 
 
+def check_fingerprints(nb_columns):
+    def check(fingerprints):
+        assert len(fingerprints) == nb_columns
+        assert all(re.match(r'^[0-9a-f]{40}$', fp) for fp in fingerprints)
+
+        return True
+
+    return check
+
+
 def check_geo_ranges(min_long, min_lat, max_long, max_lat):
     def check(ranges):
         assert len(ranges) == 3
@@ -1634,6 +1692,7 @@ basic_metadata = {
     "size": 425,
     "nb_rows": 20,
     "nb_profiled_rows": 20,
+    "column_fingerprints": check_fingerprints(4),
     "columns": [
         {
             "name": "name",
@@ -1764,6 +1823,7 @@ agg_metadata = {
     "size": 116,
     "nb_rows": 8,
     "nb_profiled_rows": 8,
+    "column_fingerprints": check_fingerprints(3),
     "columns": [
         {
             "name": "id",
@@ -1854,6 +1914,7 @@ geo_metadata = {
     "size": 3910,
     "nb_rows": 100,
     "nb_profiled_rows": 100,
+    "column_fingerprints": check_fingerprints(4),
     "columns": [
         {
             "name": "id",
@@ -1972,6 +2033,7 @@ lazo_metadata = {
     "size": 297,
     "nb_rows": 36,
     "nb_profiled_rows": 36,
+    "column_fingerprints": check_fingerprints(2),
     "columns": [
         {
             "name": "state",
@@ -2025,6 +2087,7 @@ daily_metadata = {
     'size': 448,
     'nb_rows': 30,
     "nb_profiled_rows": 30,
+    "column_fingerprints": check_fingerprints(2),
     'columns': [
         {
             'name': 'aug_date',
@@ -2093,6 +2156,7 @@ hourly_metadata = {
     'size': 1242,
     'nb_rows': 52,
     "nb_profiled_rows": 52,
+    "column_fingerprints": check_fingerprints(2),
     'columns': [
         {
             'name': 'aug_date',
@@ -1,11 +1,35 @@
 from datetime import datetime
 from dateutil.tz import UTC
+import io
+import numpy
+import os
+import pandas
 import unittest
-from unittest.mock import call, patch
+from unittest.mock import MagicMock, call, patch
 
+import datamart_profiler
 from datamart_profiler import pair_latlong_columns, \
-    normalize_latlong_column_name
-from datamart_profiler import profile_types
+    normalize_latlong_column_name, process_dataset, get_numerical_ranges, \
+    get_spatial_ranges, read_sample
+from datamart_profiler import lazo, mean_stddev, profile_types, readers, \
+    types
+from datamart_profiler.profile_types import identify_types, parse_numbers
+from datamart_profiler.sketches import HyperLogLog
+from datamart_profiler.streaming import RowReservoir, read_streaming
+
+from .lazo_stub import run_stub_lazo_server
+
+
+data_dir = os.path.join(os.path.dirname(__file__), 'data')
+
+
+def load_test_data():
+    """Load all the CSV files from tests/data, as the profiler would.
+    """
+    for name in sorted(os.listdir(data_dir)):
+        if name.endswith('.csv'):
+            yield name, pandas.read_csv(os.path.join(data_dir, name),
+                                        dtype=str, na_filter=False)
 
 
 class TestLatlongSelection(unittest.TestCase):
@@ -79,6 +103,44 @@ class TestDates(unittest.TestCase):
             datetime(2019, 7, 3, 1, 13, 19, tzinfo=UTC),
         )
 
+    def check_parse_dates(self, array):
+        expected = [profile_types.parse_date(e) for e in array]
+        self.assertEqual(
+            profile_types.parse_dates(array),
+            [dt for dt in expected if dt is not None],
+        )
+
+    def test_parse_column(self):
+        """Test parsing a whole column of dates."""
+        values = [
+            '2019-07-02', '7/2/2019', '12:30', '2019-07-02T21:13:19Z',
+            '2019-07-02T21:13:19-04:00', 'Monday July 1, 2019', '',
+            '20190702T211319Z', 'hello', '2019-7-2', '1600-01-01',
+            '2019-07-02 21:13:19.123', '13/01/2019', '10:00 PM',
+            '07/02/2019 09:30 PM', '2019-07-02 21:13:19.123456',
+        ]
+        self.check_parse_dates(values)
+        self.check_parse_dates(values[::-1] * 3)
+        self.check_parse_dates(
+            ['2019-07-%02d %02d:00:00' % (d, h)
+             for d in range(1, 31) for h in range(24)] + values
+        )
+
+    def test_parse_data(self):
+        """Test parsing the test data as dates."""
+        for name, data in load_test_data():
+            for column in data.columns:
+                self.check_parse_dates(data[column])
+
+    def test_infer_formats(self):
+        """Test inferring date formats from the start of a column."""
+        self.assertEqual(
+            profile_types._infer_date_formats(
+                ['2019-07-02', '7/2/2019', '12:30', '2019-07-03', 'hello'],
+            ),
+            ['%Y-%m-%d', '%m/%d/%Y'],
+        )
+
 
 class TestTypes(unittest.TestCase):
     def do_test(self, match, positive, negative):
@@ -174,6 +236,831 @@ class TestTypes(unittest.TestCase):
         self.assertFalse(profile_types._re_float.match(''))
 
 
+def count_types_reference(array, phone=True):
+    """Per-element version of `profile_types._count_types()`.
+    """
+    num_float = num_int = num_bool = num_empty = num_text = num_phone = 0
+    for elem in array:
+        if not elem:
+            num_empty += 1
+        elif profile_types._re_int.match(elem):
+            num_int += 1
+        elif profile_types._re_float.match(elem):
+            num_float += 1
+        elif len(profile_types._re_whitespace.findall(elem)) >= 4:
+            num_text += 1
+        if elem.lower() in ('0', '1', 'true', 'false', 'y', 'n', 'yes', 'no'):
+            num_bool += 1
+        if profile_types._re_phone.match(elem) is not None:
+            num_phone += 1
+    return {
+        'empty': num_empty,
+        'int': num_int,
+        'float': num_float,
+        'text': num_text,
+        'bool': num_bool,
+        'phone': num_phone,
+    }, None
+
+
+class TestTypeCounts(unittest.TestCase):
+    TRICKY = [
+        '', ' ', '12', '+478', '12\n', '4.0', '7.000', '12.', '.7', '-.4e17',
+        '8e17', '1.7.3', 'yes', 'No', 'TRUE', 'y', 'N', 'false ', '0', '1',
+        'a b c d e', 'a\tb\nc d e', 'a b c d', '+1 347 123 4567',
+        '(347)123-4567', '06 12 34 56 78', '-3471234567', 'Y\u0130', '\u017f',
+        'caf\u00e9', '2019-07-02',
+    ]
+
+    def check_parity(self, array):
+        self.assertEqual(
+            profile_types._count_types(array)[0],
+            count_types_reference(array)[0],
+        )
+
+    def test_tricky(self):
+        """Test counting types on edge-case values."""
+        self.check_parity(pandas.Series(self.TRICKY))
+        self.check_parity(self.TRICKY * 50)
+
+    def test_classify_cells(self):
+        """Test the single-pass classifier against the separate checks."""
+        rand = numpy.random.RandomState(1)
+        alphabet = list('0123456789 .-+()eEyYesSnNoOtTrRuUfFaAlL\t\n')
+        values = self.TRICKY[1:] + ['yes\n', 'fAlSe', '\u212a', '0\n'] + [
+            ''.join(rand.choice(alphabet, rand.randint(1, 15)))
+            for _ in range(5000)
+        ]
+        codes = profile_types.classify_cells(values)
+        for value, code in zip(values, codes):
+            kind = code & profile_types.CELL_KIND
+            self.assertEqual(
+                {
+                    'empty': 0,
+                    'int': int(kind == profile_types.CELL_INT),
+                    'float': int(kind == profile_types.CELL_FLOAT),
+                    'text': int(kind == profile_types.CELL_TEXT),
+                    'bool': int(bool(code & profile_types.CELL_BOOL)),
+                    'phone': int(bool(code & profile_types.CELL_PHONE)),
+                },
+                count_types_reference([value])[0],
+                repr(value),
+            )
+
+    def test_high_cardinality(self):
+        """Test counting types when the column is not de-duplicated."""
+        array = pandas.Series(['%d' % i for i in range(3000)] + self.TRICKY)
+        self.assertIsNone(profile_types._distinct_values(array)[1])
+        self.check_parity(array)
+
+    def test_categorical_threshold(self):
+        """Test the categorical check on columns that are not de-duplicated."""
+        # Clearly too many distinct values: estimated, no set is built
+        array = pandas.Series(['v%d' % i for i in range(20000)] * 2)
+        with patch.object(profile_types, 'set',
+                          side_effect=AssertionError("set built"),
+                          create=True):
+            structural_type, semantic_types_dict, column_meta = \
+                profile_types.identify_types(array, 'values')
+        self.assertEqual(structural_type, types.TEXT)
+        self.assertNotIn(types.CATEGORICAL, semantic_types_dict)
+        self.assertLessEqual(
+            abs(column_meta['num_distinct_values'] - 20000),
+            1000,
+        )
+
+        # Categorical, but the start of the column looks diverse
+        array = pandas.Series(
+            ['v%d' % i for i in range(900)] + ['a', 'b', 'c'] * 3000,
+        )
+        structural_type, semantic_types_dict, column_meta = \
+            profile_types.identify_types(array, 'values')
+        self.assertEqual(column_meta['num_distinct_values'], 903)
+        self.assertEqual(len(semantic_types_dict[types.CATEGORICAL]), 903)
+
+    def test_data(self):
+        """Test that identify_types() gives the same results as before."""
+        for name, data in load_test_data():
+            for column in data.columns:
+                array = data[column]
+                self.check_parity(array)
+                with patch.object(profile_types, '_count_types',
+                                  count_types_reference):
+                    expected = profile_types.identify_types(array, column)
+                self.assertEqual(
+                    profile_types.identify_types(array, column),
+                    expected,
+                    "%s: %s" % (name, column),
+                )
+
+    def test_numbers(self):
+        """Test parsing numbers, for all values or with some missing."""
+        self.assertEqual(
+            profile_types.parse_numbers(['12', '-4.5', ' 7 ']).tolist(),
+            [12.0, -4.5, 7.0],
+        )
+        numbers = profile_types.parse_numbers(['12', 'a', '', '1e3', 'a'])
+        self.assertEqual(numbers[[0, 3]].tolist(), [12.0, 1000.0])
+        self.assertTrue(numpy.isnan(numbers[[1, 2, 4]]).all())
+
+    def test_latlong(self):
+        """Test that lat/long types have no payload, as before."""
+        array = pandas.Series(['40.7', '41.2', '', '39.9'])
+        structural_type, semantic_types_dict, column_meta = \
+            identify_types(array, 'latitude')
+        self.assertEqual(structural_type, types.FLOAT)
+        self.assertEqual(semantic_types_dict, {types.LATITUDE: None})
+
+        # The parsed values are only returned by the private function
+        *_, numerical_values = profile_types._identify_types(array,
+                                                             'latitude')
+        self.assertEqual(numerical_values[[0, 1, 3]].tolist(),
+                         [40.7, 41.2, 39.9])
+        self.assertIsNone(profile_types._identify_types(array, 'value')[3])
+
+
+class TestProgressive(unittest.TestCase):
+    def dates(self, nb_rows, nb_invalid):
+        """Column of dates, with some invalid values spread out."""
+        dates = pandas.date_range('2000-01-01', periods=nb_rows, freq='h')
+        array = pandas.Series(dates.strftime('%Y-%m-%d %H:%M:%S'))
+        step = nb_rows // nb_invalid
+        array.iloc[::step] = 'n/a'
+        return array
+
+    def test_bound(self):
+        """Test the confidence bound on the proportion of matches."""
+        self.assertLess(profile_types._proportion_upper_bound(0, 1000), 0.03)
+        self.assertLess(profile_types._proportion_upper_bound(900, 1000),
+                        0.98)
+        self.assertGreater(profile_types._proportion_upper_bound(970, 1000),
+                           0.98)
+
+    def test_stop_early(self):
+        """Test that the checks stop early on a column that is not dates."""
+        array = pandas.Series(['value %d' % i for i in range(20000)])
+        with patch.object(profile_types, 'parse_dates',
+                          wraps=profile_types.parse_dates) as parse_dates:
+            structural_type, semantic_types_dict, _ = \
+                profile_types.identify_types(array, 'values')
+        self.assertEqual(structural_type, types.TEXT)
+        self.assertEqual(semantic_types_dict, {})
+        checked = sum(len(c[0][0]) for c in parse_dates.call_args_list)
+        self.assertEqual(checked, profile_types.PROGRESSIVE_SAMPLE)
+
+    def test_borderline(self):
+        """Test that borderline columns are checked fully."""
+        # 2.5% invalid values: not dates, but only a full scan can tell
+        array = self.dates(20000, 500)
+        with patch.object(profile_types, 'parse_dates',
+                          wraps=profile_types.parse_dates) as parse_dates:
+            _, semantic_types_dict, _ = \
+                profile_types.identify_types(array, 'when')
+        self.assertNotIn(types.DATE_TIME, semantic_types_dict)
+        self.assertIs(parse_dates.call_args_list[-1][0][0], array)
+
+        # 1% invalid values: dates
+        array = self.dates(20000, 200)
+        _, semantic_types_dict, _ = \
+            profile_types.identify_types(array, 'when')
+        self.assertEqual(len(semantic_types_dict[types.DATE_TIME]), 19800)
+
+    def test_phone(self):
+        """Test the progressive phone number check."""
+        array = pandas.Series(['+1 347 123 %04d' % i for i in range(10000)])
+        _, semantic_types_dict, _ = \
+            profile_types.identify_types(array, 'phone')
+        self.assertIn(types.PHONE_NUMBER, semantic_types_dict)
+
+        array = pandas.Series(['+1 347 123 %04d' % i for i in range(9000)] +
+                              ['not a phone'] * 1000)
+        with patch.object(profile_types, '_count_types',
+                          wraps=profile_types._count_types) as count_types:
+            _, semantic_types_dict, _ = \
+                profile_types.identify_types(array, 'phone')
+        self.assertNotIn(types.PHONE_NUMBER, semantic_types_dict)
+        self.assertEqual(count_types.call_args[1], {'phone': False})
+
+
+class TestRanges(unittest.TestCase):
+    def test_kmeans1d(self):
+        """Test computing numerical ranges with K-Means on sorted values."""
+        self.assertEqual(
+            get_numerical_ranges([1000, 3, 2, 101, 1, 100], method='kmeans1d'),
+            [
+                {'range': {'gte': 1.0, 'lte': 3.0}},
+                {'range': {'gte': 100.0, 'lte': 101.0}},
+                {'range': {'gte': 1000.0, 'lte': 1000.0}},
+            ],
+        )
+        self.assertEqual(
+            get_numerical_ranges([4, 4, 4, 7, 7], method='kmeans1d'),
+            [
+                {'range': {'gte': 4.0, 'lte': 4.0}},
+                {'range': {'gte': 7.0, 'lte': 7.0}},
+            ],
+        )
+        self.assertEqual(
+            get_numerical_ranges([5, 5, 5], method='kmeans1d'),
+            [{'range': {'gte': 5.0, 'lte': 5.0}}],
+        )
+        self.assertEqual(get_numerical_ranges([], method='kmeans1d'), [])
+
+    def test_methods_agree(self):
+        """Test that both methods find well-separated clusters."""
+        values = ([10.0 + i * 0.1 for i in range(100)] +
+                  [50.0 + i * 0.1 for i in range(100)] +
+                  [90.0 + i * 0.1 for i in range(100)])
+
+        def key(rg):
+            return rg['range']['gte']
+
+        self.assertEqual(
+            sorted(get_numerical_ranges(values, method='kmeans'), key=key),
+            get_numerical_ranges(values, method='kmeans1d'),
+        )
+
+    def test_unknown(self):
+        with self.assertRaises(ValueError):
+            get_numerical_ranges([1, 2], method='spline')
+
+    def test_spatial_subsample(self):
+        """Test fitting the spatial clustering on a subsample."""
+        rand = numpy.random.RandomState(1)
+        points = numpy.concatenate([
+            rand.normal(center, 0.01, (300, 2))
+            for center in [(40.7, -74.0), (34.0, -118.2), (41.9, -87.6)]
+        ])
+
+        def key(rg):
+            return rg['range']['coordinates']
+
+        full = sorted(get_spatial_ranges(points), key=key)
+        self.assertEqual(len(full), 3)
+        self.assertEqual(
+            sorted(get_spatial_ranges(points.tolist()), key=key),
+            full,
+        )
+        # Clusters are well-separated, boxes are computed over all points
+        self.assertEqual(
+            sorted(get_spatial_ranges(points, max_clustering_points=30),
+                   key=key),
+            full,
+        )
+
+
+class TestSketches(unittest.TestCase):
+    def test_estimate(self):
+        """Test estimating the number of distinct values."""
+        for count in (10, 1000, 50000):
+            sketch = HyperLogLog()
+            sketch.update(['value %d' % i for i in range(count)] * 2)
+            self.assertLessEqual(abs(sketch.estimate() - count),
+                                 3 * sketch.relative_error * count + 1)
+
+    def test_merge(self):
+        """Test merging sketches of overlapping sets of values."""
+        first = HyperLogLog()
+        first.update(['%d' % i for i in range(0, 6000)])
+        second = HyperLogLog()
+        second.update(['%d' % i for i in range(4000, 10000)])
+        whole = HyperLogLog()
+        whole.update(['%d' % i for i in range(0, 10000)])
+        first.merge(second)
+        self.assertEqual(first.estimate(), whole.estimate())
+        with self.assertRaises(ValueError):
+            first.merge(HyperLogLog(10))
+
+
+class TestProcess(unittest.TestCase):
+    def test_geo(self):
+        """Test statistics and spatial coverage of numerical columns."""
+        metadata = process_dataset(os.path.join(data_dir, 'geo.csv'))
+        lat, long, height = metadata['columns'][1:]
+        self.assertEqual(round(lat['mean'], 3), 40.711)
+        self.assertEqual(round(lat['stddev'], 4), 0.0186)
+        self.assertEqual(round(long['mean'], 3), -73.993)
+        self.assertEqual(round(long['stddev'], 5), 0.00684)
+        self.assertEqual(round(height['mean'], 3), 47.827)
+        self.assertEqual(round(height['stddev'], 2), 21.28)
+        self.assertEqual(len(height['coverage']), 3)
+        self.assertNotIn('coverage', lat)
+        [spatial] = metadata['spatial_coverage']
+        self.assertEqual((spatial['lat'], spatial['lon']), ('lat', 'long'))
+        self.assertEqual(len(spatial['ranges']), 3)
+
+    def test_temporal(self):
+        """Test statistics of date columns."""
+        metadata = process_dataset(os.path.join(data_dir, 'hourly.csv'))
+        column = metadata['columns'][0]
+        self.assertEqual(round(column['mean']), 1560389398.0)
+        self.assertEqual(round(column['stddev'], 2), 54027.44)
+        self.assertEqual(len(column['coverage']), 3)
+
+    def test_ranges_method(self):
+        """Test selecting the ranges method."""
+        metadata = process_dataset(os.path.join(data_dir, 'geo.csv'),
+                                   ranges_method='kmeans1d')
+        height = metadata['columns'][3]
+        self.assertEqual(round(height['mean'], 3), 47.827)
+        self.assertEqual(len(height['coverage']), 3)
+        for rg in height['coverage']:
+            self.assertTrue(1.0 <= rg['range']['gte'] <=
+                            rg['range']['lte'] <= 90.0)
+
+    def test_parallel(self):
+        """Test that profiling columns in parallel gives the same results."""
+        for name in sorted(os.listdir(data_dir)):
+            if not name.endswith('.csv'):
+                continue
+            with self.subTest(name=name):
+                path = os.path.join(data_dir, name)
+                self.assertEqual(
+                    process_dataset(path, max_workers=2),
+                    process_dataset(path),
+                )
+
+    def test_debug(self):
+        """Test recording the time and memory used by each stage."""
+        path = os.path.join(data_dir, 'hourly.csv')
+        metadata = process_dataset(path, debug=True)
+        debug = metadata.pop('debug')
+        self.assertEqual(metadata, process_dataset(path))
+        self.assertEqual(set(debug['stages']),
+                         {'load', 'types', 'spatial', 'sample'})
+        self.assertEqual([col['name'] for col in debug['columns']],
+                         ['aug_date', 'rain'])
+        self.assertEqual(set(debug['columns'][0]['stages']),
+                         {'identify_types', 'temporal_ranges'})
+        for record in debug['stages'].values():
+            self.assertEqual(set(record), {'wall_time', 'cpu_time', 'memory'})
+            self.assertGreaterEqual(record['wall_time'], 0)
+            self.assertGreaterEqual(record['memory'], 0)
+
+        # Column stages come back from worker processes
+        debug = process_dataset(path, debug=True, max_workers=2)['debug']
+        self.assertEqual(set(debug['columns'][0]['stages']),
+                         {'identify_types', 'temporal_ranges'})
+        self.assertIn('memory',
+                      debug['columns'][0]['stages']['identify_types'])
+
+    @unittest.skipIf(datamart_profiler.shared_memory is None,
+                     "shared memory needs Python 3.8+")
+    def test_parallel_shared_memory(self):
+        """Test the shared memory used by parallel profiling."""
+        shared_memory = datamart_profiler.shared_memory
+        values = pandas.Series(['a', '', 'h\xe9llo', '日本', 'z'])
+        shm = datamart_profiler._share_column(values)
+        try:
+            self.assertEqual(
+                datamart_profiler._read_shared_column(shm.name, 5).tolist(),
+                values.tolist(),
+            )
+        finally:
+            shm.close()
+            shm.unlink()
+
+        # Only a few columns are in shared memory at a time, and they are
+        # freed after
+        share_column = datamart_profiler._share_column
+        names = []
+        live = []
+
+        def wrapped(array):
+            shm = share_column(array)
+            names.append(shm.name)
+            live.append(sum(1 for name in names if exists(name)))
+            return shm
+
+        def exists(name):
+            try:
+                shared_memory.SharedMemory(name=name).close()
+            except FileNotFoundError:
+                return False
+            return True
+
+        path = os.path.join(data_dir, 'geo.csv')
+        with patch('datamart_profiler._share_column', wrapped):
+            process_dataset(path, max_workers=2)
+        self.assertEqual(len(names), 4)
+        self.assertLessEqual(max(live), 2)
+        self.assertFalse(any(exists(name) for name in names))
+
+    def test_parallel_no_shared_memory(self):
+        """Test parallel profiling without shared memory."""
+        path = os.path.join(data_dir, 'geo.csv')
+        with patch('datamart_profiler.shared_memory', None):
+            self.assertEqual(
+                process_dataset(path, max_workers=2),
+                process_dataset(path),
+            )
+
+
+@unittest.skipIf(readers.pyarrow is None, "pyarrow is not installed")
+class TestArrowReader(unittest.TestCase):
+    def check_same(self, data):
+        expected = readers.read_csv(io.BytesIO(data))
+        result = readers.read_csv(io.BytesIO(data), 'arrow')
+        self.assertEqual(list(result.columns), list(expected.columns))
+        self.assertEqual(result.values.tolist(), expected.values.tolist())
+
+    def test_read(self):
+        """Test that the arrow reader loads the same strings as pandas."""
+        for name in sorted(os.listdir(data_dir)):
+            if name.endswith('.csv'):
+                with open(os.path.join(data_dir, name), 'rb') as fp:
+                    data = fp.read()
+                with self.subTest(name=name):
+                    self.check_same(data)
+
+    def test_tricky(self):
+        """Test reading headers and values that need care."""
+        # BOM, duplicate and missing names, empty column, blank line
+        self.check_same(b'\xef\xbb\xbfa,a,,b\n1,2,3,\n\n"x\ny",,,\n')
+        # Line break in a name, CRLF line endings
+        self.check_same(b'"x\ny",b\r\n1,2\r\n3,"4"\r\n')
+        # Values that look like numbers are kept as written
+        self.check_same(b'id,value\n007,1.50\n,1e3\n')
+        # Ragged rows, padded with empty strings
+        self.check_same(b'a,b,c\n1,2\n3,4,5\n6\n')
+
+    def test_process(self):
+        """Test that profiling with the arrow reader gives the same results."""
+        for name in sorted(os.listdir(data_dir)):
+            if not name.endswith('.csv'):
+                continue
+            with self.subTest(name=name):
+                path = os.path.join(data_dir, name)
+                self.assertEqual(
+                    process_dataset(path, reader='arrow'),
+                    process_dataset(path),
+                )
+
+    def test_sample(self):
+        """Test sampling a file with the arrow reader."""
+        data = TestSample.make_csv(20000)
+        expected = process_dataset(io.BytesIO(data), sample_size=100000,
+                                   coverage=False)
+        self.assertEqual(
+            process_dataset(io.BytesIO(data), sample_size=100000,
+                            coverage=False, reader='arrow'),
+            expected,
+        )
+
+    def test_unknown(self):
+        """Test selecting an unknown reader."""
+        with self.assertRaises(ValueError):
+            readers.read_csv(io.BytesIO(b'a,b\n1,2\n'), 'csv')
+
+
+class TestIncremental(unittest.TestCase):
+    def load(self, name):
+        return pandas.read_csv(os.path.join(data_dir, name),
+                               dtype=str, na_filter=False)
+
+    def test_fingerprints(self):
+        """Test that fingerprints change with the content of columns."""
+        data = self.load('basic.csv')
+        metadata = process_dataset(data, fingerprints=True)
+        fingerprints = metadata.pop('column_fingerprints')
+        self.assertEqual(len(set(fingerprints)), 4)
+        self.assertEqual(metadata, process_dataset(data))
+
+        data.loc[3, 'number'] = '8'
+        data = data.rename(columns={'what': 'whatever'})
+        new = process_dataset(data, fingerprints=True)['column_fingerprints']
+        self.assertEqual(
+            [a == b for a, b in zip(fingerprints, new)],
+            [True, True, False, False],
+        )
+
+    def check_incremental(self, name, change_column, expected_processed):
+        data = self.load(name)
+        previous = process_dataset(data, fingerprints=True)
+
+        data.iloc[:5, change_column] = data.iloc[5:10, change_column].values
+        expected = process_dataset(data.copy(), fingerprints=True)
+
+        with patch('datamart_profiler._process_column',
+                   wraps=datamart_profiler._process_column) as process:
+            metadata = process_dataset(data.copy(), fingerprints=True,
+                                       previous_metadata=previous)
+        self.assertEqual(
+            [c[0][1]['name'] for c in process.call_args_list],
+            expected_processed,
+        )
+        self.assertEqual(metadata, expected)
+
+    def test_reuse(self):
+        """Test re-profiling a dataset with a changed column."""
+        self.check_incremental('basic.csv', 2, ['number'])
+
+    def test_reuse_spatial(self):
+        """Test that spatial coverage is computed from re-used columns."""
+        self.check_incremental('geo.csv', 3, ['height'])
+
+    def test_reuse_lazo(self):
+        """Test that only changed textual columns are sent to Lazo."""
+        data = self.load('basic.csv')
+        previous = process_dataset(data, fingerprints=True)
+
+        data.loc[0, 'name'] = 'jim'
+        lazo_client = MagicMock()
+        process_dataset(data, dataset_id='test', lazo_client=lazo_client,
+                        fingerprints=True, previous_metadata=previous)
+        self.assertEqual(
+            [c[0][2] for c in lazo_client.index_data.call_args_list],
+            ['name'],
+        )
+
+    def test_profile_columns(self):
+        """Test profiling only some of the columns and features."""
+        data = self.load('geo.csv')
+        full = process_dataset(data)
+        metadata = process_dataset(
+            data,
+            profile_columns=[1, 2, 7],
+            features=['coverage', 'spatial_coverage'],
+        )
+        self.assertEqual(
+            metadata['columns'],
+            [{'name': 'id'}, full['columns'][1], full['columns'][2],
+             {'name': 'height'}],
+        )
+        self.assertEqual(metadata['spatial_coverage'],
+                         full['spatial_coverage'])
+        self.assertNotIn('sample', metadata)
+
+        with self.assertRaises(ValueError):
+            process_dataset(data, features=['coverage', 'colour'])
+
+
+class TestLazo(unittest.TestCase):
+    def load(self):
+        return pandas.read_csv(os.path.join(data_dir, 'basic.csv'),
+                               dtype=str, na_filter=False)
+
+    def test_index(self):
+        """Test indexing all the textual columns concurrently."""
+        data = self.load()
+        with run_stub_lazo_server(delay=0.2) as (server, client):
+            process_dataset(data, dataset_id='basic', lazo_client=client)
+        self.assertEqual(server.calls, ['IndexData'] * 3)
+        self.assertEqual(server.max_running, 3)
+        self.assertEqual(
+            set(server.index),
+            {('basic', 'name'), ('basic', 'country'), ('basic', 'what')},
+        )
+
+    def test_index_path(self):
+        """Test indexing all the columns in one request, from the path."""
+        path = os.path.join(data_dir, 'basic.csv')
+        with run_stub_lazo_server() as (server, client):
+            process_dataset(path, dataset_id='basic', lazo_client=client)
+        self.assertEqual(server.calls, ['IndexDataPath'])
+        self.assertEqual(len(server.index), 3)
+
+    def test_search(self):
+        """Test getting sketches for the search, and querying with them."""
+        data = self.load()
+        with run_stub_lazo_server(delay=0.2) as (server, client):
+            process_dataset(data, dataset_id='basic', lazo_client=client)
+            metadata = process_dataset(data, lazo_client=client, search=True)
+            self.assertEqual(server.calls[3:],
+                             ['GetLazoSketchFromData'] * 3)
+            self.assertEqual(server.max_running, 3)
+
+            sketches = [
+                (c['n_permutations'], c['hash_values'], c['cardinality'])
+                for c in metadata['lazo']
+            ]
+            results = lazo.query_sketches(client, sketches)
+        self.assertEqual(server.calls[6:], ['QueryLazoSketchData'] * 3)
+        self.assertEqual(
+            [sorted(r for r in result if r[2] > 0.99) for result in results],
+            [[('basic', 'name', 1.0)], [('basic', 'country', 1.0)],
+             [('basic', 'what', 1.0)]],
+        )
+
+    def test_sequential(self):
+        """Test sending requests one at a time."""
+        with run_stub_lazo_server(delay=0.05) as (server, client):
+            lazo.index_columns(client, self.load(), 'basic',
+                               ['name', 'country'], max_workers=1)
+        self.assertEqual(server.max_running, 1)
+        self.assertEqual(len(server.index), 2)
+
+
+class TestStreaming(unittest.TestCase):
+    def test_same_results(self):
+        """Test that streaming gives the same results on small files."""
+        for name, _ in load_test_data():
+            with self.subTest(name=name):
+                path = os.path.join(data_dir, name)
+                self.assertEqual(
+                    process_dataset(path, streaming=True),
+                    process_dataset(path),
+                )
+
+    def test_chunks(self):
+        """Test accumulating statistics over multiple chunks."""
+        for name, data in load_test_data():
+            with self.subTest(name=name):
+                path = os.path.join(data_dir, name)
+                accumulators, sample, nb_rows = read_streaming(
+                    path, 0, chunk_rows=7, reservoir_rows=10,
+                )
+                self.assertEqual(nb_rows, data.shape[0])
+                self.assertEqual(sample.shape,
+                                 (min(10, data.shape[0]), data.shape[1]))
+                for i, acc in enumerate(accumulators):
+                    array = data.iloc[:, i]
+                    expected = identify_types(array, acc.name)
+                    structural_type, semantic_types, column_meta, _ = \
+                        acc.identify_types(sample.iloc[:, i])
+                    self.assertEqual(structural_type, expected[0])
+                    self.assertEqual(set(semantic_types), set(expected[1]))
+                    self.assertEqual(column_meta, expected[2])
+                    if structural_type in (types.INTEGER, types.FLOAT):
+                        numbers = parse_numbers(array)
+                        numpy.testing.assert_allclose(
+                            acc.numbers.mean_stddev(),
+                            mean_stddev(numbers),
+                        )
+
+    def test_reservoir(self):
+        """Test that the sample of rows is uniform and in order."""
+        data = pandas.DataFrame({'a': [str(i) for i in range(1000)]})
+        reservoir = RowReservoir(100)
+        rand = numpy.random.RandomState(0)
+        for start in range(0, 1000, 30):
+            reservoir.update(data.iloc[start:start + 30], start, rand)
+        sample = reservoir.get_data()['a'].astype(int)
+        self.assertEqual(len(sample), 100)
+        self.assertTrue((numpy.diff(sample) > 0).all())
+        self.assertTrue(300 < sample.mean() < 700)
+
+    def test_process(self):
+        """Test profiling a file in many chunks, bigger than the sample."""
+        data = self.make_data(5000)
+        with patch('datamart_profiler.streaming.CHUNK_ROWS', 600), \
+                patch('datamart_profiler.streaming.RESERVOIR_ROWS', 500):
+            metadata = process_dataset(io.BytesIO(data), streaming=True)
+        self.assertEqual(metadata['nb_rows'], 5000)
+        self.assertEqual(metadata['nb_profiled_rows'], 5000)
+        self.assertNotIn('nb_rows_estimated', metadata)
+        expected = process_dataset(io.BytesIO(data))
+        for column, expected_column in zip(metadata['columns'],
+                                           expected['columns']):
+            self.assertEqual(column.pop('coverage', None) is None,
+                             expected_column.pop('coverage', None) is None)
+            self.assertAlmostEqual(column.pop('mean', 0),
+                                   expected_column.pop('mean', 0), places=5)
+            self.assertAlmostEqual(column.pop('stddev', 0),
+                                   expected_column.pop('stddev', 0),
+                                   places=5)
+            # High-cardinality columns only get an estimate
+            num_distinct = column.pop('num_distinct_values', 0)
+            expected_distinct = expected_column.pop('num_distinct_values', 0)
+            self.assertLessEqual(abs(num_distinct - expected_distinct),
+                                 0.05 * expected_distinct)
+            self.assertEqual(column, expected_column)
+        self.assertEqual(len(metadata['spatial_coverage'][0]['ranges']), 3)
+
+    def make_data(self, nb_rows):
+        rand = numpy.random.RandomState(1)
+        lines = ['id,lat,long,category,when,notes']
+        for i in range(nb_rows):
+            lines.append('%d,%.5f,%.5f,%s,%s,%s' % (
+                i,
+                40.7 + rand.normal(0, 0.01),
+                -74.0 + rand.normal(0, 0.01),
+                'abc'[i % 3],
+                '2020-01-%02d' % (1 + i % 28),
+                'note %d' % i if i % 5 else '',
+            ))
+        return ('\n'.join(lines) + '\n').encode('ascii')
+
+
+class TestSample(unittest.TestCase):
+    @staticmethod
+    def make_csv(nb_rows, trailing_newline=True):
+        lines = ['id,name,value']
+        for i in range(nb_rows):
+            if i % 100 == 7:
+                name = '"multi\nline, %d"' % i
+            else:
+                name = 'name %d' % i
+            lines.append('%d,%s,%d' % (i, name, i * 3))
+        data = '\n'.join(lines)
+        if trailing_newline:
+            data += '\n'
+        return data.encode('ascii')
+
+    def test_sample(self):
+        """Test sampling random blocks from a file."""
+        data = self.make_csv(100000)
+        sample, nb_rows = read_sample(io.BytesIO(data), len(data), 200000)
+        self.assertEqual(list(sample.columns), ['id', 'name', 'value'])
+        self.assertTrue(5000 < sample.shape[0] < 20000)
+        self.assertLess(abs(nb_rows - 100000), 5000)
+        # Rows are complete and not duplicated
+        ids = sample['id'].astype(int)
+        self.assertEqual(len(set(ids)), len(ids))
+        self.assertTrue(
+            (sample['value'].astype(int) == ids * 3).all()
+        )
+        # Deterministic
+        sample2, nb_rows2 = read_sample(io.BytesIO(data), len(data), 200000)
+        self.assertEqual(nb_rows2, nb_rows)
+        self.assertTrue(sample.equals(sample2))
+
+    def test_text_mode(self):
+        """Test sampling from text-mode file objects."""
+        data = self.make_csv(100000)
+        expected, expected_rows = read_sample(io.BytesIO(data), len(data),
+                                              200000)
+
+        # Wrapper around a binary file, sampled from the bytes
+        fp = io.TextIOWrapper(io.BytesIO(data), encoding='ascii')
+        sample, nb_rows = read_sample(fp, len(data), 200000)
+        self.assertEqual(nb_rows, expected_rows)
+        self.assertTrue(sample.equals(expected))
+
+        # In-memory text, sampled from the characters (ASCII here)
+        sample, nb_rows = read_sample(io.StringIO(data.decode('ascii')),
+                                      len(data), 200000)
+        self.assertEqual(nb_rows, expected_rows)
+        self.assertTrue(sample.equals(expected))
+
+    def test_whole_file(self):
+        """Test sampling more blocks than the file has."""
+        data = self.make_csv(1000, trailing_newline=False)
+        sample, nb_rows = read_sample(io.BytesIO(data), len(data), 10000000)
+        self.assertEqual(nb_rows, 1000)
+        self.assertEqual(sample['id'].astype(int).tolist(), list(range(1000)))
+
+    def test_long_values(self):
+        """Test sampling with multi-line values longer than a block."""
+        from datamart_profiler import SAMPLE_BLOCK_SIZE
+
+        long_value = '"%s"' % '\n'.join(
+            'line %d, "quoted"' % i
+            for i in range(SAMPLE_BLOCK_SIZE // 10)
+        ).replace('"quoted"', '""quoted""')
+        self.assertGreater(len(long_value), 2 * SAMPLE_BLOCK_SIZE)
+        lines = ['id,name,value']
+        for i in range(200000):
+            if i % 20000 == 3:
+                name = long_value
+            elif i % 3 == 0:
+                name = '"multi\nline, %d"' % i
+            else:
+                name = 'name %d' % i
+            lines.append('%d,%s,%d' % (i, name, i * 3))
+        data = ('\n'.join(lines) + '\n').encode('ascii')
+
+        sample, nb_rows = read_sample(io.BytesIO(data), len(data), 500000)
+        self.assertEqual(list(sample.columns), ['id', 'name', 'value'])
+        self.assertLess(abs(nb_rows - 200000), 30000)
+        ids = sample['id'].astype(int)
+        self.assertEqual(len(set(ids)), len(ids))
+        self.assertTrue(
+            (sample['value'].astype(int) == ids * 3).all()
+        )
+
+    def test_no_aligned_block(self):
+        """Test sampling when no block can be aligned on records."""
+        lines = ['id,name,value']
+        for i in range(20):
+            lines.append('%d,"%s",%d' % (
+                i,
+                '\n'.join('line %d, of %d' % (j, i) for j in range(8000)),
+                i * 3,
+            ))
+        data = ('\n'.join(lines) + '\n').encode('ascii')
+        sample, nb_rows = read_sample(io.BytesIO(data), len(data), 200000)
+        self.assertEqual(nb_rows, 20)
+        self.assertEqual(list(sample.columns), ['id', 'name', 'value'])
+        ids = sample['id'].astype(int)
+        self.assertTrue(
+            (sample['value'].astype(int) == ids * 3).all()
+        )
+
+    def test_process(self):
+        """Test that process_dataset() reports estimated row counts."""
+        data = self.make_csv(20000)
+        metadata = process_dataset(io.BytesIO(data), sample_size=100000,
+                                   coverage=False)
+        self.assertTrue(metadata['nb_rows_estimated'])
+        self.assertLess(abs(metadata['nb_rows'] - 20000), 2000)
+        self.assertLess(metadata['nb_profiled_rows'], 20000)
+
+        metadata = process_dataset(io.BytesIO(data), coverage=False)
+        self.assertNotIn('nb_rows_estimated', metadata)
+        self.assertEqual(metadata['nb_rows'], 20000)
+
+
 class TestTruncate(unittest.TestCase):
     def test_simple(self):
         from datamart_profiler import truncate_string
@@ -0,0 +1,450 @@
+import prometheus_client
+import threading
+import time
+import unittest
+from unittest import mock
+
+from datamart_core import types
+from query.search import PAGINATION_SIZE, UNION_MAX_CANDIDATES, \
+    DatasetColumns, SearchPlanner, SearchResultsCache, \
+    get_joinable_datasets, multi_search_all
+
+
+def fake_mget(datasets):
+    """Make a stand-in for ``Elasticsearch.mget()`` over some datasets.
+    """
+    def mget(index, body, **kwargs):
+        docs = []
+        for dataset_id in body['ids']:
+            if dataset_id in datasets:
+                docs.append({
+                    '_id': dataset_id,
+                    'found': True,
+                    '_source': {
+                        'columns': [
+                            {'name': name} for name in datasets[dataset_id]
+                        ],
+                    },
+                })
+            else:
+                docs.append({'_id': dataset_id, 'found': False})
+        return {'docs': docs}
+
+    return mock.Mock(side_effect=mget)
+
+
+def fake_msearch(hits_per_query):
+    """Make a stand-in for ``Elasticsearch.msearch()``.
+
+    Each search body has a query ``{'fake': name}``, which matches the hits
+    ``hits_per_query[name]``, a list of ``(score, id)``. Hits are sorted and
+    paginated like Elasticsearch does.
+    """
+    def msearch(body, **kwargs):
+        responses = []
+        for header, search in zip(body[::2], body[1::2]):
+            assert search['sort'] == [
+                '_score',
+                {'id': {'order': 'asc', 'unmapped_type': 'keyword'}},
+            ]
+            hits = sorted(
+                hits_per_query[search['query']['fake']],
+                key=lambda hit: (-hit[0], hit[1]),
+            )
+            if 'search_after' in search:
+                score, id_ = search['search_after']
+                hits = [
+                    hit for hit in hits
+                    if (-hit[0], hit[1]) > (-score, id_)
+                ]
+            responses.append({'hits': {'hits': [
+                {'_id': id_, '_score': score, 'sort': [score, id_]}
+                for score, id_ in hits[:search['size']]
+            ]}})
+        return {'responses': responses}
+
+    return mock.Mock(side_effect=msearch)
+
+
+def make_hits(nb):
+    # Some hits have the same score, the ID has to be used to break ties
+    return [(float(10 - i // 3), 'd%04d' % i) for i in range(nb)]
+
+
+class TestDatasetColumns(unittest.TestCase):
+    def test_prefetch(self):
+        """Test fetching the columns of several datasets at once."""
+        es = mock.Mock()
+        es.mget = fake_mget({
+            'd1': ['id', 'name', 'value'],
+            'd2': ['name', 'id'],
+        })
+        columns = DatasetColumns(es)
+        columns.prefetch(['d1', 'd2', 'd1'])
+        es.mget.assert_called_once_with(
+            index='datamart',
+            body={'ids': ['d1', 'd2']},
+            _source_includes=['columns.name'],
+        )
+
+        self.assertEqual(columns.get_indices('d1', ['value', 'id']), [2, 0])
+        self.assertEqual(columns.get_indices('d2', ['id', 'other']), [1, -1])
+        self.assertEqual(es.mget.call_count, 1)
+
+        # Only the datasets not known yet are fetched
+        columns.prefetch(['d2', 'd3'])
+        self.assertEqual(es.mget.call_count, 2)
+        self.assertEqual(es.mget.call_args[1]['body'], {'ids': ['d3']})
+
+    def test_get_indices(self):
+        """Test getting the columns of a dataset not fetched before."""
+        es = mock.Mock()
+        es.mget = fake_mget({'d1': ['id', 'name']})
+        columns = DatasetColumns(es)
+        self.assertEqual(columns.get_indices('d1', ['name']), [1])
+        self.assertEqual(columns.get_indices('d1', ['id']), [0])
+        es.mget.assert_called_once()
+
+    def test_duplicate_names(self):
+        """Test that the last column wins when names are repeated."""
+        es = mock.Mock()
+        es.mget = fake_mget({'d1': ['a', 'b', 'a']})
+        columns = DatasetColumns(es)
+        self.assertEqual(columns.get_indices('d1', ['a', 'b']), [2, 1])
+
+        columns.add('d2', [{'name': 'x'}, {'name': 'x'}, {'name': 'y'}])
+        self.assertEqual(columns.get_indices('d2', ['x', 'y']), [1, 2])
+        # Added datasets are not fetched
+        self.assertEqual(es.mget.call_count, 1)
+
+    def test_missing(self):
+        """Test that columns of datasets not in the index are all -1."""
+        es = mock.Mock()
+        es.mget = fake_mget({'d1': ['id']})
+        columns = DatasetColumns(es)
+        columns.prefetch(['d1', 'gone'])
+        self.assertEqual(columns.get_indices('gone', ['id', 'name']),
+                         [-1, -1])
+        self.assertEqual(columns.get_indices('d1', ['id']), [0])
+
+        # Missing datasets are not fetched again
+        self.assertEqual(columns.get_indices('gone', ['id']), [-1])
+        self.assertEqual(es.mget.call_count, 1)
+
+
+class TestMultiSearch(unittest.TestCase):
+    def test_pagination(self):
+        """Test getting all the hits of searches, a page at a time."""
+        es = mock.Mock()
+        es.msearch = fake_msearch({'a': make_hits(5), 'b': make_hits(2)})
+        results = multi_search_all(
+            es, 'datamart',
+            [{'query': {'fake': 'a'}}, {'query': {'fake': 'b'}}],
+            page_size=2,
+            request_timeout=30,
+        )
+        self.assertEqual(
+            [[hit['_id'] for hit in hits] for hits in results],
+            [['d0000', 'd0001', 'd0002', 'd0003', 'd0004'],
+             ['d0000', 'd0001']],
+        )
+
+        # Searches that are done are not sent again
+        self.assertEqual(
+            [len(c[1]['body']) // 2 for c in es.msearch.call_args_list],
+            [2, 2, 1],
+        )
+        first, second = es.msearch.call_args_list[:2]
+        self.assertEqual(first[1]['body'][0], {'index': 'datamart'})
+        self.assertEqual(first[1]['request_timeout'], 30)
+        self.assertNotIn('search_after', first[1]['body'][1])
+        self.assertEqual(second[1]['body'][1]['search_after'],
+                         [10.0, 'd0001'])
+
+    def test_max_hits(self):
+        """Test getting only the best hits of each search."""
+        es = mock.Mock()
+        es.msearch = fake_msearch({'a': make_hits(5)})
+        results = multi_search_all(
+            es, 'datamart', [{'query': {'fake': 'a'}}],
+            max_hits=3, page_size=2,
+        )
+        self.assertEqual([hit['_id'] for hit in results[0]],
+                         ['d0000', 'd0001', 'd0002'])
+        # The last page only asks for what's missing
+        self.assertEqual(
+            [c[1]['body'][1]['size'] for c in es.msearch.call_args_list],
+            [2, 1],
+        )
+
+        # Union search candidates
+        es.msearch = fake_msearch({'a': make_hits(UNION_MAX_CANDIDATES + 50)})
+        results = multi_search_all(
+            es, 'datamart', [{'query': {'fake': 'a'}}],
+            max_hits=UNION_MAX_CANDIDATES,
+        )
+        self.assertEqual(len(results[0]), UNION_MAX_CANDIDATES)
+        self.assertEqual(len(set(hit['_id'] for hit in results[0])),
+                         UNION_MAX_CANDIDATES)
+        self.assertEqual(es.msearch.call_count,
+                         -(-UNION_MAX_CANDIDATES // PAGINATION_SIZE))
+
+    def test_less_than_page(self):
+        """Test searches with fewer hits than a page."""
+        es = mock.Mock()
+        es.msearch = fake_msearch({'a': make_hits(3), 'b': []})
+        results = multi_search_all(
+            es, 'datamart',
+            [{'query': {'fake': 'a'}}, {'query': {'fake': 'b'}}],
+        )
+        self.assertEqual([len(hits) for hits in results], [3, 0])
+        es.msearch.assert_called_once()
+        self.assertEqual(es.msearch.call_args[1]['body'][1]['size'],
+                         PAGINATION_SIZE)
+
+        # No searches, no request
+        es.msearch.reset_mock()
+        self.assertEqual(multi_search_all(es, 'datamart', []), [])
+        es.msearch.assert_not_called()
+
+    def test_error(self):
+        """Test that errors from Elasticsearch are raised."""
+        es = mock.Mock()
+        es.msearch.return_value = {'responses': [
+            {'error': {'type': 'search_phase_execution_exception'}},
+        ]}
+        with self.assertRaises(RuntimeError):
+            multi_search_all(es, 'datamart', [{'query': {'fake': 'a'}}])
+
+
+class TestSearchPlanner(unittest.TestCase):
+    def setUp(self):
+        # Lets the slow searches finish once the test is over
+        self.release = threading.Event()
+        self.addCleanup(self.release.set)
+
+    def slow(self, result):
+        def func(*args, **kwargs):
+            self.release.wait(10)
+            return result
+        return func
+
+    def test_wait(self):
+        """Test getting the results of searches as they complete."""
+        planner = SearchPlanner(deadline=10, max_workers=2)
+        self.addCleanup(planner.shutdown)
+        fast = planner.submit(lambda: 'fast')
+        slow = planner.submit(self.slow('slow'))
+        self.assertEqual(planner.wait({fast, slow}), {fast})
+        self.release.set()
+        self.assertEqual(planner.wait({slow}), {slow})
+        self.assertEqual(slow.result(), 'slow')
+        self.assertFalse(planner.timed_out)
+
+    def test_deadline(self):
+        """Test abandoning the searches once the deadline is reached."""
+        planner = SearchPlanner(deadline=0.2, max_workers=1)
+        self.addCleanup(planner.shutdown)
+        running = planner.submit(self.slow('running'))
+        queued = planner.submit(self.slow('queued'))
+        start = time.perf_counter()
+        with self.assertLogs('query.search', 'WARNING') as logs:
+            done = planner.wait({running, queued})
+        self.assertLess(time.perf_counter() - start, 2)
+        self.assertEqual(done, set())
+        self.assertTrue(planner.timed_out)
+        self.assertEqual(
+            logs.output,
+            ["WARNING:query.search:Search deadline reached, abandoning 2 "
+             "searches"],
+        )
+        # Searches that haven't started are cancelled
+        self.assertTrue(queued.cancelled())
+
+        # Later calls return right away
+        self.assertEqual(planner.wait({running}), set())
+
+    # Input with 3 numerical columns and 2 textual columns
+    DATA_PROFILE = {
+        'columns': [
+            {
+                'name': name,
+                'structural_type': types.INTEGER,
+                'semantic_types': [],
+                'coverage': [{'range': {'gte': 0.0, 'lte': 10.0}}],
+            }
+            for name in ('a', 'b', 'c')
+        ] + [
+            {
+                'name': name,
+                'structural_type': types.TEXT,
+                'semantic_types': [],
+            }
+            for name in ('t', 'u')
+        ],
+        'lazo': [
+            {
+                'name': name,
+                'n_permutations': 2,
+                'hash_values': [1, 2],
+                'cardinality': 2,
+            }
+            for name in ('t', 'u')
+        ],
+    }
+
+    def join_search(self, planner, delays):
+        """Run a join search where each search takes some time.
+        """
+        def hits(name):
+            # Same scores, the order depends on how the results are merged
+            return [{
+                '_score': 1.0,
+                '_source': {'dataset_id': name, 'name': 'x', 'index': 0},
+            }]
+
+        def numerical_search(es, type_, type_value, column_name, *args):
+            delay = delays[column_name]
+            if delay is None:
+                self.release.wait(10)
+            else:
+                time.sleep(delay)
+            return hits('num_%s' % column_name)
+
+        def textual_search(es, dataset_ids, *args, **kwargs):
+            time.sleep(delays[dataset_ids[0]])
+            return hits('text_%s' % dataset_ids[0])
+
+        def query_sketches(lazo_client, sketches):
+            return [[('t', 'x', 0.9)], [('u', 'x', 0.9)]]
+
+        es = mock.Mock()
+        es.mget = fake_mget({
+            name: ['x']
+            for name in ('num_a', 'num_b', 'num_c', 'text_t', 'text_u',
+                         't', 'u')
+        })
+        with mock.patch('query.search.get_numerical_join_search_results',
+                        numerical_search), \
+                mock.patch('query.search.get_textual_join_search_results',
+                           textual_search), \
+                mock.patch('query.search.query_sketches', query_sketches):
+            results = get_joinable_datasets(
+                es, mock.Mock(), self.DATA_PROFILE, planner=planner,
+            )
+        return [
+            (result['id'], result['augmentation']['left_columns'])
+            for result in results
+        ]
+
+    def test_join_order(self):
+        """Test that concurrent join results come in the sequential order."""
+        # The first searches are the slowest
+        delays = {'a': 0.3, 'b': 0.2, 'c': 0.0, 't': 0.2, 'u': 0.0}
+        planner = SearchPlanner(deadline=10, max_workers=1)
+        self.addCleanup(planner.shutdown)
+        sequential = self.join_search(planner, delays)
+        self.assertEqual(
+            sequential,
+            [('num_a', [[0]]), ('num_b', [[1]]), ('num_c', [[2]]),
+             ('text_t', [[3]]), ('text_u', [[4]])],
+        )
+
+        planner = SearchPlanner(deadline=10)
+        self.addCleanup(planner.shutdown)
+        start = time.perf_counter()
+        self.assertEqual(self.join_search(planner, delays), sequential)
+        self.assertLess(time.perf_counter() - start, 0.6)
+        self.assertFalse(planner.timed_out)
+
+    def test_join_deadline(self):
+        """Test that a join search returns what it has at the deadline."""
+        delays = {'a': 0.0, 'b': None, 'c': 0.0, 't': 0.0, 'u': 0.0}
+        planner = SearchPlanner(deadline=0.5)
+        self.addCleanup(planner.shutdown)
+        with self.assertLogs('query.search', 'WARNING'):
+            results = self.join_search(planner, delays)
+        self.assertTrue(planner.timed_out)
+        self.assertEqual(
+            results,
+            [('num_a', [[0]]), ('num_c', [[2]]),
+             ('text_t', [[3]]), ('text_u', [[4]])],
+        )
+
+
+class TestSearchResultsCache(unittest.TestCase):
+    def test_key(self):
+        """Test building cache keys from searches."""
+        profile = {'columns': [{'name': 'a'}]}
+        key = SearchResultsCache.make_key(
+            'abc', profile, [{'match': 'x'}], [], [0, 2],
+        )
+        self.assertEqual(
+            SearchResultsCache.make_key(
+                'abc', profile, [{'match': 'x'}], [], (0, 2),
+            ),
+            key,
+        )
+        # The profile is only used if there is no data
+        self.assertEqual(
+            SearchResultsCache.make_key('abc', {}, [{'match': 'x'}], [],
+                                        [0, 2]),
+            key,
+        )
+        self.assertNotEqual(
+            SearchResultsCache.make_key(None, profile, [{'match': 'x'}], [],
+                                        [0, 2]),
+            key,
+        )
+        for other in [
+            ('abd', profile, [{'match': 'x'}], [], [0, 2]),
+            ('abc', profile, [{'match': 'y'}], [], [0, 2]),
+            ('abc', profile, [{'match': 'x'}], [{'match': 'x'}], [0, 2]),
+            ('abc', profile, [{'match': 'x'}], [], [0]),
+        ]:
+            self.assertNotEqual(SearchResultsCache.make_key(*other), key)
+
+        # The order of the variables doesn't matter
+        self.assertEqual(
+            SearchResultsCache.make_key(
+                'abc', profile, [{'match': 'x'}], [], [2, 0],
+            ),
+            key,
+        )
+
+        # Variables from the query might not be integers
+        self.assertEqual(
+            SearchResultsCache.make_key('abc', None, [], [], [1, 'a', None]),
+            SearchResultsCache.make_key('abc', None, [], [], [None, 1, 'a']),
+        )
+
+    def test_invalidate(self):
+        """Test dropping results when the datasets change."""
+        cache = SearchResultsCache(1000, None)
+        generation = cache.generation
+        cache.put('a', [{'id': 'd1'}], generation)
+        self.assertEqual(cache.get('a'), [{'id': 'd1'}])
+
+        cache.invalidate()
+        self.assertIsNone(cache.get('a'))
+        # Results from searches started before are not stored
+        cache.put('a', [{'id': 'd1'}], generation)
+        self.assertIsNone(cache.get('a'))
+
+        cache.put('a', [{'id': 'd2'}], cache.generation)
+        self.assertEqual(cache.get('a'), [{'id': 'd2'}])
+
+    def test_metrics(self):
+        """Test counting hits and misses."""
+        def count(name):
+            return prometheus_client.REGISTRY.get_sample_value(name) or 0.0
+
+        hits = count('search_cache_hits_total')
+        misses = count('search_cache_misses_total')
+        cache = SearchResultsCache(1000, None)
+        self.assertIsNone(cache.get('a'))
+        cache.put('a', [], cache.generation)
+        self.assertEqual(cache.get('a'), [])
+        self.assertEqual(cache.get('a'), [])
+        self.assertEqual(count('search_cache_hits_total') - hits, 2)
+        self.assertEqual(count('search_cache_misses_total') - misses, 1)